@@ -2,15 +2,19 @@
 """Data Graph
 """
 
+from collections import OrderedDict
+import heapq
+import threading
 import numpy as np
 import scipy as sp
 import scipy.spatial
 import scipy.sparse
-from joblib import Parallel, delayed
+import scipy.sparse.linalg
 from ..cython import utils_cy
 from .. import settings as sett
 from .. import logging as logg
 from .. import utils
+from .. import parallel
 from .ann_data import AnnData
 
 
@@ -25,8 +29,94 @@ def get_neighbors(X, Y, k):
     return indices_chunk, distances_chunk
 
 
-def get_distance_matrix_and_neighbors(X, k, sparse=True, n_jobs=1):
+def get_neighbors_brute(X, k, n_jobs=1):
+    """Exact k nearest neighbors by computing distances in blocks of rows."""
+    # a block of distances and the indices of argpartition take about 24 bytes
+    # per entry, use at most a tenth of max_memory and at max 20000 data points
+    max_len_chunk = int(0.1 * sett.max_memory * 2**30 / (24 * X.shape[0]))
+    max_len_chunk = max(min(20000, max_len_chunk), 1)
+    len_chunk = np.ceil(min(max_len_chunk * n_jobs, X.shape[0]) / n_jobs).astype(int)
+    n_chunks = np.ceil(X.shape[0] / len_chunk).astype(int)
+    chunks = [np.arange(start, min(start + len_chunk, X.shape[0]))
+             for start in range(0, n_chunks * len_chunk, len_chunk)]
+    indices = np.zeros((X.shape[0], k-1), dtype=np.int32)
+    distances = np.zeros((X.shape[0], k-1), dtype=np.float32)
+    if n_jobs > 1:
+        # set backend threading, said to be meaningful for computations
+        # with compiled code. more important: avoids hangs
+        # threads share X, hence, nothing needs to be copied
+        result_lst = parallel.run(get_neighbors,
+                                  [(X[chunk], X, k) for chunk in chunks],
+                                  n_jobs=n_jobs, backend='threading')
+    else:
+        logg.m('--> can be sped up by setting `n_jobs` > 1')
+    for i_chunk, chunk in enumerate(chunks):
+        if n_jobs > 1:
+            indices_chunk, distances_chunk = result_lst[i_chunk]
+        else:
+            indices_chunk, distances_chunk = get_neighbors(X[chunk], X, k)
+        indices[chunk] = indices_chunk
+        distances[chunk] = distances_chunk
+    return indices, distances
+
+
+def get_neighbors_sklearn(X, k, n_jobs=1):
+    """Exact k nearest neighbors using sklearn."""
+    from sklearn.neighbors import NearestNeighbors
+    sklearn_neighbors = NearestNeighbors(n_neighbors=k-1, n_jobs=n_jobs)
+    sklearn_neighbors.fit(X)
+    distances, indices = sklearn_neighbors.kneighbors()
+    distances = distances.astype('float32')**2
+    return indices, distances
+
+
+def get_neighbors_nn_descent(X, k, n_jobs=1, **params):
+    """Approximate k nearest neighbors, see `nn_descent.nn_descent`."""
+    from .nn_descent import nn_descent
+    return nn_descent(X, k-1, n_jobs=n_jobs, **params)
+
+
+neighbors_methods = {'brute': get_neighbors_brute,
+                     'sklearn': get_neighbors_sklearn,
+                     'nn_descent': get_neighbors_nn_descent}
+"""Methods for computing k nearest neighbors.
+
+Each method is called as `method(X, k, n_jobs=n_jobs, **params)` and returns
+arrays `indices` and `distances` of shape n_samples x (k-1), where distances
+are squared Euclidean distances and the point itself is not a neighbor. Add
+items to plug in further methods.
+"""
+
+exact_neighbors_methods = {'brute', 'sklearn'}
+"""Methods in `neighbors_methods` that compute exact neighbors."""
+
+
+def _resolve_neighbors_method(method, n_samples):
+    """Replace 'auto' by the method it chooses for n_samples."""
+    if method == 'auto':
+        # brute force is quadratic in the number of samples, sklearn is
+        # slower, but for large sample numbers more stable
+        method = 'brute' if n_samples <= 1e5 else 'sklearn'
+    if method not in neighbors_methods:
+        raise ValueError('`method` needs to be one of {}.'
+                         .format(['auto'] + list(neighbors_methods.keys())))
+    return method
+
+
+def get_distance_matrix_and_neighbors(X, k, sparse=True, n_jobs=1,
+                                      method='auto', method_params=None):
     """Compute distance matrix in squared Euclidian norm.
+
+    Parameters
+    ----------
+    method : str, optional (default: 'auto')
+        Method for computing neighbors if `sparse`, a key of
+        `neighbors_methods`. Defaults to exact computation, 'brute' for up
+        to 100000 samples and 'sklearn' above. Pass 'nn_descent' for a much
+        faster approximate computation on large data.
+    method_params : dict or None, optional (default: None)
+        Further parameters passed to the method, e.g., `n_trees`, `rho` or
+        `n_iters` for 'nn_descent', which trade off recall and speed.
     """
     if not sparse:
         if False: Dsq = utils.comp_distance(X, metric='sqeuclidean')
@@ -36,42 +126,187 @@ def get_distance_matrix_and_neighbors(X, k, sparse=True, n_jobs=1):
         indices = indices[sample_range, np.argsort(Dsq[sample_range, indices])]
         indices = indices[:, 1:]  # exclude first data point (point itself)
         distances = Dsq[sample_range, indices]
-    elif X.shape[0] > 1e5:
-        # sklearn is slower, but for large sample numbers more stable
-        from sklearn.neighbors import NearestNeighbors
-        sklearn_neighbors = NearestNeighbors(n_neighbors=k-1, n_jobs=n_jobs)
-        sklearn_neighbors.fit(X)
-        distances, indices = sklearn_neighbors.kneighbors()
-        distances = distances.astype('float32')**2
     else:
-        # assume we can fit at max 20000 data points into memory
-        len_chunk = np.ceil(min(20000, X.shape[0]) / n_jobs).astype(int)
-        n_chunks = np.ceil(X.shape[0] / len_chunk).astype(int)
-        chunks = [np.arange(start, min(start + len_chunk, X.shape[0]))
-                 for start in range(0, n_chunks * len_chunk, len_chunk)]
-        indices = np.zeros((X.shape[0], k-1), dtype=int)
-        distances = np.zeros((X.shape[0], k-1), dtype=np.float32)
-        if n_jobs > 1:
-            # set backend threading, said to be meaningful for computations
-            # with compiled code. more important: avoids hangs
-            # when using Parallel below, threading is much slower than
-            # multiprocessing
-            result_lst = Parallel(n_jobs=n_jobs, backend='threading')(
-                delayed(get_neighbors)(X[chunk], X, k) for chunk in chunks)
-        else:
-            logg.m('--> can be sped up by setting `n_jobs` > 1')
-        for i_chunk, chunk in enumerate(chunks):
-            if n_jobs > 1:
-                indices_chunk, distances_chunk = result_lst[i_chunk]
-            else:
-                indices_chunk, distances_chunk = get_neighbors(X[chunk], X, k)
-            indices[chunk] = indices_chunk
-            distances[chunk] = distances_chunk
+        method = _resolve_neighbors_method(method, X.shape[0])
+        logg.m('... computing neighbors using method', repr(method), v=4)
+        method_params = {} if method_params is None else method_params
+        indices, distances = neighbors_methods[method](X, k, n_jobs=n_jobs, **method_params)
+    # the graph is stored with int32 indices and float32 distances
+    indices = indices.astype(np.int32, copy=False)
+    distances = distances.astype(np.float32, copy=False)
     if sparse:
         Dsq = get_sparse_distance_matrix(indices, distances, X.shape[0], k)
     return Dsq, indices, distances
 
 
+def get_neighbors_cached(adata, X, rep, n_pcs, k, n_jobs=1,
+                         method='auto', method_params=None, recompute=False,
+                         overwrite=False):
+    """Get k nearest neighbors from the cache in adata.add or compute them.
+
+    The cache stores the neighbors of a single representation of the data. It
+    is reused if the representation, the metric and the method match and if
+    it stores at least k - 1 neighbors, otherwise, the neighbors are
+    recomputed. Exact methods are interchangeable.
+
+    Recomputed neighbors are written to the cache if there is none, if the
+    cache stores at most k - 1 neighbors or if `overwrite` is True. Hence, a
+    tool that needs few neighbors of another representation does not replace
+    a larger graph computed by `tl.neighbors` or another tool.
+
+    Parameters
+    ----------
+    adata : AnnData or None
+        Stores the cache. If None, neighbors are simply computed.
+    X : np.ndarray
+        The representation of the data.
+    rep : str
+        Key of the representation, 'X' or 'X_pca'.
+    n_pcs : int
+        Number of columns of the representation, 0 for 'X'.
+    k : int
+        Number of neighbors including the point itself.
+    method, method_params : see `get_distance_matrix_and_neighbors`
+    recompute : bool, optional (default: False)
+        Recompute even if matching neighbors are cached.
+    overwrite : bool, optional (default: False)
+        Write recomputed neighbors to the cache in any case.
+
+    Returns
+    -------
+    indices, distances : np.ndarray
+        Arrays of shape n_samples x (k-1) sorted by distance, storing squared
+        Euclidean distances.
+    """
+    method = _resolve_neighbors_method(method, X.shape[0])
+    if adata is not None and not recompute:
+        result = get_neighbors_from_cache(adata, X, rep, n_pcs, k,
+                                          method=method, method_params=method_params)
+        if result is not None:
+            logg.m('... using the', k - 1, 'nearest neighbors stored in adata.add')
+            return result
+    _, indices, distances = get_distance_matrix_and_neighbors(
+        X, k, sparse=True, n_jobs=n_jobs, method=method, method_params=method_params)
+    if adata is not None and (overwrite or 'neighbors_k' not in adata.add
+                              or int(adata.add['neighbors_k']) <= k):
+        adata.add['neighbors_indices'] = indices
+        adata.add['neighbors_distances'] = distances
+        adata.add['neighbors_k'] = k
+        adata.add['neighbors_rep'] = rep
+        adata.add['neighbors_n_pcs'] = n_pcs
+        adata.add['neighbors_metric'] = 'euclidean'
+        adata.add['neighbors_method'] = method
+        adata.add['neighbors_params'] = _params_to_str(method_params)
+        adata.add['neighbors_fingerprint'] = _fingerprint(X)
+    return indices, distances
+
+
+def get_neighbors_from_cache(adata, X, rep, n_pcs, k, method='auto', method_params=None):
+    """Return indices and distances of the k - 1 nearest neighbors if cached.
+
+    Neighbors computed by an exact method are returned for any exact method,
+    for instance, for 'auto'. Neighbors computed by an approximate method are
+    only returned for the same method and parameters.
+
+    Returns None on any mismatch with the cache.
+    """
+    if 'neighbors_indices' not in adata.add: return None
+    add = adata.add
+    method = _resolve_neighbors_method(method, X.shape[0])
+    method_cached = _to_str(add.get('neighbors_method', ''))
+    if method in exact_neighbors_methods:
+        method_matches = method_cached in exact_neighbors_methods
+    else:
+        method_matches = (method_cached == method
+                          and _to_str(add.get('neighbors_params', ''))
+                          == _params_to_str(method_params))
+    if (not method_matches
+        or _to_str(add['neighbors_rep']) != rep
+        or int(add['neighbors_n_pcs']) != n_pcs
+        or _to_str(add['neighbors_metric']) != 'euclidean'
+        or int(add['neighbors_k']) < k
+        or add['neighbors_indices'].shape[0] != X.shape[0]
+        or _to_str(add['neighbors_fingerprint']) != _fingerprint(X)):
+        return None
+    # neighbors are sorted by distance
+    return (add['neighbors_indices'][:, :k-1].astype(np.int32, copy=False),
+            add['neighbors_distances'][:, :k-1].astype(np.float32, copy=False))
+
+
+def _allocate_matrix(shape, name, dtype=np.float32):
+    """Allocate in memory or, if above half of `sett.max_memory`, on disk."""
+    n_bytes = np.prod(shape) * np.dtype(dtype).itemsize
+    if n_bytes > 0.5 * sett.max_memory * 2**30:
+        logg.m('... {} requires {:.1f} GB, storing it in a memory-mapped file'
+               .format(name, n_bytes / 2**30))
+        return parallel.memmap(name, shape, dtype)
+    return np.empty(shape, dtype)
+
+
+def _fill_blockwise(M, get_rows, n_jobs=1):
+    """Fill M with get_rows(rows) for blocks of rows, using threads."""
+    len_block = max(2**22 // M.shape[1], 1)
+    blocks = [slice(start, min(start + len_block, M.shape[0]))
+              for start in range(0, M.shape[0], len_block)]
+
+    def fill(rows):
+        M[rows] = get_rows(rows)
+    # threads share M, the matrix products release the GIL
+    parallel.run(fill, [(rows,) for rows in blocks], n_jobs=n_jobs, backend='threading')
+    if isinstance(M, np.memmap): M.flush()
+
+
+def get_closest_row(X, x):
+    """Index of the row of X that is closest to x in Euclidian distance.
+
+    X can be dense or sparse and is processed in chunks of rows that fit
+    into the CPU cache.
+    """
+    # chunks of about 2**20 entries
+    len_chunk = max(2**20 // max(X.shape[1], 1), 1)
+    x = np.asarray(x, dtype=np.result_type(X.dtype, np.float32))
+    i_min, dsq_min = 0, np.inf
+    for start in range(0, X.shape[0], len_chunk):
+        chunk = X[start:start + len_chunk]
+        if sp.sparse.issparse(chunk):
+            dsq = (np.ravel(chunk.multiply(chunk).sum(axis=1))
+                   - 2 * chunk.dot(x) + x.dot(x))
+        else:
+            diff = chunk - x
+            dsq = np.einsum('ij,ij->i', diff, diff)
+        i = np.argmin(dsq)
+        if dsq[i] < dsq_min:
+            i_min, dsq_min = start + i, dsq[i]
+    return i_min
+
+
+def _fingerprint(X):
+    """Hash of all entries, detects a changed representation.
+
+    Costs a single pass over the data, which is processed in chunks of rows.
+    """
+    import hashlib
+    md5 = hashlib.md5(str((X.shape, X.dtype)).encode())
+    if sp.sparse.issparse(X):
+        X = X.tocsr()
+        for a in [X.data, X.indices, X.indptr]:
+            md5.update(np.ascontiguousarray(a).tobytes())
+    else:
+        len_chunk = max(2**22 // max(X.shape[1] if X.ndim > 1 else 1, 1), 1)
+        for start in range(0, X.shape[0], len_chunk):
+            md5.update(np.ascontiguousarray(X[start:start + len_chunk]).tobytes())
+    return md5.hexdigest()
+
+
+def _params_to_str(params):
+    return str(sorted(params.items())) if params else ''
+
+
+def _to_str(value):
+    value = np.asarray(value).item() if isinstance(value, np.ndarray) else value
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
 def get_sparse_distance_matrix(indices, distances, n_samples, k):
     n_neighbors = k - 1
     n_nonzero = n_samples * n_neighbors
@@ -80,18 +315,364 @@ def get_sparse_distance_matrix(indices, distances, n_samples, k):
                                 indices.ravel(),
                                 indptr),
                                 shape=(n_samples, n_samples))
-    return Dsq
+    return compact_csr(Dsq)
+
+
+def compact_csr(A):
+    """Return A as CSR matrix with int32 indices and float32 data.
+
+    All graph matrices are stored like this. Compared to int64 and float64,
+    this halves the memory and speeds up the sparse matrix-vector products
+    in the eigen solvers. Indices are only kept as int64 if they overflow.
+    """
+    A = sp.sparse.csr_matrix(A)
+    if max(A.shape[1], A.nnz) < 2**31:
+        A.indices = A.indices.astype(np.int32, copy=False)
+        A.indptr = A.indptr.astype(np.int32, copy=False)
+    A.data = A.data.astype(np.float32, copy=False)
+    return A
+
+
+def _get_gaussian_kernel_chunk(X, chunk, sigmas, cutoff):
+    Dsq = utils.comp_sqeuclidean_distance_using_matrix_mult(X[chunk], X)
+    Dsq[np.arange(len(chunk)), chunk] = 0  # as for the full distance matrix
+    sigmas_sq = sigmas**2
+    Den = np.add.outer(sigmas_sq[chunk], sigmas_sq)
+    W = np.multiply.outer(2 * sigmas[chunk], sigmas)
+    W /= Den
+    np.sqrt(W, out=W)
+    Dsq /= -Den
+    np.exp(Dsq, out=Dsq)
+    W *= Dsq
+    W[W <= cutoff] = 0
+    return sp.sparse.csr_matrix(W)
+
+
+def get_gaussian_kernel(X, sigmas, cutoff=1e-14, n_jobs=1):
+    """Gaussian kernel with adaptive widths, thresholded to a sparse matrix.
+
+    The kernel is computed in blocks of rows so that the dense blocks stay
+    within a fraction of `sett.max_memory` and only entries larger than
+    `cutoff` are kept.
+
+    Parameters
+    ----------
+    X : np.ndarray
+        Data array (rows store samples).
+    sigmas : np.ndarray
+        Kernel width for each sample.
+    cutoff : float, optional (default: 1e-14)
+        Entries of the kernel below this value are set to zero.
+
+    Returns
+    -------
+    W : sp.sparse.csr_matrix
+        Symmetric weight matrix of shape n_samples x n_samples.
+    """
+    n_samples = X.shape[0]
+    # four dense float64 arrays of shape len_chunk x n_samples per job,
+    # use at most a tenth of max_memory
+    len_chunk = int(0.1 * sett.max_memory * 2**30 / (4 * 8 * n_samples * n_jobs))
+    len_chunk = min(max(len_chunk, 1), n_samples)
+    chunks = [np.arange(start, min(start + len_chunk, n_samples))
+              for start in range(0, n_samples, len_chunk)]
+    args_list = [(X, chunk, sigmas, cutoff) for chunk in chunks]
+    if n_jobs > 1 and len(chunks) > 1:
+        W_chunks = parallel.run(_get_gaussian_kernel_chunk, args_list,
+                                n_jobs=n_jobs, backend='threading')
+    else:
+        W_chunks = [_get_gaussian_kernel_chunk(*args) for args in args_list]
+    return compact_csr(sp.sparse.vstack(W_chunks, format='csr'))
+
+
+def eigsh_arpack(A, k, largest=True, tol=None, v0=None):
+    """Eigenvalues and -vectors of symmetric A using ARPACK (`eigsh`).
+
+    Returns eigenvalues in increasing order, eigenvectors and the number of
+    matrix-vector products.
+    """
+    # as for all solvers, compute in double precision even if A is stored
+    # in single precision, eigenvalues close to one need it
+    A = A.astype(np.float64, copy=False)
+    n_matvecs = [0]
+
+    def matvec(x):
+        n_matvecs[0] += 1
+        return A.dot(x)
+    A_op = sp.sparse.linalg.LinearOperator(A.shape, matvec=matvec, dtype=A.dtype)
+    if v0 is not None:
+        # ARPACK accepts a single start vector, mix the guessed eigenvectors
+        v0 = np.asarray(v0[:, :k], dtype=A.dtype).sum(axis=1)
+    which = 'LM' if largest else 'SM'
+    evals, evecs = sp.sparse.linalg.eigsh(A_op, k=k, which=which, v0=v0,
+                                          tol=0 if tol is None else tol)
+    return evals, evecs, n_matvecs[0]
+
+
+def eigsh_lobpcg(A, k, largest=True, tol=None, v0=None, maxiter=1000, random_state=0):
+    """Eigenvalues and -vectors of symmetric A using LOBPCG.
+
+    The block of initial vectors is `v0`, completed by random vectors.
+    Returns eigenvalues in increasing order, eigenvectors and the number of
+    iterations.
+    """
+    A = A.astype(np.float64, copy=False)
+    X = _init_block(A.shape[0], k, v0, random_state)
+    evals, evecs, residuals = sp.sparse.linalg.lobpcg(
+        A, X, tol=tol, maxiter=maxiter, largest=largest,
+        retResidualNormsHistory=True)
+    order = np.argsort(evals)
+    return evals[order], evecs[:, order], len(residuals)
+
+
+def eigsh_randomized(A, k, largest=True, tol=None, v0=None, maxiter=1000,
+                     n_oversamples=10, degree=8, random_state=0):
+    """Eigenvalues and -vectors of symmetric A using randomized subspace iteration.
+
+    Iterate a block of k + `n_oversamples` vectors, initialized with `v0` and
+    random vectors, until the residuals of the Ritz pairs with largest
+    eigenvalues fall below `tol` (default: 1e-6). Each iteration applies a
+    Chebyshev polynomial of `degree` that damps the unwanted part of the
+    spectrum, which is essential for the clustered eigenvalues close to one
+    of diffusion operators. Returns eigenvalues in increasing order,
+    eigenvectors and the number of iterations.
+    """
+    if not largest:
+        raise ValueError('Solver \'randomized\' only computes the largest eigenvalues.')
+    tol = 1e-6 if tol is None or tol == 0 else tol
+    A = A.astype(np.float64, copy=False)
+    # bound for the spectral radius
+    radius = np.max(abs(A).sum(axis=1))
+    Q, _ = np.linalg.qr(_init_block(A.shape[0], min(A.shape[0], k + n_oversamples),
+                                    v0, random_state))
+    for n_iter in range(1, maxiter + 1):
+        Z = A.dot(Q)
+        # Rayleigh-Ritz projection on the current subspace
+        evals, S = np.linalg.eigh(Q.T.dot(Z))
+        evecs = Q.dot(S[:, -k:])
+        residuals = np.linalg.norm(Z.dot(S[:, -k:]) - evecs * evals[-k:], axis=0)
+        if np.max(residuals) <= tol: break
+        # damp the interval [-radius, evals[0]] that bounds unwanted eigenvalues
+        Q, _ = np.linalg.qr(_chebyshev_filter(A, Q.dot(S), Z.dot(S), degree,
+                                              -radius, evals[0]))
+    return evals[-k:], evecs, n_iter
+
+
+def _chebyshev_filter(A, X, AX, degree, lower, upper):
+    """Apply Chebyshev polynomial that is small on [lower, upper] to X."""
+    center, half_width = (upper + lower) / 2, (upper - lower) / 2
+    Y_prev, Y = X, (AX - center * X) / half_width
+    for _ in range(1, degree):
+        Y_prev, Y = Y, 2 * (A.dot(Y) - center * Y) / half_width - Y_prev
+    # normalize columns to avoid overflow
+    return Y / np.linalg.norm(Y, axis=0)
+
+
+def _init_block(n, k, v0, random_state):
+    X = np.random.RandomState(random_state).randn(n, k)
+    if v0 is not None:
+        n_init = min(k, v0.shape[1])
+        X[:, :n_init] = v0[:, :n_init]
+    return X
+
+
+eigen_solvers = {'arpack': eigsh_arpack,
+                 'lobpcg': eigsh_lobpcg,
+                 'randomized': eigsh_randomized}
+"""Solvers for the eigendecomposition in `DataGraph.embed`.
+
+Each solver is called as `solver(A, k, largest=largest, tol=tol, v0=v0)`,
+where `v0` is None or an initial guess for the eigenvectors in columns, and
+returns eigenvalues in increasing order, eigenvectors in columns and the
+number of iterations, which are matrix-vector products for 'arpack'.
+"""
+
+
+def _get_Ddiff_row_chunk(m_i, j_range, evals, rbasis, lbasis, M=None):
+    d_i = np.zeros(len(j_range))
+    for j_cnt, j in enumerate(j_range):
+        if M is None:
+            m_j = utils_cy.get_M_row(j, evals, rbasis, lbasis)
+        else:
+            m_j = M[j]
+        d_i[j_cnt] = utils_cy.c_dist(m_i, m_j)
+    return d_i
+
+
+class BoxTree(object):
+    """Index of points for nearest and farthest point queries.
+
+    Nearest points are found by a `scipy.spatial.cKDTree`. For farthest
+    points, the points are recursively split at the median of the coordinate
+    with the largest spread, and each node stores the bounding box of its
+    points. A query visits the nodes in the order of an upper bound for the
+    distance, which is given by the farthest corner of the box, and stops
+    once no node can contain a farther point than the best found so far.
+    For points that lie on a low-dimensional manifold, as for diffusion
+    coordinates, this visits a number of nodes that grows like log n.
+
+    Parameters
+    ----------
+    X : np.ndarray
+        Coordinates, rows store points.
+    leaf_size : int, optional (default: 32)
+        Maximal number of points in a leaf.
+    """
+    def __init__(self, X, leaf_size=32):
+        self.X = np.asarray(X, dtype=np.float64)
+        self.perm = np.arange(self.X.shape[0])
+        # nodes in breadth-first order, children come after their parents
+        nodes, children = [(0, self.X.shape[0])], []
+        for start, end in nodes:
+            if end - start <= leaf_size:
+                children.append((-1, -1))
+                continue
+            idx = self.perm[start:end]
+            dim = np.argmax(np.ptp(self.X[idx], axis=0))
+            half = (end - start) // 2
+            self.perm[start:end] = idx[np.argpartition(self.X[idx, dim], half)]
+            children.append((len(nodes), len(nodes) + 1))
+            nodes += [(start, start + half), (start + half, end)]
+        self.nodes = np.array(nodes)
+        self.children = np.array(children)
+        # bounding boxes of the leaves, then of the inner nodes
+        leaves = np.flatnonzero(self.children[:, 0] == -1)
+        leaves = leaves[np.argsort(self.nodes[leaves, 0])]
+        Xperm = self.X[self.perm]
+        self.lo = np.empty((len(nodes), self.X.shape[1]))
+        self.hi = np.empty((len(nodes), self.X.shape[1]))
+        self.lo[leaves] = np.minimum.reduceat(Xperm, self.nodes[leaves, 0], axis=0)
+        self.hi[leaves] = np.maximum.reduceat(Xperm, self.nodes[leaves, 0], axis=0)
+        for inode in range(len(nodes) - 1, -1, -1):
+            left, right = self.children[inode]
+            if left == -1: continue
+            self.lo[inode] = np.minimum(self.lo[left], self.lo[right])
+            self.hi[inode] = np.maximum(self.hi[left], self.hi[right])
+        self._kdtree = None
+
+    def nearest(self, x):
+        """Return index of the nearest point to x and the distance."""
+        if self._kdtree is None:
+            self._kdtree = sp.spatial.cKDTree(self.X)
+        d, i = self._kdtree.query(x)
+        return i, d
+
+    def farthest(self, Y):
+        """Return index of the point with the largest sum of distances to the
+        rows of Y and this sum.
+        """
+        Y = np.atleast_2d(Y)
+        best, best_d = -1, -np.inf
+        heap = [(-self._upper_bound([0], Y)[0], 0)]
+        while heap:
+            bound, inode = heapq.heappop(heap)
+            if -bound <= best_d: break
+            if self.children[inode, 0] == -1:
+                start, end = self.nodes[inode]
+                d = np.zeros(end - start)
+                for y in Y:
+                    d += np.sqrt(np.sum((self.X[self.perm[start:end]] - y)**2, axis=1))
+                i = np.argmax(d)
+                if d[i] > best_d:
+                    best, best_d = self.perm[start + i], d[i]
+            else:
+                for child, bound in zip(self.children[inode],
+                                        self._upper_bound(self.children[inode], Y)):
+                    if bound > best_d: heapq.heappush(heap, (-bound, child))
+        return best, best_d
+
+    def _upper_bound(self, inodes, Y):
+        """Upper bound for the sum of distances to Y of the points in the nodes."""
+        lo, hi = self.lo[inodes], self.hi[inodes]
+        bound = np.zeros(len(inodes))
+        for y in Y:
+            bound += np.sqrt(np.sum(np.maximum((y - lo)**2, (hi - y)**2), axis=1))
+        return bound
+
+
+n_Ddiff_trees = 32
+"""Number of trees kept by `DataGraph.get_Ddiff_tree`."""
+
+_Ddiff_trees_lock = threading.Lock()
+
+
+class RowCache(object):
+    """Least-recently-used cache of matrix rows within a memory budget.
+
+    Parameters
+    ----------
+    max_bytes : int or None, optional (default: None)
+        Budget for the stored rows, defaults to a tenth of `sett.max_memory`.
+    dtype : dtype or None, optional (default: None)
+        Store rows with this dtype, e.g., np.float32 to halve the memory.
+
+    Lookups and insertions are guarded by a lock, so that a cache can be
+    shared by threads.
+
+    Attributes
+    ----------
+    hits, misses : int
+        Number of lookups that found and did not find a row, respectively.
+    n_bytes : int
+        Memory used by the stored rows.
+    """
+    def __init__(self, max_bytes=None, dtype=None):
+        self.max_bytes = (int(0.1 * sett.max_memory * 2**30)
+                          if max_bytes is None else max_bytes)
+        self.dtype = dtype
+        self.rows = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def get(self, key):
+        """Return row or None, and mark it as recently used."""
+        with self._lock:
+            if key in self.rows:
+                self.hits += 1
+                self.rows.move_to_end(key)
+                return self.rows[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, row):
+        """Store and return a copy of row, evict the least recently used rows."""
+        row = np.array(row, dtype=self.dtype)
+        with self._lock:
+            if key in self.rows:
+                self.n_bytes -= self.rows.pop(key).nbytes
+            self.rows[key] = row
+            self.n_bytes += row.nbytes
+            while self.n_bytes > self.max_bytes and len(self.rows) > 1:
+                self.n_bytes -= self.rows.popitem(last=False)[1].nbytes
+        return row
 
 
 class OnFlySymMatrix():
     """Emulate a matrix where elements are calculated on the fly.
+
+    Rows are computed by `get_rows` if passed, which computes several rows in
+    one call, otherwise by `get_row`. Indexing with an array of row indices
+    returns the corresponding rows as a 2d array and fetches all missing
+    rows at once. Computed rows are kept in `rows`, a `RowCache` shared with
+    restricted views, which is created with `max_bytes` and `dtype` if not
+    passed.
     """
-    def __init__(self, get_row, shape, DC_start=0, DC_end=-1, rows=None, restrict_array=None):
+    def __init__(self, get_row, shape, DC_start=0, DC_end=-1, rows=None,
+                 restrict_array=None, get_rows=None, max_bytes=None, dtype=None):
         self.get_row = get_row
+        self.get_rows = get_rows
         self.shape = shape
         self.DC_start = DC_start
         self.DC_end = DC_end
-        self.rows = {} if rows is None else rows
+        self.rows = RowCache(max_bytes, dtype) if rows is None else rows
         self.restrict_array = restrict_array  # restrict the array to a subset
 
     def __getitem__(self, index):
@@ -101,26 +682,50 @@ class OnFlySymMatrix():
             else:
                 # map the index back to the global index
                 glob_index = self.restrict_array[index]
-            if glob_index not in self.rows:
-                self.rows[glob_index] = self.get_row(glob_index,
-                                                     DC_start=self.DC_start,
-                                                     DC_end=self.DC_end)
-            row = self.rows[glob_index]
+            row = self._fetch([glob_index])[0]
             if self.restrict_array is None:
                 return row
             else:
                 return row[self.restrict_array]
+        elif isinstance(index, (list, np.ndarray)):
+            glob_indices = (np.asarray(index) if self.restrict_array is None
+                            else self.restrict_array[index])
+            rows = np.array(self._fetch(glob_indices))
+            if self.restrict_array is None:
+                return rows
+            else:
+                return rows[:, self.restrict_array]
         else:
             if self.restrict_array is None:
                 glob_index_0, glob_index_1 = index
             else:
                 glob_index_0 = self.restrict_array[index[0]]
                 glob_index_1 = self.restrict_array[index[1]]
-            if glob_index_0 not in self.rows:
-                self.rows[glob_index_0] = self.get_row(glob_index_0,
-                                                       DC_start=self.DC_start,
-                                                       DC_end=self.DC_end)
-            return self.rows[glob_index_0][glob_index_1]
+            return self._fetch([glob_index_0])[0][glob_index_1]
+
+    def fetch(self, indices):
+        """Compute all rows among indices that are not yet stored in one batch."""
+        indices = np.asarray(indices, dtype=int)
+        self._fetch(indices if self.restrict_array is None
+                    else self.restrict_array[indices])
+
+    def _fetch(self, glob_indices):
+        """Return the rows for global indices, computing the missing ones."""
+        rows = {}
+        for i in glob_indices:
+            if i not in rows:
+                rows[i] = self.rows.get((i, self.DC_start, self.DC_end))
+        missing = [i for i in rows if rows[i] is None]
+        if len(missing) > 0:
+            if self.get_rows is not None:
+                new_rows = self.get_rows(missing, DC_start=self.DC_start,
+                                         DC_end=self.DC_end)
+            else:
+                new_rows = [self.get_row(i, DC_start=self.DC_start, DC_end=self.DC_end)
+                            for i in missing]
+            for i, row in zip(missing, new_rows):
+                rows[i] = self.rows.put((i, self.DC_start, self.DC_end), row)
+        return [rows[i] for i in glob_indices]
 
     def restrict(self, index_array):
         """Generate a 1d view of the data.
@@ -128,7 +733,8 @@ class OnFlySymMatrix():
         new_shape = index_array.shape[0], index_array.shape[0]
         return OnFlySymMatrix(self.get_row, new_shape, DC_start=self.DC_start,
                               DC_end=self.DC_end,
-                              rows=self.rows, restrict_array=index_array)
+                              rows=self.rows, restrict_array=index_array,
+                              get_rows=self.get_rows)
 
 
 class DataGraph(object):
@@ -136,16 +742,24 @@ class DataGraph(object):
     """
 
     def __init__(self, adata_or_X, k=30, knn=True,
-                 n_jobs=None, n_pcs=30, n_pcs_post=30,
+                 n_jobs=None, n_pcs=30, n_pcs_post=None,
                  recompute_pca=None,
                  recompute_diffmap=None,
-                 flavor='haghverdi16'):
+                 flavor='haghverdi16',
+                 neighbors_method='auto', neighbors_params=None,
+                 eigen_solver='arpack', eigen_tol=None, warm_start=True):
         logg.m('initializing data graph')
         self.k = k
         self.knn = knn
+        self.neighbors_method = neighbors_method
+        self.neighbors_params = neighbors_params
+        self.eigen_solver = eigen_solver
+        self.eigen_tol = eigen_tol
         self.n_jobs = sett.n_jobs if n_jobs is None else n_jobs
         self.n_pcs = n_pcs
-        self.n_pcs_post = 30
+        if n_pcs_post is not None:
+            logg.m('WARNING: n_pcs_post is deprecated and ignored, the DPT distance\n'
+                   '    is computed from the diffusion components', v='warn')
         self.flavor = flavor  # this is to experiment around
         self.sym = True  # we do not allow asymetric cases
         isadata = isinstance(adata_or_X, AnnData)
@@ -154,6 +768,9 @@ class DataGraph(object):
             X = adata_or_X.X
         else:
             X = adata_or_X
+        # the AnnData that caches neighbors and the key of the representation
+        self.adata = adata if isadata else None
+        self.rep = 'X_pca', self.n_pcs
         # retrieve xroot
         xroot = None
         if 'xroot' in adata.add: xroot = adata.add['xroot']
@@ -161,6 +778,7 @@ class DataGraph(object):
         if (self.n_pcs == 0  # use the full X as n_pcs == 0
             or X.shape[1] < self.n_pcs):
             self.X = X
+            self.rep = 'X', 0
             logg.m('... using X for building graph')
             if xroot is not None: self.set_root(xroot)
         # use the precomupted X_pca
@@ -196,14 +814,21 @@ class DataGraph(object):
             self.evals = np.r_[1, adata.add['diffmap_evals']]
             self.rbasis = np.c_[adata.smp['X_diffmap0'][:, None], adata.smp['X_diffmap']]
             self.lbasis = self.rbasis
-            if knn: self.Dsq = adata.add['distance']
+            if knn: self.Dsq = compact_csr(adata.add['distance'])
             self.Dchosen = OnFlySymMatrix(self.get_Ddiff_row,
-                                          shape=(self.X.shape[0], self.X.shape[0]))
+                                          shape=(self.X.shape[0], self.X.shape[0]),
+                                          get_rows=self.get_Ddiff_rows)
         else:
             self.evals = None
             self.rbasis = None
             self.lbasis = None
             self.Dsq = None
+        # a previously computed diffmap serves as initial guess for the
+        # eigendecomposition, which then converges much faster
+        self.evecs_init = None
+        if (warm_start and self.evals is None and isadata
+            and 'X_diffmap' in adata.smp and 'X_diffmap0' in adata.smp):
+            self.evecs_init = np.c_[adata.smp['X_diffmap0'][:, None], adata.smp['X_diffmap']]
         # further attributes that might be written during the computation
         self.M = None
 
@@ -214,7 +839,7 @@ class DataGraph(object):
         if self.evals is None:
             logg.m('start computing Diffusion Map', r=True)
             self.compute_transition_matrix()
-            self.embed(n_evals=n_comps)
+            self.embed(n_evals=n_comps, v0=self.evecs_init)
         # write results to dictionary
         ddmap = {}
         # skip the first eigenvalue/eigenvector
@@ -232,17 +857,35 @@ class DataGraph(object):
         self.compute_M_matrix()
         self.compute_Ddiff_matrix()
 
-    def compute_C_all(self, n_evals=10):
+    def compute_C_all(self, n_evals=10, on_the_fly=False):
         self.compute_L_matrix()
         self.embed(self.L, n_evals=n_evals, sort='increase')
-        evalsL = self.evals
-        self.compute_Lp_matrix()
-        self.compute_C_matrix()
+        self.compute_C_matrix(on_the_fly=on_the_fly)
 
-    def spec_layout(self):
+    def spec_layout(self, n_comps=2, normalized=True):
+        """Spectral layout, that is, Laplacian eigenmaps of the graph.
+
+        For the normalized Laplacian I - Ktilde, the eigenvectors with the
+        smallest eigenvalues are those with the largest eigenvalues of the
+        normalized adjacency Ktilde, which the eigen solvers find quickly. For
+        the unnormalized Laplacian, the solvers search the smallest
+        eigenvalues of the sparse Laplacian.
+
+        Parameters
+        ----------
+        n_comps : int, optional (default: 2)
+            Number of components, the trivial first eigenvector is skipped.
+        normalized : bool, optional (default: True)
+            Use the normalized Laplacian and return the eigenvectors of the
+            random walk Laplacian, as in Belkin & Niyogi (2003).
+        """
         self.compute_transition_matrix()
-        self.compute_L_matrix()
-        self.embed(self.L, sort='increase')
+        if normalized:
+            self.embed(self.Ktilde, n_evals=n_comps+1, sym=False, sort='decrease')
+            self.evals = 1 - self.evals
+        else:
+            self.compute_L_matrix()
+            self.embed(self.L, n_evals=n_comps+1, sym=True, sort='increase')
         # write results to dictionary
         ddmap = {}
         # skip the first eigenvalue/eigenvector
@@ -267,12 +910,17 @@ class DataGraph(object):
         Also Haghverdi et al. (2016, 2015) and Coifman and Lafon (2006) and
         Coifman et al. (2005).
         """
-        result = get_distance_matrix_and_neighbors(X=self.X,
-                                                   k=self.k,
-                                                   sparse=self.knn,
-                                                   n_jobs=self.n_jobs)
-        Dsq, indices, distances_sq = result
-        self.Dsq = Dsq
+        if self.knn:
+            indices, distances_sq = get_neighbors_cached(
+                self.adata, self.X, *self.rep, k=self.k, n_jobs=self.n_jobs,
+                method=self.neighbors_method, method_params=self.neighbors_params)
+            Dsq = get_sparse_distance_matrix(indices, distances_sq, self.X.shape[0], self.k)
+            self.Dsq = Dsq
+        else:
+            # only the distance to the k-th neighbor is needed
+            indices, distances_sq = get_neighbors_brute(self.X, self.k, n_jobs=self.n_jobs)
+            # the kernel is computed chunk-wise below, there is no distance matrix
+            self.Dsq = None
         # choose sigma, the heuristic here often makes not much
         # of a difference, but is used to reproduce the figures
         # of Haghverdi et al. (2016)
@@ -286,52 +934,43 @@ class DataGraph(object):
             # zero - in its sorted position
             sigmas_sq = distances_sq[:, -1]/4
         sigmas = np.sqrt(sigmas_sq)
+        # the kernel widths and the density are needed to extend the kernel
+        # to new data points in `transform`
+        self.sigmas = sigmas
+        self.alpha = alpha
+        self.q = None
         logg.m('... determined k =', self.k, 'nearest neighbors of each point', t=True)
 
         if self.flavor == 'unweighted':
             if not self.knn:
                 raise ValueError('`flavor="unweighted"` only with `knn=True`.')
-            self.Ktilde = self.Dsq.sign()
+            self.Ktilde = compact_csr(self.Dsq.sign())
             return
 
         # compute the symmetric weight matrix
-        if not sp.sparse.issparse(self.Dsq):
-            Num = 2 * np.multiply.outer(sigmas, sigmas)
-            Den = np.add.outer(sigmas_sq, sigmas_sq)
-            W = np.sqrt(Num/Den) * np.exp(-Dsq/Den)
-            # make the weight matrix sparse
-            if not self.knn:
-                self.Mask = W > 1e-14
-                W[self.Mask == False] = 0
-            else:
-                # restrict number of neighbors to ~k
-                # build a symmetric mask
-                Mask = np.zeros(Dsq.shape, dtype=bool)
-                for i, row in enumerate(indices):
-                    Mask[i, row] = True
-                    for j in row:
-                        if i not in set(indices[j]):
-                            W[j, i] = W[i, j]
-                            Mask[j, i] = True
-                # set all entries that are not nearest neighbors to zero
-                W[Mask == False] = 0
-                self.Mask = Mask
+        if not self.knn:
+            # Gaussian kernel on all pairs, thresholded to a sparse matrix
+            W = get_gaussian_kernel(self.X, sigmas, cutoff=1e-14, n_jobs=self.n_jobs)
         else:
-            W = Dsq
-            for i in range(len(Dsq.indptr[:-1])):
-                row = Dsq.indices[Dsq.indptr[i]:Dsq.indptr[i+1]]
-                num = 2 * sigmas[i] * sigmas[row]
-                den = sigmas_sq[i] + sigmas_sq[row]
-                W.data[Dsq.indptr[i]:Dsq.indptr[i+1]] = np.sqrt(num/den) * np.exp(-Dsq.data[Dsq.indptr[i]: Dsq.indptr[i+1]] / den)
-            W = W.tolil()
-            for i, row in enumerate(indices):
-                for j in row:
-                    if i not in set(indices[j]):
-                        W[j, i] = W[i, j]
+            # gather the kernel widths of both end points of each edge
+            rows = np.repeat(np.arange(Dsq.shape[0]), np.diff(Dsq.indptr))
+            cols = Dsq.indices
+            num = 2 * sigmas[rows] * sigmas[cols]
+            den = sigmas_sq[rows] + sigmas_sq[cols]
+            W = sp.sparse.csr_matrix((np.sqrt(num/den) * np.exp(-Dsq.data / den),
+                                      Dsq.indices.copy(), Dsq.indptr.copy()),
+                                     shape=Dsq.shape)
+            # symmetrize: if j is a neighbor of i but not vice versa, set
+            # W[j, i] = W[i, j], that is, add the entries of the transpose
+            # outside of the sparsity pattern of W
+            Pattern = W.copy()
+            Pattern.data[:] = 1
+            WT = W.T.tocsr()
+            W = compact_csr(W + (WT - WT.multiply(Pattern)))
+            W.eliminate_zeros()
             if False:
                 W.setdiag(1)  # set diagonal to one
                 logg.m('... note that now, we set the diagonal of the weight matrix to one!')
-            W = W.tocsr()
         logg.m('... computed W (weight matrix) with "knn" =', self.knn, t=True)
 
         # if sp.sparse.issparse(W): W = W.toarray()
@@ -352,54 +991,44 @@ class DataGraph(object):
         else:
             # q[i] is an estimate for the sampling density at point x_i
             # it's also the degree of the underlying graph
-            if not sp.sparse.issparse(W):
-                q = np.sum(W, axis=0)
-                # raise to power alpha
-                if alpha != 1:
-                    q = q**alpha
-                Den = np.outer(q, q)
-                self.K = W / Den
-            else:
-                q = np.array(np.sum(W, axis=0)).flatten()
-                self.K = W
-                for i in range(len(W.indptr[:-1])):
-                    row = W.indices[W.indptr[i]: W.indptr[i+1]]
-                    num = q[i] * q[row]
-                    W.data[W.indptr[i]: W.indptr[i+1]] = W.data[W.indptr[i]: W.indptr[i+1]] / num
+            q = np.array(np.sum(W, axis=0)).flatten()
+            # raise to power alpha
+            if alpha != 1:
+                q = q**alpha
+            self.q = q
+            Q_inv = sp.sparse.diags(1/q)
+            self.K = compact_csr(Q_inv.dot(W).dot(Q_inv))
         logg.m('... computed K (anisotropic kernel)', t=True)
 
-        if not sp.sparse.issparse(self.K):
-            # now compute the row normalization to build the transition matrix T
-            # and the adjoint Ktilde: both have the same spectrum
-            self.z = np.sum(self.K, axis=0)
-            # the following is the transition matrix
-            self.T = self.K / self.z[:, np.newaxis]
-            # now we need the square root of the density
-            self.sqrtz = np.array(np.sqrt(self.z))
-            # now compute the density-normalized Kernel
-            # it's still symmetric
-            szszT = np.outer(self.sqrtz, self.sqrtz)
-            self.Ktilde = self.K / szszT
-        else:
-            self.z = np.array(np.sum(self.K, axis=0)).flatten()
-            # now we need the square root of the density
-            self.sqrtz = np.array(np.sqrt(self.z))
-            # now compute the density-normalized Kernel
-            # it's still symmetric
-            self.Ktilde = self.K
-            for i in range(len(self.K.indptr[:-1])):
-                row = self.K.indices[self.K.indptr[i]: self.K.indptr[i+1]]
-                num = self.sqrtz[i] * self.sqrtz[row]
-                self.Ktilde.data[self.K.indptr[i]: self.K.indptr[i+1]] = self.K.data[self.K.indptr[i]: self.K.indptr[i+1]] / num
+        # now compute the row normalization, the transition matrix T = K / z
+        # and the adjoint Ktilde have the same spectrum, T is not stored
+        self.z = np.array(np.sum(self.K, axis=0)).flatten()
+        # now we need the square root of the density
+        self.sqrtz = np.array(np.sqrt(self.z))
+        # now compute the density-normalized Kernel
+        # it's still symmetric
+        Sqrtz_inv = sp.sparse.diags(1/self.sqrtz)
+        self.Ktilde = compact_csr(Sqrtz_inv.dot(self.K).dot(Sqrtz_inv))
         logg.m('... computed Ktilde (normalized anistropic kernel)')
 
-    def compute_L_matrix(self):
-        """Graph Laplacian for K.
+    def compute_L_matrix(self, normalized=False):
+        """Graph Laplacian for K as sparse matrix.
+
+        Parameters
+        ----------
+        normalized : bool, optional (default: False)
+            Compute the symmetric normalized Laplacian I - Ktilde instead of
+            diag(z) - K.
         """
-        self.L = np.diag(self.z) - self.K
+        if normalized:
+            L = sp.sparse.identity(self.K.shape[0]) - self.Ktilde
+        else:
+            L = sp.sparse.diags(self.z) - self.K
+        self.L = sp.sparse.csr_matrix(L)
         sett.mt(0, 'compute graph Laplacian')
 
-    def embed(self, matrix=None, n_evals=15, sym=None, sort='decrease'):
+    def embed(self, matrix=None, n_evals=15, sym=None, sort='decrease',
+              solver=None, tol=None, v0=None):
         """Compute eigen decomposition of matrix.
 
         Parameters
@@ -413,6 +1042,14 @@ class DataGraph(object):
             Instead of computing the eigendecomposition of the assymetric
             transition matrix, computed the eigendecomposition of the symmetric
             Ktilde matrix.
+        solver : {'arpack', 'lobpcg', 'randomized'} or None
+            See `eigen_solvers`, defaults to `self.eigen_solver`.
+        tol : float or None
+            Tolerance of the solver, defaults to `self.eigen_tol`. If None,
+            use the default of the solver.
+        v0 : np.ndarray or None
+            Initial guess for the eigenvectors, stored in columns, for
+            instance, from a previous computation.
 
         Writes attributes
         -----------------
@@ -432,20 +1069,30 @@ class DataGraph(object):
         self.rbasisBool = True
         if matrix is None:
             matrix = self.Ktilde
+        if solver is None: solver = self.eigen_solver
+        if tol is None: tol = self.eigen_tol
         # compute the spectrum
         if n_evals == 0:
+            if sp.sparse.issparse(matrix): matrix = matrix.toarray()
             evals, evecs = sp.linalg.eigh(matrix)
+            n_iter = 1
         else:
+            if solver not in eigen_solvers:
+                raise ValueError('`solver` needs to be one of {}.'
+                                 .format(list(eigen_solvers.keys())))
             n_evals = min(matrix.shape[0]-1, n_evals)
-            # ncv = max(2 * n_evals + 1, int(np.sqrt(matrix.shape[0])))
-            ncv = None
-            which = 'LM' if sort == 'decrease' else 'SM'
-            evals, evecs = sp.sparse.linalg.eigsh(matrix, k=n_evals, which=which,
-                                                  ncv=ncv)
+            if v0 is not None and v0.shape[0] != matrix.shape[0]:
+                logg.m('... initial guess for eigenvectors has wrong shape, ignoring it', v=4)
+                v0 = None
+            evals, evecs, n_iter = eigen_solvers[solver](
+                matrix, n_evals, largest=sort == 'decrease', tol=tol, v0=v0)
         if sort == 'decrease':
             evals = evals[::-1]
             evecs = evecs[:, ::-1]
-        logg.m('... computed eigenvalues', t=True)
+        logg.m('... computed eigenvalues using solver', repr(solver),
+               '{}in {} iterations'.format('with warm start ' if v0 is not None else '',
+                                           n_iter),
+               t=True)
         logg.m(evals)
         # assign attributes
         self.evals = evals
@@ -467,65 +1114,31 @@ class DataGraph(object):
                 self.lbasis /= np.linalg.norm(self.lbasis, axis=0, ord=2)
         # init on-the-fly computed distance "matrix"
         self.Dchosen = OnFlySymMatrix(self.get_Ddiff_row,
-                                      shape=self.Dsq.shape)
+                                      shape=(self.X.shape[0], self.X.shape[0]),
+                                      get_rows=self.get_Ddiff_rows)
 
-    def _get_M_row_chunk(self, i_range):
-        M_chunk = np.zeros((len(i_range), self.X.shape[0]), dtype=np.float32)
-        for i_cnt, i in enumerate(i_range):
-            if False:  # not much slower, but slower
-                M_chunk[i_cnt] = self.get_M_row(j)
-            else:
-                M_chunk[i_cnt] = utils_cy.get_M_row(i, self.evals, self.rbasis, self.lbasis)
-        return M_chunk
+    def _get_M_factors(self):
+        # M = A L^T with the weighted right and the left eigenbasis
+        weights = np.r_[1, self.evals[1:] / (1 - self.evals[1:])]
+        A = np.asarray(self.rbasis, dtype=np.float64) * weights
+        L = np.asarray(self.lbasis, dtype=np.float64)
+        return A, L
 
     def compute_M_matrix(self):
         """The M matrix is the matrix that results from summing over all powers of
         T in the subspace without the first eigenspace.
 
         See Haghverdi et al. (2016).
+
+        M is computed in blocks of rows using `n_jobs` threads. If it does
+        not fit into half of `sett.max_memory`, it is stored in a
+        memory-mapped file.
         """
-        if self.n_jobs >= 4:  # if we have enough cores, skip this step
-            return            # TODO: make sure that this is really the best strategy
-        logg.m('... try computing "M" matrix using up to 90% of `sett.max_memory`')
-        if True:  # Python version
-            self.M = sum([self.evals[l]/(1-self.evals[l])
-                          * np.outer(self.rbasis[:, l], self.lbasis[:, l])
-                          for l in range(1, self.evals.size)])
-            self.M += np.outer(self.rbasis[:, 0], self.lbasis[:, 0])
-        else:  # Cython version
-            used_memory, _ = logg.get_memory_usage()
-            memory_for_M = self.X.shape[0]**2 * 23 / 8 / 1e9  # in GB
-            logg.m('... max memory =', sett.max_memory,
-                   ' / used memory = {:.1f}'.format(used_memory),
-                   ' / memory_for_M = {:.1f}'.format(memory_for_M))
-            if used_memory + memory_for_M < 0.9 * sett.max_memory:
-                logg.m(0, '    allocate memory and compute M matrix')
-                len_chunk = np.ceil(self.X.shape[0] / self.n_jobs).astype(int)
-                n_chunks = np.ceil(self.X.shape[0] / len_chunk).astype(int)
-                chunks = [np.arange(start, min(start + len_chunk, self.X.shape[0]))
-                         for start in range(0, n_chunks * len_chunk, len_chunk)]
-                # parallel computing does not seem to help
-                if False:  # self.n_jobs > 1:
-                    # here backend threading is not necessary, and seems to slow
-                    # down everything considerably
-                    result_lst = Parallel(n_jobs=self.n_jobs, backend='threading')(
-                        delayed(self._get_M_row_chunk)(chunk)
-                        for chunk in chunks)
-                self.M = np.zeros((self.X.shape[0], self.X.shape[0]),
-                                  dtype=np.float32)
-                for i_chunk, chunk in enumerate(chunks):
-                    if False:  # self.n_jobs > 1:
-                        M_chunk = result_lst[i_chunk]
-                    else:
-                        M_chunk = self._get_M_row_chunk(chunk)
-                    self.M[chunk] = M_chunk
-                # the following did not work
-                # filename = sett.writedir + 'tmp.npy'
-                # np.save(filename, self.M)
-                # self.M = filename
-                sett.mt(0, 'finished computation of M')
-            else:
-                logg.m('not enough memory to compute M, using "on-the-fly" computation')
+        n = self.X.shape[0]
+        A, L = self._get_M_factors()
+        self.M = _allocate_matrix((n, n), 'M')
+        _fill_blockwise(self.M, lambda rows: A[rows].dot(L.T), self.n_jobs)
+        logg.m('... computed M matrix', t=True)
 
     def compute_Ddiff_matrix(self):
         """Returns the distance matrix in the Diffusion Pseudotime metric.
@@ -534,45 +1147,124 @@ class DataGraph(object):
 
         Notes
         -----
-        - Is based on M matrix.
+        - Is the Euclidian distance matrix of the rows of M = A L^T, which is
+          computed in blocks of rows from the factors via
+          |M_i - M_j|^2 = (A_i - A_j) L^T L (A_i - A_j)^T, that is, without
+          computing M itself, in O(n^2 n_evals) instead of O(n^3).
+        - Is stored in a memory-mapped file if it does not fit into half of
+          `sett.max_memory`.
         - self.Ddiff[self.iroot,:] stores diffusion pseudotime as a vector.
         """
-        if self.M.shape[0] > 1000 and self.n_pcs_post == 0:
-            logg.m('--> high number of dimensions for computing DPT distance matrix\n'
-                   '    by setting n_pcs_post > 0 you can speed up the computation')
-        if self.n_pcs_post > 0 and self.M.shape[0] > self.n_pcs_post:
-            from ..preprocessing import pca
-            self.M = pca(self.M, n_comps=self.n_pcs_post, mute=True)
-        self.Ddiff = sp.spatial.distance.squareform(sp.spatial.distance.pdist(self.M))
+        n = self.X.shape[0]
+        A, L = self._get_M_factors()
+        B = A.dot(L.T.dot(L))
+        sqnorms = np.einsum('ij,ij->i', A, B)
+
+        def get_rows(rows):
+            Dsq = np.dot(-2 * B[rows], A.T)
+            Dsq += sqnorms[rows, None]
+            Dsq += sqnorms[None, :]
+            np.maximum(Dsq, 0, out=Dsq)
+            Dsq[np.arange(Dsq.shape[0]), np.arange(n)[rows]] = 0
+            return np.sqrt(Dsq, out=Dsq)
+        self.Ddiff = _allocate_matrix((n, n), 'Ddiff')
+        _fill_blockwise(self.Ddiff, get_rows, self.n_jobs)
         logg.m('computed Ddiff distance matrix', t=True)
         self.Dchosen = self.Ddiff
 
-    def _get_Ddiff_row_chunk(self, m_i, j_range):
-        M = self.M  # caching with a file on disk did not work
-        d_i = np.zeros(len(j_range))
-        for j_cnt, j in enumerate(j_range):
-            if False:  # not much slower, but slower
-                m_j = self.get_M_row(j)
-                d_i[j_cnt] = sp.spatial.distance.cdist(m_i[None, :], m_j[None, :])
-            else:
-                if M is None:
-                    m_j = utils_cy.get_M_row(j, self.evals, self.rbasis, self.lbasis)
-                else:
-                    m_j = M[j]
-                d_i[j_cnt] = utils_cy.c_dist(m_i, m_j)
-        return d_i
-
     def get_Ddiff_row(self, i, DC_start=0, DC_end=-1):
+        return self.get_Ddiff_rows([i], DC_start=DC_start, DC_end=DC_end)[0]
+
+    def get_Ddiff_rows(self, indices, DC_start=0, DC_end=-1):
+        """Rows of the DPT distance matrix for a batch of data points.
+
+        The DPT distance is the Euclidian distance in the basis of
+        eigenvectors weighted with evals / (1 - evals), hence, the rows are
+        computed via a single matrix product.
+
+        Parameters
+        ----------
+        indices : array-like
+            Indices of the rows.
+        DC_start, DC_end : int
+            Range of diffusion components, DC_end == -1 uses all.
+
+        Returns
+        -------
+        Array of shape len(indices) x n_samples.
+        """
         if not self.sym:
             raise ValueError('The computation needs to be adjusted if sym=False.')
         if DC_end == -1:
             DC_end = self.evals.size
-        row = sum([(self.evals[l]/(1-self.evals[l])
-                     * (self.rbasis[i, l] - self.lbasis[:, l]))**2
-                    for l in range(max(DC_start, 1), DC_end)])
-        if DC_start == 0:
-            row += (self.rbasis[i, 0] - self.lbasis[:, 0])**2
-        return np.sqrt(row)
+        indices = np.asarray(indices, dtype=int)
+        comps, weights, lcoords, lsqnorms = self._get_Ddiff_coords(DC_start, DC_end)
+        rcoords = self.rbasis[indices][:, comps] * weights
+        Dsq = np.dot(-2 * rcoords, lcoords.T)
+        Dsq += np.einsum('ij,ij->i', rcoords, rcoords)[:, None]
+        Dsq += lsqnorms[None, :]
+        np.maximum(Dsq, 0, out=Dsq)
+        Dsq[np.arange(indices.size), indices] = 0
+        dtype = np.result_type(self.evals.dtype, self.rbasis.dtype)
+        return np.sqrt(Dsq, out=Dsq).astype(dtype, copy=False)
+
+    def get_Ddiff_extreme(self, i, subset, farthest=False):
+        """Nearest (farthest) point to i among subset in the DPT distance.
+
+        The query is answered by the `BoxTree` of subset, see
+        `get_Ddiff_tree`. For farthest points, i can be a list of indices,
+        then, the sum of distances to these points is maximized.
+
+        Returns
+        -------
+        Position within subset and distance.
+        """
+        tree = self.get_Ddiff_tree(subset)
+        lcoords = self._get_Ddiff_coords(0, self.evals.size)[2]
+        if farthest:
+            return tree.farthest(lcoords[np.ravel(i)])
+        return tree.nearest(lcoords[i])
+
+    def get_Ddiff_tree(self, subset):
+        """`BoxTree` of the points in subset in the weighted eigenbasis.
+
+        The DPT distance is the Euclidian distance in these coordinates. The
+        trees of the last `n_Ddiff_trees` subsets are kept, as segments are
+        queried repeatedly during branch detection.
+        """
+        lcoords = self._get_Ddiff_coords(0, self.evals.size)[2]
+        subset = np.asarray(subset)
+        key = hash(subset.tobytes()), subset.size
+        with _Ddiff_trees_lock:
+            cached = getattr(self, '_Ddiff_trees', None)
+            # the trees are dropped once the coordinates change
+            if cached is None or cached[0] is not lcoords:
+                self._Ddiff_trees = cached = lcoords, OrderedDict()
+            trees = cached[1]
+            if key in trees:
+                trees.move_to_end(key)
+                return trees[key]
+        tree = BoxTree(lcoords[subset])
+        with _Ddiff_trees_lock:
+            trees[key] = tree
+            while len(trees) > n_Ddiff_trees: trees.popitem(last=False)
+        return tree
+
+    def _get_Ddiff_coords(self, DC_start, DC_end):
+        # the weighted left basis is reused as long as the basis does not change
+        key = (self.evals, self.lbasis, DC_start, DC_end)
+        cached = getattr(self, '_Ddiff_coords', None)
+        if cached is None or any(a is not b for a, b in zip(cached[0], key)):
+            comps = np.arange(max(DC_start, 1), DC_end)
+            weights = self.evals[comps] / (1 - self.evals[comps])
+            if DC_start == 0:
+                comps = np.r_[0, comps]
+                weights = np.r_[1, weights]
+            weights = weights.astype(np.float64)
+            lcoords = self.lbasis[:, comps] * weights
+            lsqnorms = np.einsum('ij,ij->i', lcoords, lcoords)
+            self._Ddiff_coords = key, (comps, weights, lcoords, lsqnorms)
+        return self._Ddiff_coords[1]
 
     def get_Ddiff_row_deprecated(self, i):
         if self.M is None:
@@ -586,13 +1278,25 @@ class DataGraph(object):
         if self.n_jobs >= 4:  # problems with high memory calculations, we skip computing M above
             # here backend threading is not necessary, and seems to slow
             # down everything considerably
-            result_lst = Parallel(n_jobs=self.n_jobs)(
-                delayed(self._get_Ddiff_row_chunk)(m_i, chunk)
-                for chunk in chunks)
+            # the arrays are published once and then passed by reference to
+            # all chunks
+            names = ['Ddiff_evals', 'Ddiff_rbasis', 'Ddiff_lbasis', 'Ddiff_M']
+            evals = parallel.share(self.evals, 'Ddiff_evals')
+            rbasis = parallel.share(self.rbasis, 'Ddiff_rbasis')
+            lbasis = parallel.share(self.lbasis, 'Ddiff_lbasis')
+            M = None if self.M is None else parallel.share(self.M, 'Ddiff_M')
+            try:
+                result_lst = parallel.run(_get_Ddiff_row_chunk,
+                                          [(m_i, chunk, evals, rbasis, lbasis, M)
+                                           for chunk in chunks],
+                                          n_jobs=self.n_jobs)
+            finally:
+                for name in names: parallel.release(name)
         d_i = np.zeros(self.X.shape[0])
         for i_chunk, chunk in enumerate(chunks):
             if self.n_jobs >= 4: d_i_chunk = result_lst[i_chunk]
-            else: d_i_chunk = self._get_Ddiff_row_chunk(m_i, chunk)
+            else: d_i_chunk = _get_Ddiff_row_chunk(m_i, chunk, self.evals,
+                                                   self.rbasis, self.lbasis, self.M)
             d_i[chunk] = d_i_chunk
         return d_i
 
@@ -600,34 +1304,83 @@ class DataGraph(object):
         """See Fouss et al. (2006) and von Luxburg et al. (2007).
 
         See Proposition 6 in von Luxburg (2007) and the inline equations
-        right in the text above.
+        right in the text above. Is computed in blocks of rows as a product
+        of the truncated eigenbasis.
         """
-        self.Lp = sum([1/self.evals[i]
-                      * np.outer(self.rbasis[:, i], self.lbasis[:, i])
-                      for i in range(1, self.evals.size)])
+        n = self.X.shape[0]
+        comps, weights, lcoords, _ = self._get_Lp_coords(0, -1)
+        rcoords = self.rbasis[:, comps] * weights
+        self.Lp = _allocate_matrix((n, n), 'Lp', dtype=np.float64)
+        _fill_blockwise(self.Lp, lambda rows: rcoords[rows].dot(lcoords.T), self.n_jobs)
         sett.mt(0, 'computed pseudoinverse of Laplacian')
 
-    def compute_C_matrix(self):
+    def compute_C_matrix(self, on_the_fly=False):
         """See Fouss et al. (2006) and von Luxburg et al. (2007).
 
         This is the commute-time matrix. It's a squared-euclidian distance
         matrix in \mathbb{R}^n.
+
+        Parameters
+        ----------
+        on_the_fly : bool, optional (default: False)
+            Instead of the n x n matrix, store an `OnFlySymMatrix` that
+            computes rows via `get_C_rows` when they are accessed.
         """
-        self.C = np.repeat(np.diag(self.Lp)[:, np.newaxis],
-                           self.Lp.shape[0], axis=1)
-        self.C += np.repeat(np.diag(self.Lp)[np.newaxis, :],
-                            self.Lp.shape[0], axis=0)
-        self.C -= 2*self.Lp
-        # the following is much slower
-        # self.C = np.zeros(self.Lp.shape)
-        # for i in range(self.Lp.shape[0]):
-        #     for j in range(self.Lp.shape[1]):
-        #         self.C[i, j] = self.Lp[i, i] + self.Lp[j, j] - 2*self.Lp[i, j]
-        volG = np.sum(self.z)
-        self.C *= volG
+        n = self.X.shape[0]
+        if on_the_fly:
+            self.C = OnFlySymMatrix(self.get_C_row, shape=(n, n),
+                                    get_rows=self.get_C_rows)
+        else:
+            self.C = _allocate_matrix((n, n), 'C', dtype=np.float64)
+            _fill_blockwise(self.C, self.get_C_rows, self.n_jobs)
         sett.mt(0, 'computed commute distance matrix')
         self.Dchosen = self.C
 
+    def get_C_row(self, i, DC_start=0, DC_end=-1):
+        return self.get_C_rows([i], DC_start=DC_start, DC_end=DC_end)[0]
+
+    def get_C_rows(self, indices, DC_start=0, DC_end=-1):
+        """Rows of the commute-time matrix for a batch of data points.
+
+        C[i, j] = vol(G) (Lp[i, i] + Lp[j, j] - 2 Lp[i, j]), where the diagonal
+        of Lp is precomputed and the rows of Lp are a single matrix product
+        in the truncated eigenbasis.
+
+        Parameters
+        ----------
+        indices : array-like or slice
+            Indices of the rows.
+        DC_start, DC_end : int
+            Range of eigenvectors of the Laplacian, DC_end == -1 uses all.
+
+        Returns
+        -------
+        Array of shape len(indices) x n_samples.
+        """
+        comps, weights, lcoords, diag = self._get_Lp_coords(DC_start, DC_end)
+        indices = np.arange(self.rbasis.shape[0])[indices]
+        rcoords = self.rbasis[indices][:, comps] * weights
+        C = np.dot(-2 * rcoords, lcoords.T)
+        C += diag[indices, None]
+        C += diag[None, :]
+        np.maximum(C, 0, out=C)
+        C[np.arange(indices.size), indices] = 0
+        C *= np.sum(self.z)
+        return C
+
+    def _get_Lp_coords(self, DC_start, DC_end):
+        # Lp = (rbasis * weights) lbasis^T, skipping the zero eigenvalue
+        key = (self.evals, self.rbasis, self.lbasis, DC_start, DC_end)
+        cached = getattr(self, '_Lp_coords', None)
+        if cached is None or any(a is not b for a, b in zip(cached[0], key)):
+            comps = np.arange(max(DC_start, 1),
+                              self.evals.size if DC_end == -1 else DC_end)
+            weights = 1 / self.evals[comps].astype(np.float64)
+            lcoords = self.lbasis[:, comps].astype(np.float64)
+            diag = np.einsum('ij,ij->i', self.rbasis[:, comps] * weights, lcoords)
+            self._Lp_coords = key, (comps, weights, lcoords, diag)
+        return self._Lp_coords[1]
+
     def compute_MFP_matrix(self):
         """See Fouss et al. (2006).
 
@@ -637,22 +1390,161 @@ class DataGraph(object):
         corresponds to the standard notation for transition matrices (left index
         initial state, right index final state, i.e. a right-stochastic
         matrix, with each row summing to one).
+
+        Summing over j in Fouss et al. (2006) yields
+        Mfp[i, k] = u[i] - u[k] + vol(G) (Lp[k, k] - Lp[i, k]) with u = Lp z,
+        which is computed in blocks of rows in O(n^2 n_evals).
         """
-        self.MFP = np.zeros(self.Lp.shape)
-        for i in range(self.Lp.shape[0]):
-            for k in range(self.Lp.shape[1]):
-                for j in range(self.Lp.shape[1]):
-                    self.MFP[i, k] += (self.Lp[i, j] - self.Lp[i, k]
-                                       - self.Lp[k, j] + self.Lp[k, k]) * self.z[j]
+        n = self.X.shape[0]
+        comps, weights, lcoords, diag = self._get_Lp_coords(0, -1)
+        rcoords = self.rbasis[:, comps] * weights
+        volG = np.sum(self.z)
+        u = rcoords.dot(lcoords.T.dot(self.z))
+
+        def get_rows(rows):
+            MFP = np.dot(-volG * rcoords[rows], lcoords.T)
+            MFP += u[rows, None]
+            MFP += volG * diag[None, :] - u[None, :]
+            return MFP
+        self.MFP = _allocate_matrix((n, n), 'MFP', dtype=np.float64)
+        _fill_blockwise(self.MFP, get_rows, self.n_jobs)
         sett.mt(0, 'computed mean first passage time matrix')
         self.Dchosen = self.MFP
 
+    def transform(self, X_new):
+        """Embed new data points into the diffusion map.
+
+        Nyström extension: the kernel is extended to the new data points
+        using their nearest neighbors among the data points of the graph,
+        the same kernel width heuristic and the density normalization of the
+        graph, and then projected on the eigenbasis. Neither the graph nor
+        the eigenbasis change, hence, the cost is linear in the number of new
+        data points. If `self.knn`, the neighbors are queried from an index
+        of the data points of the graph that is built on the first call.
+
+        Parameters
+        ----------
+        X_new : np.ndarray
+            New data points in the representation of `self.X`.
+
+        Returns
+        -------
+        Array of shape n_new x n_evals, the rows of `rbasis` for the new
+        data points.
+        """
+        if self.flavor == 'unweighted':
+            raise ValueError('`transform` is not available for `flavor="unweighted"`.')
+        if self.evals is None:
+            raise ValueError('Compute the diffusion map before calling `transform`.')
+        if getattr(self, 'sigmas', None) is None:
+            self.compute_transition_matrix()
+        n_samples = self.X.shape[0]
+        n_neighbors = min(self.k - 1, n_samples)
+        if self.knn:
+            index = self.get_neighbors_index()
+            len_chunk = X_new.shape[0]
+        else:
+            # a few dense arrays of shape len_chunk x n_samples,
+            # use at most a tenth of max_memory
+            len_chunk = int(0.1 * sett.max_memory * 2**30 / (4 * 8 * n_samples))
+            len_chunk = min(max(len_chunk, 1), X_new.shape[0])
+        rbasis_new = np.zeros((X_new.shape[0], self.evals.size), dtype=self.rbasis.dtype)
+        for start in range(0, X_new.shape[0], len_chunk):
+            chunk = slice(start, start + len_chunk)
+            if self.knn:
+                distances, indices = index.kneighbors(X_new[chunk], n_neighbors)
+                distances_sq = distances**2
+            else:
+                distances_sq = utils.comp_sqeuclidean_distance_using_matrix_mult(
+                    X_new[chunk], self.X)
+                indices = np.broadcast_to(np.arange(n_samples), distances_sq.shape)
+            # the same heuristics as in compute_transition_matrix
+            if self.knn:
+                sigmas_sq = np.median(distances_sq, axis=1)
+            else:
+                sigmas_sq = np.max(np.partition(distances_sq, n_neighbors - 1, axis=1)
+                                   [:, :n_neighbors], axis=1) / 4
+            sigmas = np.sqrt(sigmas_sq)
+            den = sigmas_sq[:, None] + self.sigmas[indices]**2
+            W = np.sqrt(2 * sigmas[:, None] * self.sigmas[indices] / den)
+            W *= np.exp(-distances_sq / den)
+            if not self.knn: W[W <= 1e-14] = 0
+            W = sp.sparse.csr_matrix((W.ravel(), indices.ravel(),
+                                      np.arange(0, W.size + 1, W.shape[1])),
+                                     shape=(W.shape[0], n_samples))
+            W.eliminate_zeros()
+            # density normalization and symmetric row normalization
+            if self.q is None:
+                K = W
+            else:
+                q = np.array(np.sum(W, axis=1)).flatten()**self.alpha
+                K = sp.sparse.diags(1/q).dot(W).dot(sp.sparse.diags(1/self.q))
+            z = np.array(np.sum(K, axis=1)).flatten()
+            Ktilde = sp.sparse.diags(1/np.sqrt(z)).dot(K).dot(sp.sparse.diags(1/self.sqrtz))
+            # the eigenvector equation, evaluated at the new data points
+            rbasis_new[chunk] = Ktilde.dot(self.rbasis) / self.evals
+        return rbasis_new
+
+    def get_neighbors_index(self):
+        """Index of the data points of the graph for neighbor queries.
+
+        Built once and cached, uses `sklearn.neighbors.NearestNeighbors` with
+        brute force search for `neighbors_method='brute'` and a tree
+        otherwise. Queries are exact also for approximate neighbor methods.
+        """
+        index = getattr(self, '_neighbors_index', None)
+        if index is None:
+            from sklearn.neighbors import NearestNeighbors
+            method = _resolve_neighbors_method(self.neighbors_method, self.X.shape[0])
+            index = NearestNeighbors(algorithm='brute' if method == 'brute' else 'auto',
+                                     n_jobs=self.n_jobs)
+            index.fit(self.X)
+            self._neighbors_index = index
+        return index
+
+    def get_Ddiff_transformed(self, i, rbasis_new):
+        """DPT distances between data point i and transformed data points.
+
+        Parameters
+        ----------
+        i : int
+            Index of a data point of the graph.
+        rbasis_new : np.ndarray
+            Rows of the eigenbasis of new data points as returned by
+            `transform`.
+        """
+        comps, weights, _, _ = self._get_Ddiff_coords(0, self.evals.size)
+        diff = (rbasis_new[:, comps] - self.rbasis[i, comps]) * weights
+        return np.sqrt(np.einsum('ij,ij->i', diff, diff))
+
     def set_pseudotime(self):
         """Return pseudotime with respect to root point.
         """
         self.pseudotime = self.Dchosen[self.iroot].copy()
         self.pseudotime /= np.max(self.pseudotime)
 
+    def get_pseudotime_multi(self, iroots):
+        """Return pseudotime with respect to several root points.
+
+        The rows of the distance matrix for all roots are computed with
+        batched products in the diffusion basis, in batches that respect a
+        tenth of `sett.max_memory`.
+
+        Returns
+        -------
+        Array of shape n_samples x len(iroots), each column normalized to a
+        maximum of 1.
+        """
+        iroots = np.asarray(iroots, dtype=int)
+        n_samples = self.rbasis.shape[0]
+        pseudotime = np.zeros((n_samples, iroots.size), dtype=np.float32)
+        batch_size = max(int(0.1 * sett.max_memory * 2**30 / (8 * n_samples)), 1)
+        for start in range(0, iroots.size, batch_size):
+            rows = self.get_Ddiff_rows(iroots[start:start+batch_size])
+            rows /= np.max(rows, axis=1)[:, None]
+            pseudotime[:, start:start+batch_size] = rows.T
+        return pseudotime
+
     def set_root(self, xroot):
         """Determine the index of the root cell.
 
@@ -669,18 +1561,9 @@ class DataGraph(object):
             raise ValueError('The root vector you provided does not have the '
                              'correct dimension. Make sure you provide the dimension-'
                              'reduced version, if you provided X_pca.')
-        # this is the squared distance
-        dsqroot = 1e10
-        self.iroot = 0
-        for i in range(self.X.shape[0]):
-            diff = self.X[i, :]-xroot
-            dsq = diff.dot(diff)
-            if dsq < dsqroot:
-                dsqroot = dsq
-                self.iroot = i
-                if np.sqrt(dsqroot) < 1e-10:
-                    sett.m(2, 'root found at machine prec')
-                    break
+        self.iroot = get_closest_row(self.X, np.ravel(xroot))
+        if self.adata is not None:
+            self.adata.add['iroot'] = self.iroot
         logg.m('... set iroot', self.iroot)
         return self.iroot
 
@@ -692,9 +1575,9 @@ class DataGraph(object):
         # pl.show()
         if sett.verbosity > 2:
             # output of spectrum of K for comparison
-            w, v = np.linalg.eigh(self.K)
+            w, v = np.linalg.eigh(self.K.toarray())
             sett.mi('spectrum of K (kernel)')
         if sett.verbosity > 3:
             # direct computation of spectrum of T
-            w, vl, vr = sp.linalg.eig(self.T,left=True)
+            w, vl, vr = sp.linalg.eig(self.K.toarray() / self.z[:, np.newaxis], left=True)
             sett.mi('spectrum of transition matrix (should be same as of Ktilde)')
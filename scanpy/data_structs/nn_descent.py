@@ -0,0 +1,269 @@
+# Author: F. Alex Wolf (http://falexwolf.de)
+"""Approximate Nearest Neighbors
+
+Nearest neighbor descent (Dong et al., 2011), initialized with a forest of
+random projection trees (Dasgupta & Freund, 2008).
+
+All computations are vectorized over blocks of data points. Blocks are
+processed by threads that write to disjoint rows of the neighbor lists, hence,
+the result does not depend on the number of threads.
+"""
+
+import numpy as np
+from .. import settings as sett
+from .. import logging as logg
+from .. import parallel
+
+
+def nn_descent(X, n_neighbors, n_trees=None, leaf_size=None, n_iters=10,
+               rho=0.5, delta=0.001, n_jobs=None, random_state=0):
+    """Approximate nearest neighbors in squared Euclidean distance.
+
+    Parameters
+    ----------
+    X : np.ndarray
+        Data matrix of shape n_samples x n_variables.
+    n_neighbors : int
+        Number of neighbors of each data point, not counting the point itself.
+    n_trees : int or None, optional (default: None)
+        Number of random projection trees for initialization. More trees
+        increase recall and runtime. Defaults to a value between 2 and 8 that
+        grows with the number of samples.
+    leaf_size : int or None, optional (default: None)
+        Maximal number of points in a leaf of a tree. Defaults to `max(10,
+        n_neighbors + 1)`.
+    n_iters : int, optional (default: 10)
+        Maximal number of descent iterations.
+    rho : float, optional (default: 0.5)
+        Fraction of the neighbors that is sampled for the local join in each
+        iteration. Higher values increase recall and runtime.
+    delta : float, optional (default: 0.001)
+        Stop if less than a fraction `delta` of all neighbors is updated within
+        an iteration.
+    n_jobs : int or None, optional (default: None)
+        Number of threads, defaults to sett.n_jobs.
+    random_state : int, optional (default: 0)
+        Seed for the random number generator.
+
+    Returns
+    -------
+    indices : np.ndarray
+        Array of shape n_samples x n_neighbors, sorted by distance.
+    distances : np.ndarray
+        Squared Euclidean distances, same shape as indices, of dtype float32.
+    """
+    n_jobs = sett.n_jobs if n_jobs is None else n_jobs
+    X = np.asarray(X)
+    if X.dtype.kind != 'f': X = X.astype(np.float32)
+    n_samples = X.shape[0]
+    if n_neighbors >= n_samples:
+        raise ValueError('`n_neighbors` needs to be smaller than the number of samples.')
+    if n_trees is None:
+        n_trees = min(8, 2 + int(round(n_samples**0.25 / 4)))
+    if leaf_size is None:
+        leaf_size = max(10, n_neighbors + 1)
+    n_samples_join = max(1, int(round(rho * n_neighbors)))
+    norms_sq = np.einsum('ij,ij->i', X, X)
+    indices = np.full((n_samples, n_neighbors), -1, dtype=np.int64)
+    distances = np.full((n_samples, n_neighbors), np.inf, dtype=np.float32)
+    # whether a neighbor has not yet been used in a local join
+    is_new = np.ones((n_samples, n_neighbors), dtype=bool)
+    # as memory usage is dominated by gathering candidate points, restrict
+    # blocks to about 64 MB of candidate coordinates
+    n_candidates = max(leaf_size, (3 * n_samples_join + n_neighbors) * n_neighbors)
+    len_block = int(max(1, min(4096, 2**24 // (n_candidates * max(1, X.shape[1])))))
+    # initialize with a forest of random projection trees
+    for i_tree in range(n_trees):
+        leaves = _rp_tree_leaves(X, leaf_size, np.random.RandomState(random_state + i_tree))
+        len_block_leaves = max(1, len_block * n_candidates // (leaves.shape[1]**2))
+        parallel.run(_join_leaves,
+                     [(leaves[start:start+len_block_leaves], X, norms_sq,
+                       indices, distances, is_new)
+                      for start in range(0, leaves.shape[0], len_block_leaves)],
+                     n_jobs=n_jobs, backend='threading')
+    logg.m('... initialized neighbors with', n_trees, 'random projection trees', v=4)
+    # nearest neighbor descent, the candidates are computed from a copy of
+    # the neighbor lists at the start of each iteration
+    for i_iter in range(n_iters):
+        random_state_iter = np.random.RandomState(random_state + n_trees + i_iter)
+        indices_old = indices.copy()
+        is_new_old = is_new.copy()
+        reverse_new = _sample_reverse(indices_old, is_new_old, n_samples_join, random_state_iter)
+        reverse_old = _sample_reverse(indices_old, ~is_new_old, n_samples_join, random_state_iter)
+        seeds = random_state_iter.randint(np.iinfo(np.int32).max,
+                                          size=int(np.ceil(n_samples / len_block)))
+        n_updates = parallel.run(
+            _join_neighbors,
+            [(np.arange(start, min(start + len_block, n_samples)), X, norms_sq,
+              indices_old, is_new_old, reverse_new, reverse_old,
+              indices, distances, is_new, n_samples_join, seed)
+             for start, seed in zip(range(0, n_samples, len_block), seeds)],
+            n_jobs=n_jobs, backend='threading')
+        n_updates = sum(n_updates)
+        logg.m('... iteration', i_iter + 1, 'updated', n_updates, 'neighbors', v=4)
+        if n_updates < delta * n_samples * n_neighbors:
+            break
+    # points that could not be joined with enough others, which is rare,
+    # are searched exhaustively
+    rows = np.flatnonzero(np.any(indices < 0, axis=1))
+    len_block = max(1, 2**24 // (n_samples * max(1, X.shape[1])))
+    for start in range(0, rows.size, len_block):
+        rows_block = rows[start:start+len_block]
+        _update(rows_block, np.tile(np.arange(n_samples), (rows_block.size, 1)),
+                X, norms_sq, indices, distances, is_new)
+    # sort neighbors by distance
+    order = np.argsort(distances, axis=1)
+    sample_range = np.arange(n_samples)[:, None]
+    return indices[sample_range, order], distances[sample_range, order]
+
+
+def _rp_tree_leaves(X, leaf_size, random_state):
+    """Leaves of a random projection tree.
+
+    The tree is grown level by level, splitting all nodes of a level at once
+    by the hyperplane that separates two randomly chosen points.
+
+    Returns
+    -------
+    leaves : np.ndarray
+        Array of shape n_leaves x max_leaf_size storing point indices, padded
+        with -1.
+    """
+    n_samples = X.shape[0]
+    labels = np.zeros(n_samples, dtype=np.int64)
+    while True:
+        sizes = np.bincount(labels)
+        split = sizes > leaf_size
+        if not split.any(): break
+        idx = np.flatnonzero(split[labels])
+        idx = idx[np.argsort(labels[idx], kind='mergesort')]
+        _, starts, counts = np.unique(labels[idx], return_index=True, return_counts=True)
+        a = idx[starts + (random_state.rand(counts.size) * counts).astype(int)]
+        b = idx[starts + (random_state.rand(counts.size) * counts).astype(int)]
+        normals = X[a] - X[b]
+        offsets = np.einsum('ij,ij->i', normals, (X[a] + X[b]) / 2)
+        nodes = np.repeat(np.arange(counts.size), counts)
+        side = np.empty(idx.size, dtype=bool)
+        for start in range(0, idx.size, 100000):
+            chunk = slice(start, start + 100000)
+            side[chunk] = (np.einsum('ij,ij->i', X[idx[chunk]], normals[nodes[chunk]])
+                           > offsets[nodes[chunk]])
+        # split degenerate nodes, e.g., of duplicate points, randomly
+        n_right = np.bincount(nodes, side, minlength=counts.size)
+        degenerate = (n_right == 0) | (n_right == counts)
+        if degenerate.any():
+            mask = degenerate[nodes]
+            side[mask] = random_state.rand(mask.sum()) < 0.5
+        labels_new = labels.copy()
+        labels_new[idx] = labels.max() + 1 + 2 * nodes + side
+        labels = np.unique(labels_new, return_inverse=True)[1]
+    # arrange points in the leaves
+    order = np.argsort(labels, kind='mergesort')
+    sizes = np.bincount(labels)
+    starts = np.r_[0, np.cumsum(sizes)[:-1]]
+    leaves = np.full((sizes.size, sizes.max()), -1, dtype=np.int64)
+    positions = np.arange(n_samples) - np.repeat(starts, sizes)
+    leaves[labels[order], positions] = order
+    return leaves
+
+
+def _sample_reverse(indices, mask, n_samples_join, random_state):
+    """Sample reverse neighbors among the entries in mask, padded with -1."""
+    n_samples = indices.shape[0]
+    sources = np.repeat(np.arange(n_samples), indices.shape[1])[mask.ravel()]
+    targets = indices.ravel()[mask.ravel()]
+    valid = targets >= 0
+    sources, targets = sources[valid], targets[valid]
+    # random order within each target
+    order = np.argsort(targets * 2.0 + random_state.rand(targets.size), kind='mergesort')
+    sources, targets = sources[order], targets[order]
+    starts = np.searchsorted(targets, np.arange(n_samples))
+    positions = np.arange(targets.size) - starts[targets]
+    keep = positions < n_samples_join
+    reverse = np.full((n_samples, n_samples_join), -1, dtype=np.int64)
+    reverse[targets[keep], positions[keep]] = sources[keep]
+    return reverse
+
+
+def _join_leaves(leaves, X, norms_sq, indices, distances, is_new):
+    """All pairs within the leaves are candidate neighbors."""
+    mask = leaves >= 0
+    points = leaves[mask]
+    # for each point in a leaf, the candidates are all points of the leaf
+    candidates = np.repeat(leaves, mask.sum(axis=1), axis=0)
+    return _update(points, candidates, X, norms_sq, indices, distances, is_new)
+
+
+def _join_neighbors(rows, X, norms_sq, indices_old, is_new_old, reverse_new, reverse_old,
+                    indices, distances, is_new, n_samples_join, seed):
+    """Local join of the neighbors and reverse neighbors of rows.
+
+    Pairs of a new and any other neighbor of a point are candidates, pairs of
+    old neighbors have already been compared in previous iterations. Here,
+    this is arranged from the perspective of rows: the candidates are all
+    neighbors of the new neighbors of rows and the new neighbors of the old
+    neighbors of rows.
+    """
+    random_state = np.random.RandomState(seed)
+    row_range = np.arange(rows.size)[:, None]
+    # sample new forward neighbors and mark them as old
+    new = is_new_old[rows]
+    keys = random_state.rand(*new.shape) + ~new
+    columns = np.argsort(keys, axis=1)[:, :n_samples_join]
+    sampled = new[row_range, columns]
+    forward_new = np.where(sampled, indices_old[rows][row_range, columns], -1)
+    is_new_rows = is_new[rows]
+    is_new_rows[row_range, columns] &= ~sampled
+    is_new[rows] = is_new_rows
+    forward_old = np.where(new, -1, indices_old[rows])
+    joined_new = np.c_[forward_new, reverse_new[rows]]
+    joined_old = np.c_[forward_old, reverse_old[rows]]
+    candidates_new = np.where((joined_new >= 0)[:, :, None], indices_old[joined_new], -1)
+    candidates_old = np.where((joined_old >= 0)[:, :, None] & is_new_old[joined_old],
+                              indices_old[joined_old], -1)
+    candidates = np.c_[reverse_new[rows],
+                       candidates_new.reshape(rows.size, -1),
+                       candidates_old.reshape(rows.size, -1)]
+    return _update(rows, candidates, X, norms_sq, indices, distances, is_new)
+
+
+def _update(rows, candidates, X, norms_sq, indices, distances, is_new):
+    """Merge candidates into the neighbor lists of rows.
+
+    Returns the number of new neighbors.
+    """
+    n_samples = X.shape[0]
+    n_neighbors = indices.shape[1]
+    row_range = np.arange(rows.size)[:, None]
+    # flatten to pairs (row_id, candidate) encoded as row_id * n_samples +
+    # candidate and remove duplicates as well as current neighbors before
+    # computing any distances
+    valid = (candidates >= 0) & (candidates != rows[:, None])
+    row_ids, columns = np.nonzero(valid)
+    pairs = np.sort(row_ids * n_samples + candidates[row_ids, columns])
+    pairs = pairs[np.r_[True, pairs[1:] != pairs[:-1]]]
+    current = (row_range * n_samples + indices[rows])[indices[rows] >= 0]
+    pairs = pairs[~np.in1d(pairs, current, assume_unique=True)]
+    row_ids, candidates = pairs // n_samples, pairs % n_samples
+    cand_distances = (norms_sq[rows[row_ids]] + norms_sq[candidates]
+                      - 2 * np.einsum('ij,ij->i', X[rows[row_ids]], X[candidates]))
+    cand_distances = np.maximum(cand_distances, 0).astype(np.float32)
+    # only candidates closer than the current farthest neighbor can enter the
+    # neighbor lists
+    closer = cand_distances < distances[rows].max(axis=1)[row_ids]
+    row_ids, candidates, cand_distances = row_ids[closer], candidates[closer], cand_distances[closer]
+    # arrange the remaining candidates in rows, row_ids are sorted
+    counts = np.bincount(row_ids, minlength=rows.size)
+    positions = np.arange(row_ids.size) - np.r_[0, np.cumsum(counts)[:-1]][row_ids]
+    width = max(1, counts.max()) if rows.size > 0 else 1
+    all_indices = np.c_[indices[rows], np.full((rows.size, width), -1, dtype=indices.dtype)]
+    all_distances = np.c_[distances[rows], np.full((rows.size, width), np.inf, dtype=np.float32)]
+    all_indices[row_ids, n_neighbors + positions] = candidates
+    all_distances[row_ids, n_neighbors + positions] = cand_distances
+    chosen = np.argpartition(all_distances, n_neighbors - 1, axis=1)[:, :n_neighbors]
+    inserted = (chosen >= n_neighbors) & np.isfinite(all_distances[row_range, chosen])
+    all_is_new = np.c_[is_new[rows], np.ones((rows.size, width), dtype=bool)]
+    indices[rows] = all_indices[row_range, chosen]
+    distances[rows] = all_distances[row_range, chosen]
+    is_new[rows] = all_is_new[row_range, chosen]
+    return inserted.sum()
@@ -0,0 +1,145 @@
+# Author: F. Alex Wolf (http://falexwolf.de)
+"""Parallel Computing
+
+Persistent pools of workers and arrays shared with the workers.
+
+Arrays are published once as memory-mapped files and are then passed to the
+workers by reference (the filename) instead of being serialized for each call.
+Pools are kept alive between calls, which avoids paying the startup cost of
+worker processes for each parallel section.
+"""
+
+import os
+import atexit
+import shutil
+import tempfile
+import numpy as np
+from joblib import Parallel, delayed, dump, load
+from . import settings as sett
+from . import logging as logg
+
+_pools = {}
+"""Persistent pools, keyed by (n_jobs, backend)."""
+
+_shared = {}
+"""Shared arrays, keyed by name, storing (source array, memmap)."""
+
+_tmpdir = None
+"""Directory that stores the memory-mapped files."""
+
+
+def get_pool(n_jobs=None, backend='loky'):
+    """Get a persistent pool of workers.
+
+    Parameters
+    ----------
+    n_jobs : int or None (default: None)
+        Number of workers, defaults to sett.n_jobs.
+    backend : {'loky', 'multiprocessing', 'threading'}, optional (default: 'loky')
+        Use 'threading' for compiled code that releases the GIL, then, no
+        data needs to be shared via files.
+
+    Returns
+    -------
+    pool : joblib.Parallel
+        Call as `pool(delayed(func)(*args) for args in args_list)`.
+    """
+    n_jobs = sett.n_jobs if n_jobs is None else n_jobs
+    key = (n_jobs, backend)
+    if key not in _pools:
+        # max_nbytes=None: do not dump arrays on each call, instead, the
+        # caller publishes large arrays once via `share`
+        pool = Parallel(n_jobs=n_jobs, backend=backend, max_nbytes=None)
+        pool.__enter__()
+        _pools[key] = pool
+    return _pools[key]
+
+
+def run(func, args_list, n_jobs=None, backend='loky'):
+    """Evaluate `func` for each tuple of arguments in `args_list`.
+
+    The order of the results is the order of `args_list`. For `n_jobs == 1`,
+    everything is computed serially in the current process.
+    """
+    n_jobs = sett.n_jobs if n_jobs is None else n_jobs
+    if n_jobs == 1:
+        return [func(*args) for args in args_list]
+    return get_pool(n_jobs, backend)(delayed(func)(*args) for args in args_list)
+
+
+def share(X, name):
+    """Publish an array to the workers.
+
+    The array is written to a memory-mapped file once. As long as the same
+    array object is published under the same name, the existing file is
+    reused. A reference to the array is kept until `release`, so that its
+    identity cannot be taken over by another array. Modifications of the
+    array in place are not detected: `release` it before sharing it again.
+
+    Parameters
+    ----------
+    X : np.ndarray
+        Array to share.
+    name : str
+        Name under which the array is referenced.
+
+    Returns
+    -------
+    X_shared : np.memmap
+        Read-only memory map that can be passed to `run` at no cost.
+    """
+    if name in _shared and _shared[name][0] is X:
+        return _shared[name][1]
+    release(name)
+    filename = os.path.join(_get_tmpdir(), name + '.mmap')
+    dump(np.asarray(X), filename)
+    _shared[name] = X, load(filename, mmap_mode='r')
+    logg.m('... shared', name, 'with workers', v=4)
+    return _shared[name][1]
+
+
+def memmap(name, shape, dtype=np.float32):
+    """Allocate a writable memory-mapped array.
+
+    The file is stored next to the shared arrays and removed by `release`
+    or at exit. Use it for results that do not fit into memory.
+    """
+    release(name)
+    filename = os.path.join(_get_tmpdir(), name + '.mmap')
+    _shared[name] = None, np.memmap(filename, dtype=dtype, mode='w+', shape=shape)
+    logg.m('... allocated', name, 'as memory-mapped file', filename, v=4)
+    return _shared[name][1]
+
+
+def release(name=None):
+    """Remove a shared array, or all of them if `name` is None."""
+    names = list(_shared.keys()) if name is None else [name]
+    for name in names:
+        if name not in _shared: continue
+        filename = _shared.pop(name)[1].filename
+        try:
+            os.remove(filename)
+        except OSError:  # still mapped on some platforms
+            pass
+
+
+def shutdown():
+    """Terminate all pools and remove all shared arrays."""
+    global _tmpdir
+    for pool in _pools.values():
+        pool.__exit__(None, None, None)
+    _pools.clear()
+    release()
+    if _tmpdir is not None:
+        shutil.rmtree(_tmpdir, ignore_errors=True)
+        _tmpdir = None
+
+
+def _get_tmpdir():
+    global _tmpdir
+    if _tmpdir is None:
+        _tmpdir = tempfile.mkdtemp(prefix='scanpy_')
+    return _tmpdir
+
+
+atexit.register(shutdown)
@@ -6,6 +6,7 @@ Simple functions and whole recipes.
 
 from .simple import *
 from .recipes import *
+from .pipeline import Pipeline
 
 
 def overview():
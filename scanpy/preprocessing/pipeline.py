@@ -0,0 +1,388 @@
+# Author: F. Alex Wolf (http://falexwolf.de)
+"""Preprocessing Pipeline
+
+Plan a sequence of preprocessing steps and execute it in a few chunked passes
+over the data.
+"""
+
+import numpy as np
+import scipy as sp
+from scipy.sparse import issparse
+from . import simple
+from .. import logging as logg
+
+
+class Pipeline(object):
+    """Chunked preprocessing pipeline.
+
+    Steps are recorded and only executed when calling `run`. Elementwise steps
+    (`normalize_per_cell`, `log1p` and `scale`) are not executed right away, but
+    fused into the next pass over the data, which processes the data in blocks
+    of rows. Statistics computed in a pass are reused by all subsequent steps
+    that do not invalidate them.
+
+    Subsetting genes and cells is done by compacting the data matrix inplace,
+    hence, the peak memory stays close to the size of the data matrix.
+
+    Parameters
+    ----------
+    len_chunk : int, optional (default: 10000)
+        Number of rows processed at once.
+
+    Example
+    -------
+    Normalize, logarithmize and scale in two passes over the data.
+
+    >>> pipe = Pipeline().normalize_per_cell().log1p().scale()
+    >>> pipe.run(adata)
+    """
+
+    def __init__(self, len_chunk=10000):
+        self.len_chunk = len_chunk
+        self.steps = []
+        self.filter_result = None
+        self.n_passes = 0
+
+    def filter_genes(self, min_cells=None, min_counts=None):
+        """See `sc.pp.filter_genes`."""
+        if min_cells is not None and min_counts is not None:
+            raise ValueError('Either specify min_counts or min_cells, but not both.')
+        if min_cells is None and min_counts is None:
+            raise ValueError('Provide one of min_counts or min_cells.')
+        self.steps.append(('filter_genes', dict(min_cells=min_cells,
+                                                min_counts=min_counts)))
+        return self
+
+    def normalize_per_cell(self, counts_per_cell_after=None):
+        """See `sc.pp.normalize_per_cell`."""
+        self.steps.append(('normalize_per_cell',
+                           dict(counts_per_cell_after=counts_per_cell_after)))
+        return self
+
+    def filter_genes_dispersion(self, log=True,
+                                min_disp=0.5, max_disp=None,
+                                min_mean=0.0125, max_mean=3,
+                                n_top_genes=None, flavor='seurat'):
+        """See `sc.pp.filter_genes_dispersion`.
+
+        The returned record array is stored as attribute `filter_result`.
+        """
+        self.steps.append(('filter_genes_dispersion',
+                           dict(log=log, min_disp=min_disp, max_disp=max_disp,
+                                min_mean=min_mean, max_mean=max_mean,
+                                n_top_genes=n_top_genes, flavor=flavor)))
+        return self
+
+    def log1p(self):
+        """See `sc.pp.log1p`."""
+        self.steps.append(('log1p', {}))
+        return self
+
+    def scale(self, zero_center=True, max_value=None):
+        """See `sc.pp.scale`."""
+        self.steps.append(('scale', dict(zero_center=zero_center,
+                                         max_value=max_value)))
+        return self
+
+    def run(self, adata, copy=False):
+        """Run the pipeline on `adata`.
+
+        Parameters
+        ----------
+        adata : AnnData
+            Annotated data matrix.
+        copy : bool (default: False)
+            Return a copy if true, otherwise, `adata` is modified inplace.
+        """
+        adata = adata.copy() if copy else adata
+        logg.m('run preprocessing pipeline with steps',
+               [name for name, _ in self.steps], r=True)
+        self._X = adata.X
+        self._orig_rows = np.arange(adata.X.shape[0])
+        self._orig_cols = np.arange(adata.X.shape[1])
+        self._rows = None   # pending subset of rows of self._X
+        self._cols = None   # pending subset of columns of self._X
+        self._ops = []      # pending elementwise operations
+        self._stats = {}    # statistics of the current view of the data
+        self._stats_spec = None
+        self._var_annotation = []
+        self.n_passes = 0
+        for istep, (name, params) in enumerate(self.steps):
+            getattr(self, '_' + name)(istep, **params)
+        if self._ops or self._rows is not None or self._cols is not None:
+            self._pass(materialize=True)
+        # update adata, self._X stores the rows self._orig_rows and the columns
+        # self._orig_cols of the original data matrix
+        var_annotation = []
+        for key, values, cols in self._var_annotation:
+            values_orig = np.zeros(adata.X.shape[1], dtype=values.dtype)
+            values_orig[cols] = values
+            var_annotation.append((key, values_orig[self._orig_cols]))
+        adata.X = self._X
+        adata.smp = adata.smp[self._orig_rows]
+        adata.n_smps = self._X.shape[0]
+        adata.var = adata.var[self._orig_cols]
+        adata.n_vars = self._X.shape[1]
+        for key, values in var_annotation:
+            adata.var[key] = values
+        del self._X
+        logg.m('finished with', self.n_passes, 'passes over the data', t=True)
+        return adata if copy else None
+
+    # --------------------------------------------------------------------------
+    # Execution of steps
+    # --------------------------------------------------------------------------
+
+    def _filter_genes(self, istep, min_cells=None, min_counts=None):
+        stats = self._get_stats(istep)
+        number = stats['n_cells'] if min_counts is None else stats['sum']
+        min_number = min_counts if min_cells is None else min_cells
+        gene_subset = number >= min_number
+        self._annotate_var('n_counts' if min_cells is None else 'n_cells', number)
+        logg.m('... filtered out', np.sum(~gene_subset),
+               'genes that are detected',
+               'in less than ' + str(min_cells) + ' cells' if min_counts is None
+               else 'with less than ' + str(min_counts) + ' counts')
+        self._subset_cols(gene_subset)
+
+    def _normalize_per_cell(self, istep, counts_per_cell_after=None):
+        logg.m('... normalizing by total count per cell')
+        if 'row_sum' not in self._stats: self._pass()
+        counts_per_cell = self._stats['row_sum']
+        rows = self._get_rows()
+        cell_subset = counts_per_cell[rows] >= 1
+        if counts_per_cell_after is None:
+            counts_per_cell_after = np.median(counts_per_cell[rows][cell_subset])
+        factors = np.ones(self._X.shape[0])
+        factors[rows[cell_subset]] = counts_per_cell_after / counts_per_cell[rows][cell_subset]
+        self._ops.append(('rows', factors))
+        stats = {}
+        # normalizing by positive factors does not change which entries are
+        # non-zero or positive
+        for key in ['n_nonzero', 'n_cells']:
+            if key in self._stats: stats[key] = self._stats[key]
+        stats['row_sum'] = np.full(self._X.shape[0], counts_per_cell_after)
+        if self._stats_spec is not None:
+            # statistics that have been computed using factors 1/counts_per_cell
+            stats['sum'] = self._stats_spec['sum'] * counts_per_cell_after
+            stats['sumsq'] = self._stats_spec['sumsq'] * counts_per_cell_after**2
+            self._stats_spec = None
+        if np.sum(~cell_subset) > 0:
+            logg.m('... filtered out', np.sum(~cell_subset),
+                   'cells that have less than 1 counts')
+            # if these cells have no counts at all, they do not contribute to
+            # the statistics of the genes, otherwise, these need to be recomputed
+            if np.any(counts_per_cell[rows][~cell_subset] != 0):
+                stats = {'row_sum': stats['row_sum']}
+            self._rows = rows[cell_subset]
+        stats['n_rows'] = self._get_rows().size
+        self._stats = stats
+
+    def _filter_genes_dispersion(self, istep, **params):
+        self._get_stats(istep)
+        mean, var = self._get_mean_var()
+        logg.m('... filter highly varying genes by dispersion and mean', end=' ')
+        result = simple._filter_genes_dispersion(mean, var, **params)
+        self.filter_result = result
+        self._annotate_var('means', result['means'])
+        self._annotate_var('dispersions', result['dispersions'])
+        self._annotate_var('dispersions_norm', result['dispersions_norm'])
+        self._subset_cols(result['gene_subset'])
+
+    def _log1p(self, istep):
+        self._ops.append(('log1p',))
+        self._stats = {'n_rows': self._stats['n_rows']} if 'n_rows' in self._stats else {}
+        self._stats_spec = None
+
+    def _scale(self, istep, zero_center=True, max_value=None):
+        if zero_center and max_value is not None:
+            logg.m('... scale_data: be very careful to use `max_value` without `zero_center`')
+        if not zero_center:
+            logg.m('... omitting to zero_center the data')
+        if max_value is not None:
+            logg.m('... clipping at max_value', max_value)
+        self._get_stats(istep)
+        mean, var = self._get_mean_var()
+        self._ops.append(('cols', mean if zero_center else None, np.sqrt(var), max_value))
+        self._stats = {}
+        self._stats_spec = None
+
+    # --------------------------------------------------------------------------
+    # Bookkeeping
+    # --------------------------------------------------------------------------
+
+    def _get_rows(self):
+        return np.arange(self._X.shape[0]) if self._rows is None else self._rows
+
+    def _get_cols(self):
+        return np.arange(self._X.shape[1]) if self._cols is None else self._cols
+
+    def _get_stats(self, istep):
+        """Return gene statistics of the current view of the data."""
+        if 'sum' not in self._stats:
+            # if the next step normalizes per cell and the step after requires
+            # statistics of genes, compute them speculatively in the same pass
+            names = [name for name, _ in self.steps[istep+1:istep+3]]
+            speculate = (names[:1] == ['normalize_per_cell'] and len(names) == 2
+                         and names[1] in {'filter_genes', 'filter_genes_dispersion', 'scale'})
+            self._pass(speculate=speculate)
+        return self._stats
+
+    def _get_mean_var(self):
+        n = self._stats['n_rows']
+        mean = self._stats['sum'] / n
+        mean_sq = self._stats['sumsq'] / n
+        # enforce R convention (unbiased estimator) for variance
+        var = (mean_sq - mean**2) * (n/(n-1))
+        return mean, var
+
+    def _subset_cols(self, gene_subset):
+        # if only genes without any non-zero entry are removed, the row sums
+        # and the speculative statistics remain valid
+        only_zeros_removed = ('n_nonzero' in self._stats
+                              and np.all(self._stats['n_nonzero'][~gene_subset] == 0))
+        self._cols = self._get_cols()[gene_subset]
+        stats = {}
+        for key, value in self._stats.items():
+            if key in {'sum', 'sumsq', 'n_nonzero', 'n_cells'}:
+                stats[key] = value[gene_subset]
+            elif key != 'row_sum' or only_zeros_removed:
+                stats[key] = value
+        self._stats = stats
+        if self._stats_spec is not None and only_zeros_removed:
+            self._stats_spec = {key: value[gene_subset]
+                                for key, value in self._stats_spec.items()}
+        else:
+            self._stats_spec = None
+
+    def _annotate_var(self, key, values):
+        self._var_annotation.append((key, np.array(values),
+                                     self._orig_cols[self._get_cols()]))
+
+    # --------------------------------------------------------------------------
+    # Passes over the data
+    # --------------------------------------------------------------------------
+
+    def _pass(self, materialize=None, speculate=False):
+        """Pass over the data in chunks of rows and compute statistics.
+
+        If there are pending operations, these are written to the data matrix,
+        which is compacted inplace if rows or columns are subsetted.
+        """
+        if materialize is None:
+            materialize = (len(self._ops) > 0
+                           or self._rows is not None or self._cols is not None)
+        X = self._X
+        rows, cols = self._get_rows(), self._get_cols()
+        n_cols = cols.size
+        n_rows_max = X.shape[0]
+        densify = any(op[0] == 'cols' and op[1] is not None for op in self._ops)
+        sparse = issparse(X)
+        if materialize:
+            if sparse and not densify:
+                X = X.tocsr()
+                data, indices, indptr = X.data, X.indices, X.indptr
+                if data.dtype.kind != 'f' and self._ops:
+                    data = np.empty(X.nnz, dtype=np.float32)
+                indptr_new = np.zeros(rows.size + 1, dtype=indptr.dtype)
+                pos_nnz = 0
+            elif (not sparse and X.flags['C_CONTIGUOUS'] and X.flags['WRITEABLE']
+                  and X.dtype.kind == 'f'):
+                buffer = X.reshape(-1)
+            else:
+                buffer = np.empty(rows.size * n_cols, dtype=X.dtype if X.dtype.kind == 'f'
+                                  else np.float32)
+        mask_rows = np.zeros(n_rows_max, dtype=bool)
+        mask_rows[rows] = True
+        stats = {'row_sum': np.zeros(n_rows_max),
+                 'sum': np.zeros(n_cols), 'sumsq': np.zeros(n_cols),
+                 'n_nonzero': np.zeros(n_cols, dtype=int),
+                 'n_cells': np.zeros(n_cols, dtype=int),
+                 'n_rows': rows.size}
+        if speculate:
+            stats_spec = {'sum': np.zeros(n_cols), 'sumsq': np.zeros(n_cols)}
+        pos = 0  # position in the compacted matrix
+        for start in range(0, n_rows_max, self.len_chunk):
+            end = min(start + self.len_chunk, n_rows_max)
+            chunk_rows = np.arange(start, end)[mask_rows[start:end]]
+            chunk = X[start:end]
+            if self._rows is not None: chunk = chunk[mask_rows[start:end]]
+            if self._cols is not None: chunk = chunk[:, cols]
+            elif not materialize and self._ops: chunk = chunk.copy()
+            chunk = self._apply_ops(chunk, chunk_rows)
+            # write the chunk
+            if materialize:
+                if sparse and not densify:
+                    chunk = sp.sparse.csr_matrix(chunk)
+                    data[pos_nnz:pos_nnz+chunk.nnz] = chunk.data
+                    indices[pos_nnz:pos_nnz+chunk.nnz] = chunk.indices
+                    indptr_new[pos+1:pos+1+chunk.shape[0]] = pos_nnz + chunk.indptr[1:]
+                    pos_nnz += chunk.nnz
+                else:
+                    if issparse(chunk): chunk = chunk.toarray()
+                    buffer[pos*n_cols:(pos+chunk.shape[0])*n_cols] = chunk.ravel()
+            pos += chunk.shape[0]
+            # compute statistics
+            row_sum = np.ravel(chunk.sum(axis=1))
+            stats['row_sum'][chunk_rows] = row_sum
+            self._add_col_stats(stats, chunk)
+            if speculate:
+                factors = np.zeros(row_sum.size)
+                factors[row_sum >= 1] = 1 / row_sum[row_sum >= 1]
+                if issparse(chunk):
+                    chunk = sp.sparse.diags(factors).dot(chunk)
+                else:
+                    chunk = chunk * factors[:, None]
+                stats_spec['sum'] += np.ravel(chunk.sum(axis=0))
+                stats_spec['sumsq'] += np.ravel(chunk.multiply(chunk).sum(axis=0)
+                                                if issparse(chunk)
+                                                else np.einsum('ij,ij->j', chunk, chunk))
+        self.n_passes += 1
+        if materialize:
+            if sparse and not densify:
+                self._X = sp.sparse.csr_matrix((data[:pos_nnz], indices[:pos_nnz], indptr_new),
+                                               shape=(rows.size, n_cols))
+            else:
+                self._X = buffer[:rows.size*n_cols].reshape(rows.size, n_cols)
+            self._orig_rows = self._orig_rows[rows]
+            self._orig_cols = self._orig_cols[cols]
+            stats['row_sum'] = stats['row_sum'][rows]
+            self._rows = self._cols = None
+            self._ops = []
+        self._stats = stats
+        self._stats_spec = stats_spec if speculate else None
+
+    def _apply_ops(self, chunk, chunk_rows):
+        if self._ops and chunk.dtype.kind != 'f':
+            chunk = chunk.astype(np.float32)
+        for op in self._ops:
+            if op[0] == 'rows':
+                factors = op[1][chunk_rows]
+                if issparse(chunk): chunk = sp.sparse.diags(factors).dot(chunk)
+                else: chunk *= factors[:, None]
+            elif op[0] == 'log1p':
+                if issparse(chunk): chunk = chunk.log1p()
+                else: np.log1p(chunk, out=chunk)
+            elif op[0] == 'cols':
+                _, mean, scale, max_value = op
+                if mean is not None:
+                    if issparse(chunk): chunk = chunk.toarray()
+                    chunk -= mean
+                if issparse(chunk): chunk = chunk.dot(sp.sparse.diags(1/scale))
+                else: chunk /= scale
+                if max_value is not None:
+                    if issparse(chunk): chunk.data[chunk.data > max_value] = max_value
+                    else: chunk[chunk > max_value] = max_value
+        return chunk
+
+    def _add_col_stats(self, stats, chunk):
+        if issparse(chunk):
+            stats['sum'] += np.ravel(chunk.sum(axis=0))
+            stats['sumsq'] += np.ravel(chunk.multiply(chunk).sum(axis=0))
+            stats['n_nonzero'] += np.ravel((chunk != 0).sum(axis=0))
+            stats['n_cells'] += np.ravel((chunk > 0).sum(axis=0))
+        else:
+            stats['sum'] += chunk.sum(axis=0)
+            stats['sumsq'] += np.einsum('ij,ij->j', chunk, chunk)
+            stats['n_nonzero'] += np.count_nonzero(chunk, axis=0)
+            stats['n_cells'] += np.sum(chunk > 0, axis=0)
@@ -5,6 +5,7 @@ Preprocessing recipes from the literature
 
 from .. import settings as sett
 from . import simple as pp
+from .pipeline import Pipeline
 
 
 def recipe_weinreb16(adata, mean_threshold=0.01, cv_threshold=2,
@@ -33,9 +34,13 @@ def recipe_weinreb16(adata, mean_threshold=0.01, cv_threshold=2,
     sett.m(0, 'preprocess: weinreb16, X has shape n_samples x n_variables =',
            adata.X.shape[0], 'x', adata.X.shape[1])
     if copy: adata = adata.copy()
-    adata.X = pp.normalize_per_cell_weinreb16(adata.X,
-                                           max_fraction=0.05,
-                                           mult_with_mean=True)
+    if adata.X.dtype.kind == 'f':
+        pp.normalize_per_cell_weinreb16(adata.X, max_fraction=0.05,
+                                        mult_with_mean=True, copy=False)
+    else:
+        adata.X = pp.normalize_per_cell_weinreb16(adata.X,
+                                               max_fraction=0.05,
+                                               mult_with_mean=True)
     # filter out genes with mean expression < 0.1 and coefficient of variance <
     # cv_threshold
     gene_subset = pp.filter_genes_cv_deprecated(adata.X, mean_threshold, cv_threshold)
@@ -60,19 +65,18 @@ def recipe_zheng17(adata, n_top_genes=1000, zero_center=True, plot=True, copy=Fa
     """Normalization and filtering as of Zheng et al. (2017).
     """
     if copy: adata = adata.copy()
-    pp.filter_genes(adata, min_counts=1)  # only consider genes with more than 1 count
-    pp.normalize_per_cell(adata)          # normalize with total UMI count per cell
-    filter_result = pp.filter_genes_dispersion(adata.X,
-                                               flavor='cell_ranger',
-                                               n_top_genes=n_top_genes,
-                                               log=False)
+    # all steps are fused into few chunked passes over the data, see Pipeline
+    pipe = (Pipeline()
+            .filter_genes(min_counts=1)  # only consider genes with more than 1 count
+            .normalize_per_cell()        # normalize with total UMI count per cell
+            .filter_genes_dispersion(flavor='cell_ranger',
+                                     n_top_genes=n_top_genes,
+                                     log=False)
+            .normalize_per_cell()        # need to redo normalization after filtering
+            .log1p()                     # log transform: X = log(X + 1)
+            .scale(zero_center=zero_center))
+    pipe.run(adata)
     if plot:
         from .. import plotting as pl  # should not import at the top of the file
-        pl.filter_genes_dispersion(filter_result, log=True)
-    # actually filter the genes, the following is the inplace version of
-    #     adata = adata[:, filter.gene_subset]
-    adata.inplace_subset_var(filter_result.gene_subset)  # filter genes
-    pp.normalize_per_cell(adata)  # need to redo normalization after filtering
-    pp.log1p(adata)  # log transform: X = log(X + 1)
-    pp.scale(adata, zero_center=zero_center)
+        pl.filter_genes_dispersion(pipe.filter_result, log=True)
     return adata if copy else None
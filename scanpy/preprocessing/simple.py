@@ -2,12 +2,25 @@
 """Simple Preprocessing Functions
 
 Compositions of these functions are found in sc.preprocess.recipes.
+
+Functions that transform the data matrix, `log1p`, `normalize_per_cell`,
+`scale` and the legacy `normalize_per_cell_weinreb16` and `zscore_deprecated`,
+take `copy`. If False, an AnnData or a floating point data matrix is updated
+in place, in chunks of rows and without temporaries of the size of the data.
+This requires a floating point data matrix, convert integer counts once, for
+example, to float32. Only the legacy functions default to `copy=True`, as they
+always returned a new matrix.
+
+The other functions do not transform the data matrix, hence, have no such
+path: `filter_cells`, `filter_genes`, `filter_genes_dispersion` and
+`subsample` only compute statistics in chunks of rows and subset the AnnData
+in place; `pca` writes a new representation and leaves the data matrix
+untouched.
 """
 
 import numpy as np
 import scipy as sp
 import warnings
-from joblib import Parallel, delayed
 from scipy.sparse import issparse
 import statsmodels.api as sm
 from statsmodels.tools.sm_exceptions import PerfectSeparationError
@@ -15,6 +28,7 @@ from sklearn.utils import sparsefuncs
 from ..data_structs import AnnData
 from .. import settings as sett
 from .. import logging as logg
+from .. import parallel
 
 
 def filter_cells(data, min_counts=None, min_genes=None, copy=False):
@@ -58,8 +72,13 @@ def filter_cells(data, min_counts=None, min_genes=None, copy=False):
         return adata if copy else None
     X = data  # proceed with processing the data matrix
     min_number = min_counts if min_genes is None else min_genes
-    number_per_cell = np.sum(X if min_genes is None else X > 0, axis=1)
-    if issparse(X): number_per_cell = number_per_cell.A1
+    if issparse(X):
+        number_per_cell = np.sum(X if min_genes is None else X > 0, axis=1).A1
+    else:
+        # count in chunks of rows to avoid a boolean temporary of the size of X
+        number_per_cell = np.concatenate([
+            np.sum(X[rows] if min_genes is None else X[rows] > 0, axis=1)
+            for rows in _chunks(X)])
     cell_subset = number_per_cell >= min_number
     s = np.sum(~cell_subset)
     if s > 0:
@@ -96,10 +115,12 @@ def filter_genes(data, min_cells=None, min_counts=None, copy=False):
         adata.inplace_subset_var(gene_subset)
         return adata if copy else None
     X = data  # proceed with processing the data matrix
-    number_per_gene = np.sum(X if min_cells is None else X > 0, axis=0)
     min_number = min_counts if min_cells is None else min_cells
     if issparse(X):
-        number_per_gene = number_per_gene.A1
+        number_per_gene = np.sum(X if min_cells is None else X > 0, axis=0).A1
+    else:
+        number_per_gene = sum(np.sum(X[rows] if min_cells is None else X[rows] > 0, axis=0)
+                              for rows in _chunks(X))
     gene_subset = number_per_gene >= min_number
     sett.m(0, '... filtered out', np.sum(~gene_subset),
            'genes that are detected',
@@ -118,13 +139,19 @@ def filter_genes_dispersion(data, log=True,
 
     If trying out parameters, pass the data matrix instead of AnnData.
 
+    Data that does not fit into memory can be passed as h5py dataset, as
+    memory-mapped array or as an iterable of chunks of rows. Only one chunk is
+    kept in memory while accumulating the per-gene statistics.
+
     Similar functions are used, for example, by Cell Ranger (Zheng et al., 2017)
     and Seurat (Macosko et al., 2015).
 
     Parameters
     ----------
-    X : AnnData or array-like
-        Data matrix storing unlogarithmized data.
+    X : AnnData, array-like, h5py.Dataset or iterable of array-like
+        Data matrix storing unlogarithmized data. If an iterable, it yields
+        chunks of rows, which may be normalized on the fly, for example,
+        `(sc.pp.normalize_per_cell(X[i:i+10000], 1e4, copy=True) for i in ...)`.
     log : bool
         Use the logarithm of mean and variance.
     min_mean=0.0125, max_mean=3, min_disp=0.5, max_disp=None : float
@@ -168,68 +195,14 @@ def filter_genes_dispersion(data, log=True,
         return adata if copy else None
     logg.m('... filter highly varying genes by dispersion and mean', r=True, end=' ')
     X = data  # proceed with data matrix
-    mean, var = _get_mean_var(X)
-    # now actually compute the dispersion
-    dispersion = var / mean
-    if log:  # logarithmized mean as in Seurat
-        dispersion[dispersion == 0] = np.nan
-        dispersion = np.log(dispersion)
-        mean = np.log1p(mean)
-    # all of the following quantities are "per-gene" here
-    import pandas as pd
-    df = pd.DataFrame()
-    df['mean'] = mean
-    df['dispersion'] = dispersion
-    if flavor == 'seurat':
-        df['mean_bin'] = pd.cut(df['mean'], bins=20)
-        disp_grouped = df.groupby('mean_bin')['dispersion']
-        disp_mean_bin = disp_grouped.mean()
-        disp_std_bin = disp_grouped.std(ddof=1)
-        df['dispersion_norm'] = (df['dispersion'].values  # use values here as index differs
-                                 - disp_mean_bin[df['mean_bin']].values) \
-                                 / disp_std_bin[df['mean_bin']].values
-    elif flavor == 'cell_ranger':
-        from statsmodels import robust
-        df['mean_bin'] = pd.cut(df['mean'], np.r_[-np.inf,
-            np.percentile(df['mean'], np.arange(10, 105, 5)), np.inf])
-        disp_grouped = df.groupby('mean_bin')['dispersion']
-        disp_median_bin = disp_grouped.median()
-        # the next line raises the warning: "Mean of empty slice"
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore')
-            disp_mad_bin = disp_grouped.apply(robust.mad)
-        df['dispersion_norm'] = np.abs((df['dispersion'].values
-                                 - disp_median_bin[df['mean_bin']].values)) \
-                                / disp_mad_bin[df['mean_bin']].values
-    else:
-        raise ValueError('`flavor` needs to be "seurat" or "cell_ranger"')
-    dispersion_norm = df['dispersion_norm'].values.astype('float32')
-    if n_top_genes is not None:
-        dispersion_norm[::-1].sort()  # interestingly, np.argpartition is slightly slower
-        disp_cut_off = dispersion_norm[n_top_genes-1]
-        gene_subset = df['dispersion_norm'].values >= disp_cut_off
-        logg.m(t=True)
-        logg.m('    the', n_top_genes,
-               'top genes correspond to a normalized dispersion cutoff of',
-               disp_cut_off)
+    if hasattr(X, 'shape'):
+        mean, var = _get_mean_var(X)
     else:
-        logg.m(t=True)
-        logg.m('    using `min_disp={}`, `max_disp={}`, `min_mean={}` and `max_mean={}`'
-               .format(min_disp, max_disp, min_mean, max_mean))
-        logg.m('set `n_top_genes` to simply select top-scoring genes instead', v='hint')
-        max_disp = np.inf if max_disp is None else max_disp
-        dispersion_norm[np.isnan(dispersion_norm)] = 0  # similar to Seurat
-        gene_subset = np.logical_and.reduce((mean > min_mean, mean < max_mean,
-                                             dispersion_norm > min_disp,
-                                             dispersion_norm < max_disp))
-    return np.rec.fromarrays((gene_subset,
-                              df['mean'].values,
-                              df['dispersion'].values,
-                              df['dispersion_norm'].values.astype('float32', copy=False)),
-                              dtype=[('gene_subset', bool),
-                                     ('means', 'float32'),
-                                     ('dispersions', 'float32'),
-                                     ('dispersions_norm', 'float32')])
+        mean, var = _get_mean_var_chunked(X)
+    return _filter_genes_dispersion(mean, var, log=log,
+                                    min_disp=min_disp, max_disp=max_disp,
+                                    min_mean=min_mean, max_mean=max_mean,
+                                    n_top_genes=n_top_genes, flavor=flavor)
 
 
 def filter_genes_cv_deprecated(X, Ecutoff, cvFilter):
@@ -266,14 +239,28 @@ def log1p(data, copy=False):
     data : array-like or AnnData
         The data matrix.
     copy : bool (default: False)
-        If an AnnData is passed, determines whether a copy is returned.
+        Determines whether function operates inplace (default) or a copy is
+        returned. Operating inplace on a data matrix requires floating point
+        data, an AnnData with integer data is assigned a new data matrix.
+
+    Returns
+    -------
+    None if inplace. Otherwise the logarithmized version of the original data.
     """
     if isinstance(data, AnnData):
         adata = data.copy() if copy else data
-        data.X = log1p(data.X)
+        if _is_float(adata.X): log1p(adata.X)
+        else: adata.X = log1p(adata.X, copy=True)
         return adata if copy else None
     X = data  # proceed with data matrix
+    if not copy:
+        if not _is_float(X):
+            raise ValueError('Taking the logarithm inplace requires a floating point data '
+                             'matrix, set `copy=True` or convert to float.')
+        np.log1p(X.data if issparse(X) else X, out=X.data if issparse(X) else X)
+        return None
     if not issparse(X):
+        _check_memory(X.shape, np.float64 if X.dtype.itemsize > 4 else np.float32)
         return np.log1p(X)
     else:
         return X.log1p()
@@ -323,6 +310,10 @@ def pca(data, n_comps=10, zero_center=True, svd_solver='auto',
     components / PC1, PC2, PC3, ... : np.ndarray
          The PCs containing the loadings as shape n_comps x n_vars. Written to
          adata.var if an AnnData object is provided.
+    pca_mean : np.ndarray
+         The mean of the variables subtracted before projecting on the PCs,
+         zero if `zero_center` is False. Written to adata.var if an AnnData
+         object is provided.
     variance_ratio : np.ndarray
          Ratio of explained variance. Written as unstructured annotation to
          adata, if provided.
@@ -346,11 +337,15 @@ def pca(data, n_comps=10, zero_center=True, svd_solver='auto',
             adata.smp['X_pca'] = X_pca  # this is multicolumn-sample annotation
             for icomp, comp in enumerate(components):
                 adata.var['PC' + str(icomp+1)] = comp
+            # the mean that has been subtracted before projecting on the PCs
+            zero_center = zero_center if zero_center is not None else not issparse(adata.X)
+            adata.var['pca_mean'] = (np.asarray(adata.X.mean(axis=0)).flatten() if zero_center
+                                     else np.zeros(adata.X.shape[1]))
             adata.add['pca_variance_ratio'] = pca_variance_ratio
             logg.m('finished', t=True, end=' ')
             logg.m('and added\n'
                    '    the data representation "X_pca" (adata.smp)\n'
-                   '    the loadings "PC1", "PC2", ... (adata.var)\n'
+                   '    the loadings "PC1", "PC2", ... and the "pca_mean" (adata.var)\n'
                    '    the "pca_variance_ratio" (adata.add)')
         return adata if copy else None
     X = data  # proceed with data matrix
@@ -363,12 +358,16 @@ def pca(data, n_comps=10, zero_center=True, svd_solver='auto',
     from sklearn.decomposition import PCA, TruncatedSVD
     verbosity_level = np.inf if mute else 0
     if zero_center:
-        if issparse(X):
+        # sklearn centers a copy of X, unless X is our own dense copy
+        densified = issparse(X)
+        if densified:
             logg.m('... as `zero_center=True`, '
                    'sparse input is densified and may '
                    'lead to huge memory consumption')
+            _check_memory(X.shape, X.dtype, X)
             X = X.toarray()
-        pca_ = PCA(n_components=n_comps, svd_solver=svd_solver, random_state=random_state)
+        pca_ = PCA(n_components=n_comps, svd_solver=svd_solver, random_state=random_state,
+                   copy=not densified)
     else:
         logg.m('... without zero-centering: \n'
                '    the explained variance does not correspond to the exact statistical defintion\n'
@@ -414,26 +413,33 @@ def normalize_per_cell(data, counts_per_cell_after=None, copy=False, counts_per_
         adata = data.copy() if copy else data
         cell_subset, counts_per_cell = filter_cells(adata.X, min_counts=1)
         adata.inplace_subset_smp(cell_subset)
-        normalize_per_cell(adata.X, counts_per_cell_after, copy,
+        normalize_per_cell(adata.X, counts_per_cell_after,
                            counts_per_cell=counts_per_cell[cell_subset])
         return adata if copy else None
     # proceed with data matrix
     logg.m('... normalizing by total count per cell', r=True, end=' ')
+    if not copy and not _is_float(data):
+        raise ValueError('Normalizing inplace requires a floating point data matrix, '
+                         'set `copy=True` or convert to float.')
+    if copy and not issparse(data): _check_memory(data.shape, data.dtype)
     X = data.copy() if copy else data
     if counts_per_cell is None:
         cell_subset, counts_per_cell = filter_cells(X, min_counts=1)
-        X = X[cell_subset]
-        counts_per_cell = counts_per_cell[cell_subset]
+        # rows cannot be removed inplace, there, cells without counts remain zero
+        if copy:
+            X = X[cell_subset]
+            counts_per_cell = counts_per_cell[cell_subset]
     if counts_per_cell_after is None:
-        counts_per_cell_after = np.median(counts_per_cell)
+        counts_per_cell_after = np.median(counts_per_cell[counts_per_cell > 0])
     counts_per_cell /= counts_per_cell_after
+    counts_per_cell[counts_per_cell == 0] = 1
     if not issparse(X): X /= counts_per_cell[:, np.newaxis]
     else: sparsefuncs.inplace_row_scale(X, 1/counts_per_cell)
     logg.m(t=True)
     return X if copy else None
 
 
-def normalize_per_cell_weinreb16(X, max_fraction=1, mult_with_mean=False):
+def normalize_per_cell_weinreb16(X, max_fraction=1, mult_with_mean=False, copy=True):
     """Normalize each cell.
 
     This is a legacy version. See `normalize_per_cell` instead.
@@ -450,31 +456,46 @@ def normalize_per_cell_weinreb16(X, max_fraction=1, mult_with_mean=False):
         reads in every cell.
     mult_with_mean: bool, optional
         Multiply the result with the mean of total counts.
+    copy : bool, optional (default: True)
+        Return a normalized copy. If False, overwrite X, which requires a
+        floating point matrix.
 
     Returns
     -------
     X_norm : np.ndarray
-        Normalized version of the original expression matrix.
+        Normalized version of the original expression matrix, None if not
+        `copy`.
     """
     if issparse(X):
         raise ValueError('Sparse input not allowed. '
                          'Consider `sc.pp.normalize_per_cell` instead.')
     if max_fraction < 0 or max_fraction > 1:
         raise ValueError('Choose max_fraction between 0 and 1.')
+    if not copy and not _is_float(X):
+        raise ValueError('Normalizing inplace requires a floating point data matrix, '
+                         'set `copy=True` or convert to float.')
     counts_per_cell = np.sum(X, axis=1)
     if max_fraction == 1:
-        X_norm = X / counts_per_cell[:, np.newaxis]
-        return X_norm
-    # restrict computation of counts to genes that make up less than
-    # constrain_theshold of the total reads
-    tc_tiled = np.tile(counts_per_cell[:, np.newaxis], (1, X.shape[1]))
-    included = np.all(X <= tc_tiled * max_fraction, axis=0)
-    tc_include = np.sum(X[:, included], axis=1)
-    tc_tiled = np.tile(tc_include[:, np.newaxis], (1, X.shape[1])) + 1e-6
-    X_norm = X / tc_tiled
-    if mult_with_mean:
+        counts = counts_per_cell
+    else:
+        # restrict computation of counts to genes that make up less than
+        # constrain_theshold of the total reads, all of this is done in chunks
+        # of rows to avoid temporaries of the size of X
+        included = np.ones(X.shape[1], dtype=bool)
+        for rows in _chunks(X):
+            included &= np.all(X[rows] <= counts_per_cell[rows, np.newaxis] * max_fraction,
+                               axis=0)
+        tc_include = np.concatenate([X[rows].dot(included) for rows in _chunks(X)])
+        counts = tc_include + 1e-6
+    if not copy:
+        X /= counts[:, np.newaxis]
+        X_norm = X
+    else:
+        _check_memory(X.shape, np.result_type(X.dtype, np.float32))
+        X_norm = X / counts[:, np.newaxis]
+    if mult_with_mean and max_fraction != 1:
         X_norm *= np.mean(counts_per_cell)
-    return X_norm
+    return X_norm if copy else None
 
 
 def regress_out(adata, smp_keys, n_jobs=None, copy=False):
@@ -513,15 +534,14 @@ def regress_out(adata, smp_keys, n_jobs=None, copy=False):
                 'only a single one is allowed. For this one '
                 'the mean is computed for each variable/gene.')
         logg.m('... regressing on per-gene means within categories')
-        unique_categories = np.unique(adata.smp[smp_keys[0]])
-        regressors = np.zeros(adata.X.shape, dtype='float32')
-        for category in unique_categories:
-            mask = category == adata.smp[smp_keys[0]]
-            for ix, x in enumerate(adata.X.T):
-                regressors[mask, ix] = x[mask].mean()
+        # the least-squares fit of a gene on the intercept and its per-category
+        # means is the vector of per-category means itself, hence, the
+        # residuals are obtained by simply subtracting the category means
+        _subtract_category_means(adata.X, adata.smp[smp_keys[0]])
+        logg.m('finished', t=True)
+        return adata if copy else None
     # regress on one or several ordinal variables
-    else:
-        regressors = np.array([adata.smp[key] for key in smp_keys]).T
+    regressors = np.array([adata.smp[key] for key in smp_keys]).T
     regressors = np.c_[np.ones(adata.X.shape[0]), regressors]
     len_chunk = np.ceil(min(1000, adata.X.shape[1]) / n_jobs).astype(int)
     n_chunks = np.ceil(adata.X.shape[1] / len_chunk).astype(int)
@@ -536,12 +556,18 @@ def regress_out(adata, smp_keys, n_jobs=None, copy=False):
         # logg.m('... nicer progress bars as on command line come soon')
     else:
         from tqdm import tqdm
-    for chunk in tqdm(chunks):
-        result_lst = Parallel(n_jobs=n_jobs)(
-            delayed(_regress_out)(
-                col_index, adata.X, regressors) for col_index in chunk)
-        for i_column, column in enumerate(chunk):
-            adata.X[:, column] = result_lst[i_column]
+    # publish the data matrix to the workers once, instead of sending it
+    # along with each chunk
+    X = adata.X if n_jobs == 1 else parallel.share(adata.X, 'regress_out_X')
+    # each worker processes one chunk of columns per call
+    batches = [chunks[start:start + n_jobs] for start in range(0, n_chunks, n_jobs)]
+    for batch in tqdm(batches):
+        result_lst = parallel.run(_regress_out_chunk,
+                                  [(chunk, X, regressors) for chunk in batch],
+                                  n_jobs=n_jobs)
+        for chunk, chunk_array in zip(batch, result_lst):
+            adata.X[:, chunk] = chunk_array
+    parallel.release('regress_out_X')
     logg.m('finished', t=True)
     return adata if copy else None
 
@@ -558,7 +584,8 @@ def scale(data, zero_center=True, max_value=None, copy=False):
     max_value : None or float, optional (default: None)
         Clip to this value after scaling. If None, do not clip.
     copy : bool (default: False)
-        Perfrom operation inplace if False.
+        Perfrom operation inplace if False. This requires a floating point data
+        matrix and does not allocate temporaries of the size of the data.
     """
     if isinstance(data, AnnData):
         adata = data.copy() if copy else data
@@ -566,9 +593,14 @@ def scale(data, zero_center=True, max_value=None, copy=False):
         if zero_center and issparse(adata.X):
             logg.m('... scale_data: as `zero_center=True`, sparse input is '
                    'densified and may lead to large memory consumption')
+            _check_memory(adata.X.shape, adata.X.dtype, adata.X)
             adata.X = adata.X.toarray()
-        scale(adata.X, zero_center=zero_center, max_value=max_value, copy=copy)
+        scale(adata.X, zero_center=zero_center, max_value=max_value)
         return adata if copy else None
+    if not copy and not _is_float(data):
+        raise ValueError('Scaling inplace requires a floating point data matrix, '
+                         'set `copy=True` or convert to float.')
+    if copy and not issparse(data): _check_memory(data.shape, data.dtype)
     X = data.copy() if copy else data  # proceed with the data matrix
     zero_center = zero_center if zero_center is not None else False if issparse(X) else True
     if zero_center and max_value is not None:
@@ -580,10 +612,13 @@ def scale(data, zero_center=True, max_value=None, copy=False):
     if zero_center and issparse(X):
         logg.m('... scale_data: as `zero_center=True`, sparse input is '
                'densified and may lead to large memory consumption, returning copy')
+        _check_memory(X.shape, X.dtype, X)
         X = X.toarray()
         copy = True
     _scale(X, zero_center)
-    if max_value is not None: X[X > max_value] = max_value
+    if max_value is not None:
+        if issparse(X): np.minimum(X.data, max_value, out=X.data)
+        else: np.minimum(X, max_value, out=X)
     return X if copy else None
 
 
@@ -620,7 +655,7 @@ def subsample(data, subsample, seed=0, copy=False):
     return adata if copy else None
 
 
-def zscore_deprecated(X):
+def zscore_deprecated(X, copy=True):
     """Z-score standardize each variable/gene in X.
 
     Use `scale` instead.
@@ -629,15 +664,28 @@ def zscore_deprecated(X):
     ----------
     X : np.ndarray
         Data matrix. Rows correspond to cells and columns to genes.
+    copy : bool, optional (default: True)
+        Return a standardized copy. If False, overwrite X, which requires a
+        floating point matrix.
 
     Returns
     -------
     XZ : np.ndarray
-        Z-score standardized version of the data matrix.
+        Z-score standardized version of the data matrix, None if not `copy`.
     """
-    means = np.tile(np.mean(X, axis=0)[None, :], (X.shape[0], 1))
-    stds = np.tile(np.std(X, axis=0)[None, :], (X.shape[0], 1))
-    return (X - means) / (stds + .0001)
+    if not copy and not _is_float(X):
+        raise ValueError('Scaling inplace requires a floating point data matrix, '
+                         'set `copy=True` or convert to float.')
+    means, var = _get_mean_var(X)
+    # np.std is the biased estimator
+    stds = np.sqrt(var * ((X.shape[0] - 1) / X.shape[0]))
+    if copy:
+        _check_memory(X.shape, np.result_type(X.dtype, np.float32))
+        X = X.astype(np.result_type(X.dtype, np.float32))
+    for rows in _chunks(X):
+        X[rows] -= means
+        X[rows] /= stds + .0001
+    return X if copy else None
 
 
 # --------------------------------------------------------------------------------
@@ -645,14 +693,55 @@ def zscore_deprecated(X):
 # --------------------------------------------------------------------------------
 
 
+def _is_float(X):
+    return X.dtype.kind == 'f'
+
+
+def _chunks(X, len_chunk=10000):
+    """Slices of rows for processing X in chunks."""
+    for start in range(0, X.shape[0], len_chunk):
+        yield slice(start, min(start + len_chunk, X.shape[0]))
+
+
+def _check_memory(shape, dtype, X=None):
+    """Fail early if allocating an array would exceed `sett.max_memory`.
+
+    If X is sparse, the array is a dense version of it.
+    """
+    n_bytes = np.prod(shape, dtype=float) * np.dtype(dtype).itemsize
+    if n_bytes / 2**30 > sett.max_memory:
+        raise MemoryError(
+            'Allocating a {} array of shape {} requires {:.2f} GB, '
+            'which exceeds `sett.max_memory = {}`. {}'
+            .format('dense' if issparse(X) else 'new', shape, n_bytes / 2**30,
+                    sett.max_memory,
+                    'Consider not zero-centering sparse data.' if issparse(X)
+                    else 'Consider an inplace computation on float32 data.'))
+
+
+def _subtract_category_means(X, categories, len_chunk=10000):
+    """Subtract the per-category mean of each variable/gene inplace.
+
+    All means are computed with a single product of the (sparse) indicator
+    matrix of the categories with X.
+    """
+    _, codes = np.unique(categories, return_inverse=True)
+    n_categories = codes.max() + 1
+    indicator = sp.sparse.csr_matrix((np.ones(codes.size), (codes, np.arange(codes.size))),
+                                     shape=(n_categories, codes.size))
+    means = indicator.dot(X)
+    if issparse(means): means = means.toarray()
+    means /= np.bincount(codes)[:, None]
+    means = means.astype(X.dtype, copy=False)
+    # subtract in chunks of rows to avoid a temporary of the size of X
+    for start in range(0, X.shape[0], len_chunk):
+        X[start:start+len_chunk] -= means[codes[start:start+len_chunk]]
+
+
 def _regress_out(col_index, responses, regressors):
     try:
-        if regressors.shape[1] - 1 == responses.shape[1]:
-            regressors_view = np.c_[regressors[:, 0], regressors[:, col_index + 1]]
-        else:
-            regressors_view = regressors
         result = sm.GLM(responses[:, col_index],
-                        regressors_view, family=sm.families.Gaussian()).fit()
+                        regressors, family=sm.families.Gaussian()).fit()
         new_column = result.resid_response
     except PerfectSeparationError:  # this emulates R's behavior
         logg.m('warning: encountered PerfectSeparationError, setting to zero',
@@ -695,13 +784,13 @@ def _get_mean_var(X):
     #   int to long trafo for very large matrices
     # - using X.multiply is slower
     if True:
-        mean = X.mean(axis=0)
         if issparse(X):
-            mean_sq = X.multiply(X).mean(axis=0)
-            mean = mean.A1
-            mean_sq = mean_sq.A1
+            mean = X.mean(axis=0).A1
+            mean_sq = X.multiply(X).mean(axis=0).A1
         else:
-            mean_sq = np.multiply(X, X).mean(axis=0)
+            # accumulate over chunks of rows to avoid a temporary of the size
+            # of X, this also reads h5py datasets and memmaps only chunkwise
+            return _get_mean_var_chunked(X[rows] for rows in _chunks(X))
         # enforece R convention (unbiased estimator) for variance
         var = (mean_sq - mean**2) * (X.shape[0]/(X.shape[0]-1))
     else:
@@ -713,6 +802,104 @@ def _get_mean_var(X):
     return mean, var
 
 
+def _get_mean_var_chunked(chunks):
+    """Mean and variance of the columns of a matrix passed as chunks of rows."""
+    n_rows = 0
+    for chunk in chunks:
+        if n_rows == 0:
+            mean = np.zeros(chunk.shape[1])
+            mean_sq = np.zeros(chunk.shape[1])
+        if issparse(chunk):
+            mean += chunk.sum(axis=0).A1
+            mean_sq += chunk.multiply(chunk).sum(axis=0).A1
+        else:
+            chunk = np.asarray(chunk)
+            mean += chunk.sum(axis=0, dtype=np.float64)
+            mean_sq += np.einsum('ij,ij->j', chunk, chunk, dtype=np.float64)
+        n_rows += chunk.shape[0]
+    if n_rows < 2:
+        raise ValueError('Need at least two rows to compute the variance.')
+    mean /= n_rows
+    mean_sq /= n_rows
+    # enforece R convention (unbiased estimator) for variance
+    var = (mean_sq - mean**2) * (n_rows/(n_rows-1))
+    return mean, var
+
+
+def _filter_genes_dispersion(mean, var, log=True,
+                             min_disp=0.5, max_disp=None,
+                             min_mean=0.0125, max_mean=3,
+                             n_top_genes=None,
+                             flavor='seurat'):
+    """Select highly variable genes given the per-gene mean and variance.
+
+    See `filter_genes_dispersion`.
+    """
+    # now actually compute the dispersion
+    dispersion = var / mean
+    if log:  # logarithmized mean as in Seurat
+        dispersion[dispersion == 0] = np.nan
+        dispersion = np.log(dispersion)
+        mean = np.log1p(mean)
+    # all of the following quantities are "per-gene" here
+    import pandas as pd
+    df = pd.DataFrame()
+    df['mean'] = mean
+    df['dispersion'] = dispersion
+    if flavor == 'seurat':
+        df['mean_bin'] = pd.cut(df['mean'], bins=20)
+        disp_grouped = df.groupby('mean_bin')['dispersion']
+        disp_mean_bin = disp_grouped.mean()
+        disp_std_bin = disp_grouped.std(ddof=1)
+        df['dispersion_norm'] = (df['dispersion'].values  # use values here as index differs
+                                 - disp_mean_bin[df['mean_bin']].values) \
+                                 / disp_std_bin[df['mean_bin']].values
+    elif flavor == 'cell_ranger':
+        from statsmodels import robust
+        df['mean_bin'] = pd.cut(df['mean'], np.r_[-np.inf,
+            np.percentile(df['mean'], np.arange(10, 105, 5)), np.inf])
+        disp_grouped = df.groupby('mean_bin')['dispersion']
+        disp_median_bin = disp_grouped.median()
+        # the next line raises the warning: "Mean of empty slice"
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            disp_mad_bin = disp_grouped.apply(robust.mad)
+        df['dispersion_norm'] = np.abs((df['dispersion'].values
+                                 - disp_median_bin[df['mean_bin']].values)) \
+                                / disp_mad_bin[df['mean_bin']].values
+    else:
+        raise ValueError('`flavor` needs to be "seurat" or "cell_ranger"')
+    dispersion_norm = df['dispersion_norm'].values.astype('float32')
+    if n_top_genes is not None:
+        dispersion_norm[::-1].sort()  # interestingly, np.argpartition is slightly slower
+        disp_cut_off = dispersion_norm[n_top_genes-1]
+        # compare at the precision of the cutoff, otherwise the gene that
+        # defines the cutoff might not pass it
+        gene_subset = df['dispersion_norm'].values.astype('float32') >= disp_cut_off
+        logg.m(t=True)
+        logg.m('    the', n_top_genes,
+               'top genes correspond to a normalized dispersion cutoff of',
+               disp_cut_off)
+    else:
+        logg.m(t=True)
+        logg.m('    using `min_disp={}`, `max_disp={}`, `min_mean={}` and `max_mean={}`'
+               .format(min_disp, max_disp, min_mean, max_mean))
+        logg.m('set `n_top_genes` to simply select top-scoring genes instead', v='hint')
+        max_disp = np.inf if max_disp is None else max_disp
+        dispersion_norm[np.isnan(dispersion_norm)] = 0  # similar to Seurat
+        gene_subset = np.logical_and.reduce((mean > min_mean, mean < max_mean,
+                                             dispersion_norm > min_disp,
+                                             dispersion_norm < max_disp))
+    return np.rec.fromarrays((gene_subset,
+                              df['mean'].values,
+                              df['dispersion'].values,
+                              df['dispersion_norm'].values.astype('float32', copy=False)),
+                              dtype=[('gene_subset', bool),
+                                     ('means', 'float32'),
+                                     ('dispersions', 'float32'),
+                                     ('dispersions_norm', 'float32')])
+
+
 def _scale(X, zero_center=True):
     # - using sklearn.StandardScaler throws an error related to
     #   int to long trafo for very large matrices
@@ -725,8 +912,9 @@ def _scale(X, zero_center=True):
             if zero_center: raise ValueError('Cannot zero-center sparse matrix.')
             sparsefuncs.inplace_column_scale(X, 1/scale)
         else:
-            X -= mean
-            X /= scale
+            for rows in _chunks(X):
+                if zero_center: X[rows] -= mean
+                X[rows] /= scale
     else:
         from sklearn.preprocessing import StandardScaler
         scaler = StandardScaler(with_mean=zero_center, copy=False).partial_fit(X)
@@ -0,0 +1,150 @@
+import importlib
+
+import numpy as np
+
+# the module, not the function of the same name exported by scanpy.tools
+dpt = importlib.import_module('scanpy.tools.dpt')
+
+
+def test_prefix_concordance():
+    np.random.seed(0)
+    for n in [2, 17, 100]:
+        # include ties
+        a = np.random.randint(10, size=n).astype(float)
+        b = np.random.rand(n)
+        S = np.sign(a[None, :] - a[:, None]) * np.sign(b[None, :] - b[:, None])
+        diff_pos, diff_neg = dpt._prefix_concordance(a, b)
+        assert np.array_equal(diff_pos, [S[i, :i].sum() for i in range(n)])
+        assert np.array_equal(diff_neg, [S[i, i+1:].sum() for i in range(n)])
+
+
+def test_kendall_tau_split():
+    from scipy.stats import kendalltau
+    np.random.seed(0)
+    t = np.linspace(0, 1, 200)
+    # correlated before t = 0.3, anticorrelated after
+    a = np.where(t < 0.3, -t, t) + 0.01 * np.random.randn(200)
+    b = np.where(t < 0.3, -t, -t) + 0.01 * np.random.randn(200)
+    graph = dpt.DPT.__new__(dpt.DPT)
+    imax = graph.kendall_tau_split(a, b)
+    corr = [kendalltau(a[:i+1], b[:i+1])[0] - kendalltau(a[i+1:], b[i+1:])[0]
+            for i in range(5, 194)]
+    assert imax == 5 + np.argmax(corr)
+
+
+def _branching_graph(n):
+    from scanpy.data_structs import AnnData
+    np.random.seed(0)
+    t = np.random.rand(n)
+    arms = np.eye(3)[np.random.randint(3, size=n)]
+    X = (t[:, None] * arms + 0.02 * np.random.randn(n, 3)).astype('float32')
+    adata = AnnData(X)
+    adata.add['xroot'] = X[np.argmin(t)]
+    graph = dpt.DPT(adata, k=15, n_pcs=0, n_branchings=1)
+    graph.diffmap(n_comps=5)
+    graph.set_pseudotime()
+    return graph
+
+
+def test_branchings_n_jobs():
+    graph = _branching_graph(600)
+    segs_names = []
+    for n_jobs in [1, 2]:
+        graph.n_jobs = n_jobs
+        graph.branchings_segments()
+        segs_names.append(graph.segs_names)
+    assert np.array_equal(*segs_names)
+    assert len(np.unique(segs_names[0])) == 4
+    assert np.array_equal(graph.cells_seg, graph.segs_names)
+
+
+def test_branchings_empty_segments():
+    # three arms allow for a single branching, the second one yields an
+    # empty segment
+    graph = _branching_graph(300)
+    graph.n_branchings = 2
+    graph.branchings_segments()
+    assert len(graph.segs) == 6 and np.all(graph.segs.sum(axis=1) > 0)
+    for seg, tips in zip(graph.segs, graph.segs_tips):
+        assert tips[0] == -1 or np.all(seg[tips])
+    # a split without undecided cells and with an empty segment
+    from scipy.spatial.distance import pdist, squareform
+    np.random.seed(0)
+    graph = dpt.DPT.__new__(dpt.DPT)
+    Dseg = squareform(pdist(np.random.rand(20, 2)))
+    graph._detect_branching_single = lambda Dseg, tips: [
+        np.arange(10), np.arange(10, 20), np.array([], dtype=int)]
+    ssegs, ssegs_tips, ssegs_connects = graph._detect_branching(Dseg, [0, 10, 5])
+    assert len(ssegs) == 3 and ssegs[-1].size == 0
+    assert ssegs_tips[0][0] == 0 and ssegs_tips[0][1] in ssegs[0]
+    assert ssegs_tips[1][0] == 10 and ssegs_tips[1][1] in ssegs[1]
+    assert ssegs_tips[-1] == [-1, -1] and ssegs_connects[:2] == [[-1], [-1]]
+
+
+def test_landmarks():
+    graph = _branching_graph(1000)
+    segs_names = []
+    for n_landmarks in [None, 300]:
+        graph.n_landmarks = n_landmarks
+        graph.branchings_segments()
+        segs_names.append(graph.segs_names)
+    landmarks = graph.landmarks
+    assert landmarks[0] == graph.iroot and np.unique(landmarks).size == 300
+    assert np.all(np.sort(graph.indices) == np.arange(1000))
+    assert np.mean(segs_names[0] == segs_names[1]) > 0.95
+
+
+def test_resume_branchings():
+    from scanpy.data_structs import AnnData
+    np.random.seed(0)
+    # a root edge that splits into two, which split again
+    nodes = np.random.randn(7, 10)
+    nodes[0] = 0
+    edges = np.array([(0, 1), (1, 2), (1, 3), (2, 4), (2, 5), (3, 6)])
+    e = np.random.randint(len(edges), size=800)
+    s = np.random.rand(800)[:, None]
+    X = (nodes[edges[e, 0]] + s * (nodes[edges[e, 1]] - nodes[edges[e, 0]])
+         + 0.03 * np.random.randn(800, 10)).astype('float32')
+    adata = AnnData(X)
+    adata.add['xroot'] = X[np.argmin(np.linalg.norm(X, axis=1))]
+    # lobpcg is deterministic
+    graph = dpt.DPT(adata, k=15, n_pcs=0, n_branchings=2, eigen_solver='lobpcg')
+    graph.diffmap(n_comps=10)
+    graph.set_pseudotime()
+    graph.branchings_segments()
+    segs_names, segs_tips = graph.segs_names, graph.segs_tips
+    segs_adjacency = graph.segs_adjacency.toarray()
+    # one branching, then resume with a second one
+    graph.n_branchings = 1
+    graph.branchings_segments()
+    assert adata.add['dpt_branching_n'] == 1
+    select_segment, n_calls = graph.select_segment, []
+
+    def select_segment_counted(*args):
+        n_calls.append(1)
+        return select_segment(*args)
+    graph.select_segment = select_segment_counted
+    graph.n_branchings, graph.resume = 2, True
+    graph.branchings_segments()
+    assert len(n_calls) == 1 and adata.add['dpt_branching_n'] == 2
+    assert np.array_equal(graph.segs_names, segs_names)
+    assert np.array_equal(graph.segs_tips, segs_tips)
+    assert np.array_equal(graph.segs_adjacency.toarray(), segs_adjacency)
+    # the state does not refer to another root
+    graph.iroot += 1
+    assert graph._load_branching_state() is None
+
+
+def test_detect_branching_commute_time():
+    graph = _branching_graph(600)
+    graph.compute_C_all(n_evals=10, on_the_fly=True)
+    C = graph.Dchosen[np.arange(600)]
+    tip_0 = np.argmax(C[graph.iroot])
+    tips = np.array([tip_0, np.argmax(C[tip_0])])
+    graph.cells_seg, graph.cells_pos = np.zeros(600, dtype=int), np.arange(600)
+    _, tips = graph.select_segment([np.arange(600)], [tips], [True])
+    # the commute-time rows, not the DPT distance, define the new tips
+    _, ssegs_tips, ssegs_connects = graph._detect_branching(graph.Dchosen, tips)
+    _, ssegs_tips_dense, ssegs_connects_dense = graph._detect_branching(C, tips)
+    assert np.array_equal(ssegs_tips, ssegs_tips_dense)
+    assert ssegs_connects == ssegs_connects_dense
@@ -0,0 +1,290 @@
+import numpy as np
+
+from scanpy import tools as tl
+from scanpy.data_structs import AnnData, data_graph
+from scanpy.preprocessing import simple as pp
+
+
+def _synthetic_graph(n_samples, sym=True):
+    """A DataGraph without data, with a random eigenbasis."""
+    graph = data_graph.DataGraph.__new__(data_graph.DataGraph)
+    np.random.seed(0)
+    graph.sym = sym
+    graph.X, graph.n_jobs = np.zeros((n_samples, 2)), 1
+    graph.evals = np.r_[1, np.linspace(0.99, 0.9, 5)]
+    graph.rbasis = np.random.randn(n_samples, 6) / 10
+    graph.lbasis = graph.rbasis if sym else np.random.randn(n_samples, 6) / 10
+    return graph
+
+
+def _noisy_spiral(n_samples, length=3, noise=0.02):
+    """Points on a noisy spiral and their positions along it."""
+    np.random.seed(0)
+    t = np.random.rand(n_samples) * length
+    X = np.c_[np.cos(t), np.sin(t), t] + noise * np.random.randn(n_samples, 3)
+    return X, t
+
+
+def test_nn_descent_recall():
+    np.random.seed(0)
+    centers = 5 * np.random.randn(10, 20)
+    X = (centers[np.random.randint(10, size=2000)]
+         + np.random.randn(2000, 20)).astype('float32')
+    k = 15
+    Dsq_exact, indices_exact, _ = data_graph.get_distance_matrix_and_neighbors(
+        X, k, method='brute')
+    Dsq, indices, distances = data_graph.get_distance_matrix_and_neighbors(
+        X, k, method='nn_descent')
+    assert indices.shape == indices_exact.shape
+    assert Dsq.shape == Dsq_exact.shape and Dsq.nnz == Dsq_exact.nnz
+    for A in [Dsq, Dsq_exact]:
+        assert A.dtype == np.float32 and A.indices.dtype == A.indptr.dtype == np.int32
+    assert indices.dtype == indices_exact.dtype == np.int32
+    assert np.all(np.diff(distances, axis=1) >= 0)
+    recall = np.mean([np.intersect1d(a, b).size
+                      for a, b in zip(indices, indices_exact)]) / (k - 1)
+    assert recall > 0.95
+
+
+def test_neighbors_cache():
+    np.random.seed(0)
+    X = np.random.randn(300, 10).astype('float32')
+    adata = AnnData(X)
+    tl.neighbors(adata, k=20, n_pcs=0)
+    indices, distances = data_graph.get_neighbors_from_cache(adata, X, 'X', 0, k=10)
+    _, indices_exact, _ = data_graph.get_distance_matrix_and_neighbors(X, 10)
+    assert np.array_equal(indices, indices_exact)
+    assert data_graph.get_neighbors_from_cache(adata, X, 'X', 0, k=30) is None
+    assert data_graph.get_neighbors_from_cache(adata, X + 1, 'X', 0, k=10) is None
+    # exact neighbors are not served for an approximate method and vice versa
+    assert data_graph.get_neighbors_from_cache(
+        adata, X, 'X', 0, k=10, method='nn_descent') is None
+    data_graph.get_neighbors_cached(adata, X, 'X', 0, k=20, method='nn_descent')
+    assert adata.add['neighbors_method'] == 'nn_descent'
+    assert data_graph.get_neighbors_from_cache(adata, X, 'X', 0, k=10) is None
+    assert data_graph.get_neighbors_from_cache(
+        adata, X, 'X', 0, k=10, method='nn_descent') is not None
+    # a change in rows that a sample of rows would miss
+    tl.neighbors(adata, k=20, n_pcs=0)
+    X_changed = X.copy()
+    X_changed[1:3] = X[1:3][::-1] + 1
+    indices, _ = data_graph.get_neighbors_cached(adata, X_changed, 'X', 0, k=10)
+    _, indices_exact, _ = data_graph.get_distance_matrix_and_neighbors(X_changed, 10)
+    assert np.array_equal(indices, indices_exact)
+    # a tool that needs fewer neighbors of another representation does not
+    # replace the stored ones
+    tl.neighbors(adata, k=20, n_pcs=0)
+    data_graph.get_neighbors_cached(adata, X[:, :3], 'X_pca', 3, k=5)
+    assert adata.add['neighbors_rep'] == 'X' and adata.add['neighbors_k'] == 20
+    data_graph.get_neighbors_cached(adata, X[:, :3], 'X_pca', 3, k=20)
+    assert adata.add['neighbors_rep'] == 'X_pca'
+
+
+def test_gaussian_kernel_chunked():
+    from scanpy import settings as sett
+    np.random.seed(0)
+    X = np.random.randn(500, 5)
+    sigmas = np.random.rand(500) + 0.1
+    Dsq = ((X[:, None] - X[None])**2).sum(-1)
+    Den = np.add.outer(sigmas**2, sigmas**2)
+    W_dense = np.sqrt(2 * np.outer(sigmas, sigmas) / Den) * np.exp(-Dsq / Den)
+    W_dense[W_dense <= 1e-3] = 0
+    max_memory = sett.max_memory
+    sett.max_memory = 1e-4  # enforce many chunks
+    try:
+        W = data_graph.get_gaussian_kernel(X, sigmas, cutoff=1e-3)
+    finally:
+        sett.max_memory = max_memory
+    assert W.nnz == np.count_nonzero(W_dense)
+    assert np.allclose(W.toarray(), W_dense)
+
+
+def test_eigen_solvers():
+    X, _ = _noisy_spiral(1000, length=6, noise=0.03)
+    graph = data_graph.DataGraph(AnnData(X.astype('float32')), k=15, n_pcs=0)
+    graph.compute_transition_matrix()
+    graph.embed(n_evals=5, solver='arpack')
+    evals, evecs = graph.evals, graph.rbasis
+    for solver in ['lobpcg', 'randomized']:
+        for v0 in [None, evecs]:
+            graph.embed(n_evals=5, solver=solver, tol=1e-5, v0=v0)
+            assert np.allclose(graph.evals, evals, atol=1e-4)
+            overlap = np.abs(np.sum(graph.rbasis * evecs, axis=0))
+            assert np.all(overlap > 0.99)
+    # Ktilde is stored in single precision, the solvers compute in double
+    # precision
+    assert graph.Ktilde.dtype == np.float32
+    graph.embed(matrix=graph.Ktilde.astype(np.float64), n_evals=5, solver='arpack')
+    assert np.allclose(1 - evals[1:], 1 - graph.evals[1:], rtol=1e-3)
+
+
+def test_Ddiff_rows():
+    graph = _synthetic_graph(200)
+    Ddiff = data_graph.OnFlySymMatrix(graph.get_Ddiff_row, shape=(200, 200),
+                                      get_rows=graph.get_Ddiff_rows)
+    weights = np.r_[1, graph.evals[1:] / (1 - graph.evals[1:])]
+    coords = graph.rbasis * weights
+    for i in [0, 17]:
+        assert np.allclose(Ddiff[i], np.linalg.norm(coords[i] - coords, axis=1))
+    seg = np.arange(10, 50)
+    Dseg = Ddiff.restrict(seg)
+    assert np.allclose(Dseg[[3, 0]], np.array([Ddiff[13][seg], Ddiff[10][seg]]))
+    assert Dseg[3, 5] == Ddiff[13, 15]
+
+
+def test_box_tree():
+    np.random.seed(0)
+    X = np.random.randn(3000, 4)
+    tree = data_graph.BoxTree(X, leaf_size=20)
+    for Y in np.random.randn(10, 3, 4):
+        dsq = np.sum((X - Y[0])**2, axis=1)
+        i, d = tree.nearest(Y[0])
+        assert i == np.argmin(dsq) and np.isclose(d, np.sqrt(dsq.min()))
+        i, d = tree.farthest(Y[0])
+        assert i == np.argmax(dsq) and np.isclose(d, np.sqrt(dsq.max()))
+        dsum = sum(np.linalg.norm(X - y, axis=1) for y in Y)
+        i, d = tree.farthest(Y)
+        assert i == np.argmax(dsum) and np.isclose(d, dsum.max())
+
+
+def test_M_matrix():
+    from scipy.spatial.distance import pdist, squareform
+    graph = _synthetic_graph(300, sym=False)
+    M = sum(w * np.outer(graph.rbasis[:, l], graph.lbasis[:, l]) for l, w in
+            enumerate(np.r_[1, graph.evals[1:] / (1 - graph.evals[1:])]))
+    graph.compute_M_matrix()
+    graph.compute_Ddiff_matrix()
+    assert np.allclose(graph.M, M, atol=1e-6)
+    assert np.allclose(graph.Ddiff, squareform(pdist(M)), atol=1e-5)
+
+
+def test_spec_layout():
+    X, t = _noisy_spiral(500, length=4, noise=0.01)
+    graph = data_graph.DataGraph(AnnData(X), k=10, n_pcs=0)
+    Y = graph.spec_layout(normalized=True)['Y']
+    assert Y.shape == (500, 2) and abs(np.corrcoef(Y[:, 0], t)[0, 1]) > 0.95
+    Y = graph.spec_layout(normalized=False)['Y']
+    assert abs(np.corrcoef(Y[:, 0], t)[0, 1]) > 0.95
+    L = graph.L.toarray()
+    assert np.allclose(L, np.diag(graph.z) - graph.K.toarray(), atol=1e-6)
+
+
+def test_transform():
+    X, _ = _noisy_spiral(1100)
+    graph = data_graph.DataGraph(AnnData(X[:1000]), k=15, n_pcs=0)
+    graph.diffmap(n_comps=4)
+    union = data_graph.DataGraph(AnnData(X), k=15, n_pcs=0)
+    union.diffmap(n_comps=4)
+    rbasis_new = graph.transform(X[1000:])
+    for l in range(1, 4):
+        corr = np.corrcoef(rbasis_new[:, l], union.rbasis[1000:, l])[0, 1]
+        assert abs(corr) > 0.99
+    Ddiff = graph.get_Ddiff_transformed(0, rbasis_new)
+    assert abs(np.corrcoef(Ddiff, union.get_Ddiff_rows([0])[0, 1000:])[0, 1]) > 0.99
+
+
+def test_diffmap_ingest():
+    X, t = _noisy_spiral(1100)
+    # a dense reference whose PCA is not zero-centered
+    X = 1 + X.dot(np.random.randn(3, 20))
+    adata_ref = AnnData(X[:1000])
+    pp.pca(adata_ref, n_comps=5, zero_center=False)
+    assert np.all(adata_ref.var['pca_mean'] == 0)
+    tl.diffmap(adata_ref, n_comps=4, k=15, n_pcs=5)
+    # the reference cells are mapped onto themselves
+    adata_new = tl.diffmap_ingest(adata_ref, AnnData(X[:1000]), k=15, n_pcs=5,
+                                  copy=True)
+    for l in range(3):
+        corr = np.corrcoef(adata_new.smp['X_diffmap'][:, l],
+                           adata_ref.smp['X_diffmap'][:, l])[0, 1]
+        assert corr > 0.99
+    # new cells are placed by their position on the spiral
+    adata_new = tl.diffmap_ingest(adata_ref, AnnData(X[1000:]), k=15, n_pcs=5,
+                                  copy=True)
+    corr_ref = np.corrcoef(adata_ref.smp['X_diffmap'][:, 0], t[:1000])[0, 1]
+    corr_new = np.corrcoef(adata_new.smp['X_diffmap'][:, 0], t[1000:])[0, 1]
+    assert abs(corr_ref) > 0.9 and corr_new * np.sign(corr_ref) > 0.9
+
+
+def test_commute_time():
+    graph = _synthetic_graph(50)
+    K = np.random.rand(50, 50) * (np.random.rand(50, 50) < 0.3)
+    K = K + K.T
+    graph.z = K.sum(axis=1)
+    graph.evals, graph.rbasis = np.linalg.eigh(np.diag(graph.z) - K)
+    graph.lbasis = graph.rbasis
+    graph.compute_Lp_matrix()
+    Lp, volG = graph.Lp, graph.z.sum()
+    assert np.allclose(Lp, np.linalg.pinv(np.diag(graph.z) - K))
+    graph.compute_C_matrix()
+    C = volG * (np.diag(Lp)[:, None] + np.diag(Lp)[None, :] - 2 * Lp)
+    assert np.allclose(graph.C, C)
+    graph.compute_C_matrix(on_the_fly=True)
+    assert np.allclose(graph.Dchosen[[4, 2]], C[[4, 2]])
+    graph.compute_MFP_matrix()
+    i, k = 3, 8
+    assert np.isclose(graph.MFP[i, k],
+                      np.sum((Lp[i] - Lp[i, k] - Lp[k] + Lp[k, k]) * graph.z))
+
+
+def test_row_cache():
+    cache = data_graph.RowCache(max_bytes=3 * 100 * 4, dtype=np.float32)
+    for i in range(5):
+        cache.put(i, np.full(100, i, dtype=np.float64))
+    assert len(cache) == 3 and cache.n_bytes == 3 * 100 * 4
+    assert cache.get(0) is None and cache.get(2).dtype == np.float32
+    cache.put(5, np.zeros(100))  # evicts 3 as 2 was used recently
+    assert 2 in cache and 3 not in cache
+    assert cache.hits == 1 and cache.misses == 1
+
+
+def test_set_root():
+    import scipy.sparse
+    np.random.seed(0)
+    X = np.random.randn(500, 20).astype('float32')
+    for Y in [X, scipy.sparse.csr_matrix(X)]:
+        assert data_graph.get_closest_row(Y, X[123] + 1e-3) == 123
+    adata = AnnData(X)
+    adata.add['xroot'] = X[42]
+    graph = data_graph.DataGraph(adata, n_pcs=0)
+    assert graph.iroot == 42 and adata.add['iroot'] == 42
+    # a stored iroot does not override the root vector
+    adata.add['iroot'] = 7
+    assert data_graph.DataGraph(adata, n_pcs=0).iroot == 42
+
+
+def test_pseudotime_multi():
+    from scanpy import settings as sett
+    graph = _synthetic_graph(300)
+    graph.Dchosen = data_graph.OnFlySymMatrix(graph.get_Ddiff_row, shape=(300, 300))
+    max_memory = sett.max_memory
+    sett.max_memory = 1e-6  # enforce several batches
+    try:
+        pseudotime = graph.get_pseudotime_multi([5, 0, 123])
+    finally:
+        sett.max_memory = max_memory
+    for icol, iroot in enumerate([5, 0, 123]):
+        graph.iroot = iroot
+        graph.set_pseudotime()
+        assert np.allclose(pseudotime[:, icol], graph.pseudotime, atol=1e-6)
+
+
+def test_spectral():
+    X, t = _noisy_spiral(500, length=4, noise=0.01)
+    adata = AnnData(X)
+    tl.spectral(adata, k=10, n_pcs=0)
+    assert adata.smp['X_spectral'].shape == (500, 2)
+    assert abs(np.corrcoef(adata.smp['X_spectral'][:, 0], t)[0, 1]) > 0.95
+
+
+def test_dpt_pseudotime_multi():
+    X, t = _noisy_spiral(500)
+    adata = AnnData(X)
+    roots = [np.argmin(t), np.argmax(t)]
+    tl.dpt_pseudotime_multi(adata, roots, k=15, n_pcs=0)
+    pseudotime = adata.smp['dpt_pseudotime_multi']
+    assert pseudotime.shape == (500, 2)
+    assert np.array_equal(adata.add['dpt_pseudotime_multi_roots'], roots)
+    for icol, iroot in enumerate(roots):
+        assert pseudotime[iroot, icol] == 0
+        assert np.corrcoef(pseudotime[:, icol], np.abs(t - t[iroot]))[0, 1] > 0.9
@@ -0,0 +1,89 @@
+import numpy as np
+
+from scanpy.data_structs import AnnData
+from scanpy.preprocessing import simple as pp
+
+
+def test_regress_out_categorical():
+    np.random.seed(0)
+    X = np.random.rand(200, 10).astype('float32')
+    categories = np.random.choice(['a', 'b', 'c'], 200)
+    X_expected = X.copy()
+    for category in np.unique(categories):
+        mask = categories == category
+        X_expected[mask] -= X[mask].mean(axis=0)
+    adata = AnnData(X, smp={'batch': categories})
+    pp.regress_out(adata, 'batch')
+    assert np.allclose(adata.X, X_expected, atol=1e-6)
+
+
+def test_pipeline_zheng17():
+    from scanpy.preprocessing import Pipeline
+    np.random.seed(0)
+    X = np.random.negative_binomial(1, 0.3, (300, 100)).astype('float32')
+    X[:, :5] = 0  # genes without counts
+    X[:2] = 0  # cells without counts
+    adata_expected = AnnData(X.copy())
+    pp.filter_genes(adata_expected, min_counts=1)
+    pp.normalize_per_cell(adata_expected)
+    result = pp.filter_genes_dispersion(adata_expected.X, flavor='cell_ranger',
+                                        n_top_genes=20, log=False)
+    adata_expected.inplace_subset_var(result.gene_subset)
+    pp.normalize_per_cell(adata_expected)
+    pp.log1p(adata_expected)
+    pp.scale(adata_expected)
+    adata = AnnData(X)
+    pipe = (Pipeline(len_chunk=64)
+            .filter_genes(min_counts=1)
+            .normalize_per_cell()
+            .filter_genes_dispersion(flavor='cell_ranger', n_top_genes=20, log=False)
+            .normalize_per_cell()
+            .log1p()
+            .scale())
+    pipe.run(adata)
+    assert np.array_equal(adata.var_names, adata_expected.var_names)
+    assert np.array_equal(adata.smp_names, adata_expected.smp_names)
+    assert np.allclose(adata.X, adata_expected.X, atol=1e-4)
+
+
+def test_filter_genes_dispersion_chunked(tmpdir):
+    import h5py
+    np.random.seed(0)
+    X = np.random.negative_binomial(1, 0.3, (300, 50)).astype('float32')
+    result = pp.filter_genes_dispersion(X, n_top_genes=10)
+    result_chunks = pp.filter_genes_dispersion((X[i:i+64] for i in range(0, 300, 64)),
+                                               n_top_genes=10)
+    with h5py.File(str(tmpdir.join('X.h5')), 'w') as f:
+        f['X'] = X
+        result_h5 = pp.filter_genes_dispersion(f['X'], n_top_genes=10)
+    for r in [result_chunks, result_h5]:
+        assert np.array_equal(r.gene_subset, result.gene_subset)
+        assert np.allclose(r.dispersions_norm, result.dispersions_norm, equal_nan=True)
+
+
+def test_copy_inplace():
+    import pytest
+    from scipy.sparse import csr_matrix
+    np.random.seed(0)
+    X = np.random.negative_binomial(1, 0.3, (100, 20))
+    X_float = X.astype('float32')
+    for func in [pp.log1p, pp.normalize_per_cell, pp.scale]:
+        X_new = func(X_float, copy=True)
+        assert X_new.dtype == np.float32 and not np.shares_memory(X_new, X_float)
+        X_inplace = X_float.copy()
+        assert func(X_inplace) is None and np.allclose(X_inplace, X_new)
+        with pytest.raises(ValueError):
+            func(X.copy())
+    for func in [pp.normalize_per_cell_weinreb16, pp.zscore_deprecated]:
+        X_new = func(X_float)
+        X_inplace = X_float.copy()
+        assert func(X_inplace, copy=False) is None and np.allclose(X_inplace, X_new)
+    # an AnnData with integer counts is assigned a new matrix
+    adata = AnnData(X.copy())
+    pp.log1p(adata)
+    assert np.allclose(adata.X, np.log1p(X))
+    # pca centers its own dense copy of sparse input
+    X_sparse = csr_matrix(X_float)
+    assert np.allclose(np.abs(pp.pca(X_sparse, n_comps=3)),
+                       np.abs(pp.pca(X_float, n_comps=3)), atol=1e-4)
+    assert np.array_equal(X_sparse.toarray(), X_float)
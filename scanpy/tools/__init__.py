@@ -5,11 +5,13 @@ The user only sees convenience functions.
 
 # order alphabetically
 from .dbscan import dbscan
-from .diffmap import diffmap
+from .diffmap import diffmap, diffmap_ingest
 from .diffrank import diffrank
-from .dpt import dpt
+from .dpt import dpt, dpt_pseudotime_multi
+from .neighbors import neighbors
 from .pca import pca
 from .sim import sim
+from .spectral import spectral
 from .spring import spring
 from .tsne import tsne
 
@@ -5,8 +5,11 @@ Using the scikit-learn implementation.
 """
 
 import numpy as np
+import scipy as sp
+import scipy.sparse
 from .. import settings as sett
 from .. import logging as logg
+from ..data_structs import data_graph
 
 def dbscan(adata, basis='tsne', n_comps=2, eps=None, min_samples=None, n_jobs=None, copy=False):
     """Cluster cells using DBSCAN
@@ -67,10 +70,14 @@ def dbscan(adata, basis='tsne', n_comps=2, eps=None, min_samples=None, n_jobs=No
     logg.m('increase `min_samples` if you find too many clusters', v='hint')
     logg.m('reduce eps if "everything is connected"', v='hint')
     from sklearn.cluster import DBSCAN
-    from sklearn.neighbors import NearestNeighbors
-    nn = NearestNeighbors(n_neighbors=min_samples, n_jobs=n_jobs)
-    nn.fit(X)
-    D = nn.radius_neighbors_graph(radius=eps, mode='distance')
+    # tl.neighbors only stores neighbors of X_pca, not of X_tsne
+    D = (_get_radius_neighbors_graph_cached(adata, X, 'X_pca', n_comps, eps)
+         if basis == 'pca' else None)
+    if D is None:
+        from sklearn.neighbors import NearestNeighbors
+        nn = NearestNeighbors(n_neighbors=min_samples, n_jobs=n_jobs)
+        nn.fit(X)
+        D = nn.radius_neighbors_graph(radius=eps, mode='distance')
     db = DBSCAN(eps=eps, min_samples=min_samples,
                 n_jobs=n_jobs, metric='precomputed').fit(D)
     labels = db.labels_
@@ -86,3 +93,26 @@ def dbscan(adata, basis='tsne', n_comps=2, eps=None, min_samples=None, n_jobs=No
            '    "dbscan_groups", the cluster labels (adata.smp)\n'
            '    "dbscan_groups_names", the unique cluster labels (adata.add)')
     return adata if copy else None
+
+
+def _get_radius_neighbors_graph_cached(adata, X, rep, n_comps, eps):
+    """Radius neighbors graph from the neighbors stored in adata.add.
+
+    Only possible if the stored neighbors were computed by an exact method
+    and if for every point, all points within eps are among the stored
+    neighbors, that is, if the farthest stored neighbor is beyond eps.
+    Returns None otherwise.
+    """
+    if 'neighbors_k' not in adata.add: return None
+    # method 'auto' only matches neighbors computed by an exact method
+    result = data_graph.get_neighbors_from_cache(adata, X, rep, n_comps,
+                                                 int(adata.add['neighbors_k']),
+                                                 method='auto')
+    if result is None: return None
+    indices, distances = result
+    if np.any(distances[:, -1] <= eps**2): return None
+    logg.m('... using the neighbors stored in adata.add')
+    mask = distances <= eps**2
+    rows = np.repeat(np.arange(X.shape[0]), indices.shape[1])[mask.ravel()]
+    return sp.sparse.csr_matrix((np.sqrt(distances[mask]), (rows, indices[mask])),
+                                shape=(X.shape[0], X.shape[0]))
@@ -2,11 +2,15 @@
 """Diffusion Maps
 """
 
+import numpy as np
+from scipy.sparse import issparse
 from ..tools import dpt
 from .. import logging as logg
+from ..data_structs import data_graph
 
 def diffmap(adata, n_comps=15, k=30, knn=True, n_pcs=50, sigma=0, n_jobs=None,
-            flavor='haghverdi16', copy=False):
+            flavor='haghverdi16', eigen_solver='arpack', eigen_tol=None,
+            warm_start=True, copy=False):
     """Diffusion Maps
 
     Visualize data using Diffusion Maps.
@@ -45,7 +49,15 @@ def diffmap(adata, n_comps=15, k=30, knn=True, n_pcs=50, sigma=0, n_jobs=None,
         If greater 0, ignore parameter 'k', but directly set a global width
         of the Kernel Gaussian (method 'global').
     n_jobs : int or None
-        Number of CPUs to use (default: sett.n_cpus).
+        Number of CPUs to use (default: sett.n_jobs).
+    eigen_solver : {'arpack', 'lobpcg', 'randomized'}, optional (default: 'arpack')
+        Solver for the eigendecomposition, see `data_graph.eigen_solvers`.
+    eigen_tol : float or None, optional (default: None)
+        Tolerance of the eigen solver, None uses its default.
+    warm_start : bool, optional (default: True)
+        Use a previously computed adata.smp['X_diffmap'] as initial guess for
+        the eigenvectors. Speeds up recomputing after small changes of the
+        graph, in particular with 'lobpcg'.
     copy : bool (default: False)
         Return a copy instead of writing to adata.
 
@@ -62,7 +74,9 @@ def diffmap(adata, n_comps=15, k=30, knn=True, n_pcs=50, sigma=0, n_jobs=None,
     """
     adata = adata.copy() if copy else adata
     dmap = dpt.DPT(adata, k=k, knn=knn, n_pcs=n_pcs,
-                   n_jobs=n_jobs, recompute_diffmap=True, flavor=flavor)
+                   n_jobs=n_jobs, recompute_diffmap=True, flavor=flavor,
+                   eigen_solver=eigen_solver, eigen_tol=eigen_tol,
+                   warm_start=warm_start)
     ddmap = dmap.diffmap(n_comps=n_comps)
     adata.smp['X_diffmap'] = ddmap['X_diffmap']
     adata.smp['X_diffmap0'] = dmap.rbasis[:, 0]
@@ -73,3 +87,70 @@ def diffmap(adata, n_comps=15, k=30, knn=True, n_pcs=50, sigma=0, n_jobs=None,
            '    the data representation "X_diffmap" (adata.smp),\n'
            '    the eigen values of the transition matrix "diffmap_evals" (adata.add)')
     return adata if copy else None
+
+
+def diffmap_ingest(adata_ref, adata_new, k=30, knn=True, n_pcs=50, n_jobs=None,
+                   copy=False):
+    """Embed new cells into the Diffusion Map of reference cells.
+
+    Uses the Nyström extension, that is, the kernel of the reference is
+    extended to the new cells, which are then projected on the eigenbasis of
+    the reference. Neither the neighbors nor the eigendecomposition of the
+    reference are recomputed, hence, ingesting a batch of new cells scales
+    linearly with its size.
+
+    Parameters
+    ----------
+    adata_ref : AnnData
+        Reference with a Diffusion Map computed by `diffmap` or `dpt`.
+    adata_new : AnnData
+        New cells with the same variables as adata_ref.
+    k, knn, n_pcs : see `diffmap`
+        Need to be the same as for computing the Diffusion Map of adata_ref.
+    n_jobs : int or None
+        Number of CPUs to use (default: sett.n_jobs).
+    copy : bool (default: False)
+        Return a copy of adata_new instead of writing to it.
+
+    Notes
+    -----
+    The following is added to adata_new.smp
+        X_diffmap, X_diffmap0 : np.ndarray
+            As for `diffmap`, in the Diffusion Map of the reference.
+        dpt_pseudotime : np.ndarray
+            If adata_ref stores it, the pseudotime with respect to the root
+            cell of the reference, in the same units, hence, it might exceed 1
+            for cells beyond the range of the reference.
+    """
+    logg.m('ingest new cells into Diffusion Map', r=True)
+    adata_new = adata_new.copy() if copy else adata_new
+    if 'X_diffmap' not in adata_ref.smp:
+        raise ValueError('Run `diffmap` or `dpt` on `adata_ref` first.')
+    graph = data_graph.DataGraph(adata_ref, k=k, knn=knn, n_pcs=n_pcs, n_jobs=n_jobs)
+    if graph.rep[0] == 'X':
+        X_new = adata_new.X.toarray() if issparse(adata_new.X) else adata_new.X
+    else:
+        # project on the principal components of the reference after
+        # subtracting the mean that pca subtracted from the reference
+        logg.m('... projecting on the PCs of the reference')
+        PCs = np.array([adata_ref.var['PC' + str(i + 1)] for i in range(n_pcs)])
+        X_new = np.asarray(adata_new.X.dot(PCs.T))
+        if 'pca_mean' in adata_ref.var:
+            X_new -= np.asarray(adata_ref.var['pca_mean']).dot(PCs.T)
+        elif not issparse(adata_ref.X):
+            # X_pca predates storing the mean, pca zero-centers dense data by default
+            X_new -= np.asarray(adata_ref.X.mean(axis=0)).dot(PCs.T)
+    rbasis_new = graph.transform(X_new)
+    adata_new.smp['X_diffmap'] = rbasis_new[:, 1:]
+    adata_new.smp['X_diffmap0'] = rbasis_new[:, 0]
+    has_pseudotime = 'dpt_pseudotime' in adata_ref.smp and 'iroot' in adata_ref.add
+    if has_pseudotime:
+        iroot = int(adata_ref.add['iroot'])
+        pseudotime = graph.get_Ddiff_transformed(iroot, rbasis_new)
+        adata_new.smp['dpt_pseudotime'] = pseudotime / np.max(graph.get_Ddiff_row(iroot))
+    logg.m('finished', t=True, end=' ')
+    logg.m('and added\n'
+           '    the data representation "X_diffmap" (adata_new.smp)'
+           + (',\n    "dpt_pseudotime" (adata_new.smp)'
+              if has_pseudotime else ''))
+    return adata_new if copy else None
@@ -6,13 +6,16 @@ import sys
 import numpy as np
 import scipy as sp
 import scipy.sparse
+import scipy.spatial
 from .. import logging as logg
+from .. import parallel
 from ..data_structs import data_graph
 
 
-def dpt(adata, n_branchings=0, k=30, knn=True, n_pcs=50, n_pcs_post=30, n_dcs=10,
+def dpt(adata, n_branchings=0, k=30, knn=True, n_pcs=50, n_pcs_post=None, n_dcs=10,
         allow_branching_at_root=False, n_jobs=None, recompute_diffmap=False,
-        recompute_pca=False, flavor='haghverdi16', copy=False):
+        recompute_pca=False, flavor='haghverdi16', eigen_solver='arpack',
+        eigen_tol=None, n_landmarks=None, resume=False, copy=False):
     """Hierarchical Diffusion Pseudotime
 
     Infer progression of cells, identify branching subgroups.
@@ -56,10 +59,10 @@ def dpt(adata, n_branchings=0, k=30, knn=True, n_pcs=50, n_pcs_post=30, n_dcs=10
         Use n_pcs PCs to compute the Euclidian distance matrix, which is the
         basis for generating the graph. Set to 0 if you don't want preprocessing
         with PCA.
-    n_pcs_post: int, optional (default: 30)
-        Use n_pcs_post PCs to compute the DPT distance matrix. This speeds up
-        the computation at almost no loss of accuracy. Set to 0 if you don't
-        want postprocessing with PCA.
+    n_pcs_post: int or None, optional (default: None)
+        Deprecated and ignored. The DPT distance is computed in the basis of
+        the diffusion components, which is already low-dimensional, there is
+        no postprocessing with PCA.
     allow_branching_at_root : bool, optional (default: False)
         Allow to have branching directly at root point.
     n_jobs : int or None (default: None)
@@ -68,6 +71,23 @@ def dpt(adata, n_branchings=0, k=30, knn=True, n_pcs=50, n_pcs_post=30, n_dcs=10
         Recompute diffusion maps.
     recompute_pca : bool, (default: False)
         Recompute PCA.
+    eigen_solver : {'arpack', 'lobpcg', 'randomized'}, optional (default: 'arpack')
+        Solver for the eigendecomposition if diffusion maps are computed, see
+        `data_graph.eigen_solvers`. A stored adata.smp['X_diffmap'] serves as
+        initial guess when recomputing.
+    eigen_tol : float or None, optional (default: None)
+        Tolerance of the eigen solver, None uses its default.
+    n_landmarks : int or None, optional (default: None)
+        Detect branchings only on this number of landmarks, chosen by farthest
+        point sampling in the DPT distance, and assign the remaining cells to
+        the segments of their nearest landmarks. Use this for very large data
+        sets, say, above 100 000 cells. The pseudotime is computed for all
+        cells.
+    resume : bool, optional (default: False)
+        Continue from the branchings of a previous call, which are stored in
+        adata.add after each branching, if they were computed for the same
+        Diffusion Map and root cell. For instance, increasing `n_branchings`
+        by one then only computes a single branching.
     copy : bool, optional (default: False)
         Copy instance before computation and return a copy. Otherwise, perform
         computation inplace and return None.
@@ -89,6 +109,8 @@ def dpt(adata, n_branchings=0, k=30, knn=True, n_pcs=50, n_pcs_post=30, n_dcs=10
             basis of the transition matrix with eigenvectors as columns.
         dpt_evals : np.ndarray
             Array of size (number of eigen vectors). Eigenvalues of transition matrix.
+        dpt_branching_* : np.ndarray
+            State of the detection of branchings, see parameter `resume`.
     """
     adata = adata.copy() if copy else adata
     if 'xroot' not in adata.add and 'xroot' not in adata.var:
@@ -107,7 +129,8 @@ def dpt(adata, n_branchings=0, k=30, knn=True, n_pcs=50, n_pcs_post=30, n_dcs=10
               n_jobs=n_jobs, recompute_diffmap=recompute_diffmap,
               recompute_pca=recompute_pca,
               n_branchings=n_branchings, allow_branching_at_root=allow_branching_at_root,
-              flavor=flavor)
+              flavor=flavor, eigen_solver=eigen_solver, eigen_tol=eigen_tol,
+              n_landmarks=n_landmarks, resume=resume)
     # diffusion map
     ddmap = dpt.diffmap(n_comps=n_dcs)
     adata.smp['X_diffmap'] = ddmap['X_diffmap']
@@ -145,13 +168,69 @@ def dpt(adata, n_branchings=0, k=30, knn=True, n_pcs=50, n_pcs_post=30, n_dcs=10
     # adata.add['dpt_groupconnects'] = dpt.segs_connects
     # the tree/graph adjacency matrix
     adata.add['dpt_groups_adjacency'] = dpt.segs_adjacency
+    if dpt.landmarks is not None: adata.add['dpt_landmarks'] = dpt.landmarks
     logg.m('finished', t=True, end=' ')
     logg.m('and added\n'
            '    "dpt_pseudotime", stores pseudotime (adata.smp),\n'
            '    "dpt_groups", the segments of trajectories a long a tree (adata.smp),\n'
            '    "dpt_groups_adjacency", the adjacency matrix between segments that defines the tree (adata.add),\n'
            '    "dpt_order", is an index array for sorting the cells (adata.smp),\n'
-           '    "dpt_grouptips", stores the indices of tip cells (adata.add)')
+           '    "dpt_grouptips", stores the indices of tip cells (adata.add)'
+           + (',\n    "dpt_branching_*", the state of the branching detection for `resume` (adata.add)'
+              if n_branchings > 0 else ''))
+    return adata if copy else None
+
+
+def dpt_pseudotime_multi(adata, roots, k=30, knn=True, n_pcs=50, n_dcs=10,
+                         n_jobs=None, recompute_diffmap=False, copy=False):
+    """Diffusion Pseudotime with respect to several root cells
+
+    Computes the pseudotime for all roots at once, reusing the Diffusion Map
+    stored in adata, for instance, to compare alternative root cells or to
+    compute the pseudotime from each terminal state.
+
+    Parameters
+    ----------
+    adata : AnnData
+        Annotated data matrix, optionally with a Diffusion Map computed by
+        `diffmap` or `dpt`.
+    roots : list of int or str
+        Indices or names of the root cells.
+    k, knn, n_pcs, n_dcs, n_jobs, recompute_diffmap : see `dpt`
+        Only used if the Diffusion Map is (re)computed.
+    copy : bool, optional (default: False)
+        Copy instance before computation and return a copy. Otherwise, perform
+        computation inplace and return None.
+
+    Notes
+    -----
+    Writes the following to adata.smp
+        dpt_pseudotime_multi : np.ndarray
+            Array of shape (number of samples) x (number of roots), each
+            column is the pseudotime with respect to a root cell.
+    Writes the following to adata.add
+        dpt_pseudotime_multi_roots : np.ndarray
+            Indices of the root cells.
+    """
+    logg.m('compute pseudotime for', len(roots), 'roots', r=True)
+    adata = adata.copy() if copy else adata
+    smp_names = np.asarray(adata.smp_names)
+    iroots = np.array([np.flatnonzero(smp_names == root)[0]
+                       if isinstance(root, str) else root
+                       for root in roots], dtype=int)
+    graph = data_graph.DataGraph(adata, k=k, knn=knn, n_pcs=n_pcs, n_jobs=n_jobs,
+                                 recompute_diffmap=recompute_diffmap)
+    if graph.evals is None:
+        ddmap = graph.diffmap(n_comps=n_dcs)
+        adata.smp['X_diffmap'] = ddmap['X_diffmap']
+        adata.smp['X_diffmap0'] = graph.rbasis[:, 0]
+        adata.add['diffmap_evals'] = ddmap['evals']
+        if knn: adata.add['distance'] = graph.Dsq
+    adata.smp['dpt_pseudotime_multi'] = graph.get_pseudotime_multi(iroots)
+    adata.add['dpt_pseudotime_multi_roots'] = iroots
+    logg.m('finished', t=True, end=' ')
+    logg.m('and added\n'
+           '    "dpt_pseudotime_multi", stores pseudotime for each root (adata.smp)')
     return adata if copy else None
 
 
@@ -160,18 +239,29 @@ class DPT(data_graph.DataGraph):
     """
 
     def __init__(self, adata_or_X, k=30, knn=True,
-                 n_jobs=1, n_pcs=50, n_pcs_post=30,
+                 n_jobs=1, n_pcs=50, n_pcs_post=None,
                  recompute_pca=None,
                  recompute_diffmap=None, n_branchings=0,
-                 allow_branching_at_root=False, flavor='haghverdi16'):
+                 allow_branching_at_root=False, flavor='haghverdi16',
+                 neighbors_method='auto', neighbors_params=None,
+                 eigen_solver='arpack', eigen_tol=None, warm_start=True,
+                 n_landmarks=None, resume=False):
         super(DPT, self).__init__(adata_or_X, k=k, knn=knn, n_pcs=n_pcs,
                                   n_pcs_post=n_pcs_post, n_jobs=n_jobs,
                                   recompute_pca=recompute_pca,
                                   recompute_diffmap=recompute_diffmap,
-                                  flavor=flavor)
+                                  flavor=flavor,
+                                  neighbors_method=neighbors_method,
+                                  neighbors_params=neighbors_params,
+                                  eigen_solver=eigen_solver,
+                                  eigen_tol=eigen_tol,
+                                  warm_start=warm_start)
         self.n_branchings = n_branchings
         self.min_group_size = 50
         self.allow_branching_at_root = allow_branching_at_root
+        self.n_landmarks = n_landmarks
+        self.landmarks = None
+        self.resume = resume
 
     def branchings_segments(self):
         """Detect branchings and partition the data into corresponding segments.
@@ -192,13 +282,102 @@ class DPT(data_graph.DataGraph):
         """
         # logg.m('weights', self.evals[1:]/(1-self.evals[1:]))
         # logg.m('evals', self.evals[1:])
-        self.detect_branchings()
-        self.check_segments()
-        self.postprocess_segments()
-        # self.order_segments()
-        self.set_segs_names()
+        if self.n_landmarks is not None and self.n_landmarks < self.X.shape[0]:
+            self.branchings_segments_landmarks()
+        else:
+            self.detect_branchings()
+            self.check_segments()
+            self.postprocess_segments()
+            # self.order_segments()
+            self.set_segs_names()
         self.order_pseudotime()
 
+    def branchings_segments_landmarks(self, n_neighbors=5):
+        """Detect branchings on landmarks and assign all points to segments.
+
+        Branchings are detected on `n_landmarks` landmarks chosen by
+        `select_landmarks`. Each data point is then assigned to a segment by
+        a vote of its `n_neighbors` nearest landmarks in the DPT distance,
+        weighted with the inverse distance. The pseudotime is not affected,
+        it is computed for all data points.
+
+        Writes the same attributes as `branchings_segments`, and
+        landmarks : np.ndarray
+            Indices of the landmarks.
+        """
+        self.landmarks = self.select_landmarks(self.n_landmarks)
+        graph = self._restrict_to(self.landmarks)
+        graph.detect_branchings()
+        graph.check_segments()
+        graph.postprocess_segments()
+        graph.set_segs_names()
+        # query a tree of the landmarks in the weighted eigenbasis
+        comps, weights, lcoords, _ = self._get_Ddiff_coords(0, self.evals.size)
+        tree = sp.spatial.cKDTree(lcoords[self.landmarks])
+        n_neighbors = min(n_neighbors, self.landmarks.size)
+        votes = np.zeros((self.X.shape[0], len(graph.segs)))
+        for chunk in np.array_split(np.arange(self.X.shape[0]),
+                                    max(self.X.shape[0] // 100000, 1)):
+            dists, neighbors = tree.query(self.rbasis[chunk][:, comps] * weights,
+                                          k=n_neighbors)
+            dists, neighbors = dists.reshape(chunk.size, -1), neighbors.reshape(chunk.size, -1)
+            np.add.at(votes, (np.repeat(chunk, neighbors.shape[1]),
+                              graph.segs_names[neighbors].ravel()),
+                      1 / (dists.ravel() + 1e-12))
+        segs_names = np.argmax(votes, axis=1).astype(graph.segs_names.dtype)
+        # landmarks keep their labels
+        segs_names[self.landmarks] = graph.segs_names
+        self.segs_names = segs_names
+        self.segs_names_unique = graph.segs_names_unique
+        self.segs = np.array([segs_names == iseg for iseg in range(len(graph.segs))])
+        # map tips and connecting points to global indices
+        self.segs_tips = _map_to(self.landmarks, graph.segs_tips)
+        self.segs_connects = [list(_map_to(self.landmarks, connects))
+                              for connects in graph.segs_connects]
+        self.segs_undecided = graph.segs_undecided
+        self.segs_adjacency = graph.segs_adjacency
+        logg.m('... assigned all points to segments of {} landmarks'
+               .format(self.landmarks.size), t=True)
+
+    def select_landmarks(self, n_landmarks):
+        """Select landmarks by farthest point sampling in the DPT distance.
+
+        Starting from the root, iteratively add the point that is most
+        distant to all previous landmarks. Requires one row of the distance
+        matrix per landmark, no rows are stored.
+
+        Returns
+        -------
+        landmarks : np.ndarray
+            Indices of the landmarks, the first one is `iroot`.
+        """
+        landmarks = np.zeros(n_landmarks, dtype=int)
+        landmarks[0] = self.iroot
+        dist = self.get_Ddiff_row(self.iroot)
+        for i in range(1, n_landmarks):
+            landmarks[i] = np.argmax(dist)
+            np.minimum(dist, self.get_Ddiff_row(landmarks[i]), out=dist)
+        logg.m('... selected', n_landmarks, 'landmarks', t=True)
+        return landmarks
+
+    def _restrict_to(self, indices):
+        """Return a DPT instance that only sees the points in indices."""
+        graph = DPT.__new__(DPT)
+        graph.__dict__.update(self.__dict__)
+        graph.X = self.X[indices]
+        graph.rbasis = self.rbasis[indices]
+        graph.lbasis = self.lbasis[indices]
+        graph.pseudotime = self.pseudotime[indices]
+        graph.iroot = np.flatnonzero(indices == self.iroot)[0]
+        # do not share cached coordinates and distance rows
+        graph.__dict__.pop('_Ddiff_coords', None)
+        graph.__dict__.pop('_Ddiff_trees', None)
+        graph.__dict__.pop('_neighbors_index', None)
+        graph.Dchosen = data_graph.OnFlySymMatrix(graph.get_Ddiff_row,
+                                                  shape=(indices.size, indices.size),
+                                                  get_rows=graph.get_Ddiff_rows)
+        return graph
+
     def detect_branchings(self):
         """Detect all branchings up to `n_branchings`.
 
@@ -208,6 +387,10 @@ class DPT(data_graph.DataGraph):
             List of integer index arrays.
         segs_tips : np.ndarray
             List of indices of the tips of segments.
+        cells_seg : np.ndarray
+            Index of the segment of each data point.
+        cells_pos : np.ndarray
+            Position of each data point within the index array of its segment.
         """
         logg.m('... detect', self.n_branchings,
                'branching' + ('' if self.n_branchings == 1 else 's'))
@@ -219,6 +402,10 @@ class DPT(data_graph.DataGraph):
         # let's keep a list of segments, the first segment to add is the
         # whole data set
         segs = [indices_all]
+        # the segments partition the data, hence, two arrays suffice to map
+        # global indices to segments and to positions within segments
+        self.cells_seg = np.zeros(self.X.shape[0], dtype=int)
+        self.cells_pos = indices_all.copy()
         # a segment can as well be defined by the two points that have maximal
         # distance in the segment, the "tips" of the segment
         #
@@ -240,6 +427,10 @@ class DPT(data_graph.DataGraph):
         # let us define the tips of the whole data set
         if False:  # this is safe, but not compatible with on-the-fly computation
             tips_all = np.array(np.unravel_index(np.argmax(self.Dchosen), self.Dchosen.shape))
+        elif self._uses_Ddiff_tree(self.Dchosen):
+            tip_0 = self.get_Ddiff_extreme(self.iroot, indices_all, farthest=True)[0]
+            tips_all = np.array([tip_0, self.get_Ddiff_extreme(tip_0, indices_all,
+                                                               farthest=True)[0]])
         else:
             tip_0 = np.argmax(self.Dchosen[self.iroot])
             tips_all = np.array([tip_0, np.argmax(self.Dchosen[tip_0])])
@@ -248,9 +439,20 @@ class DPT(data_graph.DataGraph):
         segs_connects = [[]]
         segs_undecided = [True]
         segs_adjacency = [[]]
+        n_done = 0
+        state = self._load_branching_state() if self.resume else None
+        if state is not None and state[0] > self.n_branchings:
+            logg.m('... stored state has more than', self.n_branchings,
+                   'branchings, start from scratch')
+        elif state is not None:
+            n_done, segs, segs_tips, segs_connects, segs_undecided, segs_adjacency = state
+            for iseg, seg in enumerate(segs):
+                self.cells_seg[seg] = iseg
+                self.cells_pos[seg] = np.arange(seg.size)
+            logg.m('... resume after', n_done, 'branchings stored in adata.add')
         logg.m('... do not consider groups with less than {} points for splitting'
                .format(self.min_group_size))
-        for ibranch in range(self.n_branchings):
+        for ibranch in range(n_done, self.n_branchings):
             # this is dangerous!
             # make sure that in each iteration the correct Dchosen
             # is used, also, Dchosen saves elements...,
@@ -274,6 +476,9 @@ class DPT(data_graph.DataGraph):
                                   segs_connects,
                                   segs_undecided,
                                   segs_adjacency, iseg, tips3)
+            # checkpoint, so that we can resume from here
+            self._save_branching_state(ibranch + 1, segs, segs_tips, segs_connects,
+                                       segs_undecided, segs_adjacency)
         # get back to what we had in the beginning
         # self.Dchosen = data_graph.OnFlySymMatrix(self.get_Ddiff_row,
         #                                          shape=self.Dchosen.shape)
@@ -288,6 +493,66 @@ class DPT(data_graph.DataGraph):
         for i, seg_adjacency in enumerate(segs_adjacency):
             self.segs_adjacency[i, seg_adjacency] = 1
         self.segs_adjacency = self.segs_adjacency.tocsr()
+        if isinstance(self.Dchosen, data_graph.OnFlySymMatrix):
+            rows = self.Dchosen.rows
+            logg.m('... distance rows: {} cache hits, {} misses, {} rows stored ({:.1f} MB)'
+                   .format(rows.hits, rows.misses, len(rows), rows.n_bytes / 2**20), v=4)
+
+    def _uses_Ddiff_tree(self, D):
+        """Whether D stores DPT distances over all diffusion components, so
+        that nearest and farthest points are found via `get_Ddiff_tree`
+        instead of rows of D.
+        """
+        return (isinstance(D, data_graph.OnFlySymMatrix)
+                and D.get_rows == self.get_Ddiff_rows
+                and D.DC_start == 0 and D.DC_end == -1)
+
+    def _branching_fingerprint(self):
+        """Identify the diffusion map and root a branching state refers to."""
+        return data_graph._fingerprint(self.rbasis) + str(self.iroot)
+
+    def _save_branching_state(self, n_done, segs, segs_tips, segs_connects,
+                              segs_undecided, segs_adjacency):
+        """Store the state of `detect_branchings` in adata.add."""
+        if self.adata is None: return
+        add = self.adata.add
+        add['dpt_branching_fingerprint'] = self._branching_fingerprint()
+        add['dpt_branching_n'] = n_done
+        # the segments partition the data, store them as a single array
+        add['dpt_branching_segs'] = np.concatenate(segs)
+        add['dpt_branching_segs_sizes'] = np.array([len(seg) for seg in segs])
+        add['dpt_branching_segs_tips'] = np.array(segs_tips, dtype=int)
+        add['dpt_branching_segs_undecided'] = np.array(segs_undecided)
+        # the adjacency lists and the connecting points as a list of edges
+        add['dpt_branching_edges'] = np.array(
+            [[iseg, jseg, connect] for iseg in range(len(segs))
+             for jseg, connect in zip(segs_adjacency[iseg], segs_connects[iseg])],
+            dtype=int).reshape(-1, 3)
+
+    def _load_branching_state(self):
+        """Return the state stored by `_save_branching_state` or None.
+
+        The state is only returned if it refers to the same diffusion map and
+        root.
+        """
+        add = self.adata.add if self.adata is not None else {}
+        if ('dpt_branching_fingerprint' not in add
+            or (data_graph._to_str(add['dpt_branching_fingerprint'])
+                != self._branching_fingerprint())):
+            return None
+        sizes = add['dpt_branching_segs_sizes']
+        segs = np.split(np.asarray(add['dpt_branching_segs'], dtype=int),
+                        np.cumsum(sizes)[:-1])
+        segs_tips = list(np.asarray(add['dpt_branching_segs_tips'], dtype=int))
+        segs_undecided = [bool(undecided) for undecided
+                          in add['dpt_branching_segs_undecided']]
+        segs_adjacency = [[] for seg in segs]
+        segs_connects = [[] for seg in segs]
+        for iseg, jseg, connect in add['dpt_branching_edges']:
+            segs_adjacency[iseg].append(int(jseg))
+            segs_connects[iseg].append(int(connect))
+        return (int(add['dpt_branching_n']), segs, segs_tips, segs_connects,
+                segs_undecided, segs_adjacency)
 
     def select_segment(self, segs, segs_tips, segs_undecided):
         """Out of a list of line segments, choose segment that has the most
@@ -304,63 +569,106 @@ class DPT(data_graph.DataGraph):
             Positions of tips within chosen segment.
         """
         scores_tips = np.zeros((len(segs), 4))
-        allindices = np.arange(self.X.shape[0], dtype=int)
-        for iseg, seg in enumerate(segs):
-            # do not consider too small segments
-            if segs_tips[iseg][0] == -1: continue
+        if (isinstance(self.Dchosen, data_graph.OnFlySymMatrix)
+            and not self._uses_Ddiff_tree(self.Dchosen)):
+            # compute the rows of all tips in a single batch
+            tips_all = np.ravel(segs_tips)
+            self.Dchosen.fetch(tips_all[tips_all >= 0])
+        # segments are scored independently, in threads if n_jobs > 1
+        results = parallel.run(self._score_segment,
+                               [(iseg, segs, segs_tips, segs_undecided)
+                                for iseg in range(len(segs))],
+                               n_jobs=self.n_jobs, backend='threading')
+        for iseg, result in enumerate(results):
+            if result is None: continue
+            # write result
+            scores_tips[iseg, 0] = result[0]
+            scores_tips[iseg, 1:] = result[1]
+        iseg = np.argmax(scores_tips[:, 0])
+        tips3 = scores_tips[iseg, 1:].astype(int)
+        return iseg, tips3
+
+    def _score_segment(self, iseg, segs, segs_tips, segs_undecided):
+        """Score a segment for being split, see `select_segment`.
+
+        Returns
+        -------
+        score : float
+            Added distance of the third tip to the first two tips, normalized
+            by the distance between the first two tips.
+        tips3 : np.ndarray
+            Positions of tips within the segment. None is returned instead of
+            (score, tips3) if the segment has no tips.
+        """
+        seg = segs[iseg]
+        # do not consider too small segments
+        if segs_tips[iseg][0] == -1: return None
+        if self._uses_Ddiff_tree(self.Dchosen):
+            # query the tree of the segment in the weighted eigenbasis
+            lcoords = self._get_Ddiff_coords(0, self.evals.size)[2]
+            tree = self.get_Ddiff_tree(seg)
+
+            def dist(i, j):
+                return np.linalg.norm(lcoords[i] - lcoords[j])
+
+            def argfarthest(tips):
+                return tree.farthest(tree.X[tips])[0]
+        else:
             # restrict distance matrix to points in segment
             if not isinstance(self.Dchosen, data_graph.OnFlySymMatrix):
                 Dseg = self.Dchosen[np.ix_(seg, seg)]
             else:
                 Dseg = self.Dchosen.restrict(seg)
-            third_maximizer = None
-            if segs_undecided[iseg]:
-                # check that none of our tips "connects" with a tip of the
-                # other segments
-                for jseg in range(len(segs)):
-                    if jseg != iseg:
-                        # take the inner tip, the "second tip" of the segment
-                        for itip in range(2):
-                            if (self.Dchosen[segs_tips[jseg][1], segs_tips[iseg][itip]]
-                                < 0.5 * self.Dchosen[segs_tips[iseg][~itip], segs_tips[iseg][itip]]):
-                                # logg.m('... group', iseg, 'with tip', segs_tips[iseg][itip],
-                                #        'connects with', jseg, 'with tip', segs_tips[jseg][1], v=4)
-                                # logg.m('    do not use the tip for "triangulation"', v=4)
-                                third_maximizer = itip
-            # map the global position to the position within the segment
-            tips = [np.where(allindices[seg] == tip)[0][0]
-                    for tip in segs_tips[iseg]]
-            # find the third point on the segment that has maximal
-            # added distance from the two tip points
-            dseg = Dseg[tips[0]] + Dseg[tips[1]]
-            # add this point to tips, it's a third tip, we store it at the first
-            # position in an array called tips3
-            third_tip = np.argmax(dseg)
-            if third_maximizer is not None:
-                # find a fourth point that has maximal distance to all three
-                dseg += Dseg[third_tip]
-                fourth_tip = np.argmax(dseg)
-                if fourth_tip != tips[0] and fourth_tip != third_tip:
-                    tips[1] = fourth_tip
-                    dseg -= Dseg[tips[1]]
-                else:
-                    dseg -= Dseg[third_tip]
-            tips3 = np.insert(tips, 0, third_tip)
-            # compute the score as ratio of the added distance to the third tip,
-            # to what it would be if it were on the straight line between the
-            # two first tips, given by Dseg[tips[:2]]
-            # if we did not normalize, there would be a danger of simply
-            # assigning the highest score to the longest segment
-            score = dseg[tips3[0]] / Dseg[tips3[1], tips3[2]]
-            logg.m('... group', iseg, 'score', score, 'n_points', len(seg),
-                   '(too small)' if len(seg) < self.min_group_size else '', v=4)
-            if len(seg) < self.min_group_size: score = 0
-            # write result
-            scores_tips[iseg, 0] = score
-            scores_tips[iseg, 1:] = tips3
-        iseg = np.argmax(scores_tips[:, 0])
-        tips3 = scores_tips[iseg, 1:].astype(int)
-        return iseg, tips3
+
+            def dist(i, j):
+                return self.Dchosen[i, j]
+
+            def argfarthest(tips):
+                return np.argmax(np.sum(Dseg[tips], axis=0))
+        third_maximizer = None
+        if segs_undecided[iseg]:
+            # check that none of our tips "connects" with a tip of the
+            # other segments
+            for jseg in range(len(segs)):
+                if jseg != iseg:
+                    # take the inner tip, the "second tip" of the segment
+                    for itip in range(2):
+                        if (dist(segs_tips[jseg][1], segs_tips[iseg][itip])
+                            < 0.5 * dist(segs_tips[iseg][~itip], segs_tips[iseg][itip])):
+                            # logg.m('... group', iseg, 'with tip', segs_tips[iseg][itip],
+                            #        'connects with', jseg, 'with tip', segs_tips[jseg][1], v=4)
+                            # logg.m('    do not use the tip for "triangulation"', v=4)
+                            third_maximizer = itip
+        # map the global position to the position within the segment
+        if np.any(self.cells_seg[segs_tips[iseg]] != iseg):
+            raise ValueError('The tips of group {} are not in the group.'.format(iseg))
+        tips = list(self.cells_pos[segs_tips[iseg]])
+        # find the third point on the segment that has maximal
+        # added distance from the two tip points, the added distance of a
+        # point is
+        #     dseg = Dseg[tips[0]] + Dseg[tips[1]]
+        # add this point to tips, it's a third tip, we store it at the first
+        # position in an array called tips3
+        third_tip = argfarthest(tips)
+        dseg_third = dist(seg[tips[0]], seg[third_tip]) + dist(seg[tips[1]], seg[third_tip])
+        if third_maximizer is not None:
+            # find a fourth point that has maximal distance to all three
+            fourth_tip = argfarthest(tips + [third_tip])
+            if fourth_tip != tips[0] and fourth_tip != third_tip:
+                # as dseg += Dseg[third_tip], dseg -= Dseg[fourth_tip]
+                dseg_third -= dist(seg[fourth_tip], seg[third_tip])
+                tips[1] = fourth_tip
+        tips3 = np.insert(tips, 0, third_tip)
+        # compute the score as ratio of the added distance to the third tip,
+        # to what it would be if it were on the straight line between the
+        # two first tips, given by Dseg[tips[:2]]
+        # if we did not normalize, there would be a danger of simply
+        # assigning the highest score to the longest segment
+        score = dseg_third / dist(seg[tips3[1]], seg[tips3[2]])
+        logg.m('... group', iseg, 'score', score, 'n_points', len(seg),
+               '(too small)' if len(seg) < self.min_group_size else '', v=4)
+        if len(seg) < self.min_group_size: score = 0
+        return score, tips3
 
     def postprocess_segments(self):
         """Convert the format of the segment class members."""
@@ -377,10 +685,7 @@ class DPT(data_graph.DataGraph):
     def check_segments(self):
         """Perform checks on segments."""
         # find the segment that contains the root cell
-        for iseg, seg in enumerate(self.segs):
-            if self.iroot in seg:
-                isegroot = iseg
-                break
+        isegroot = iseg = self.cells_seg[self.iroot]
         # check whether the root cell is one of the tip cells of the
         # segment, if not we need to introduce a new branching, directly
         # at the root cell
@@ -392,11 +697,9 @@ class DPT(data_graph.DataGraph):
             if (False and np.min(dist_to_root) > 0.01*self.Dchosen[tuple(self.segs_tips[iseg])]
                 and self.allow_branching_at_root):
                 logg.m('... adding branching directly at root')
-                allindices = np.arange(self.X.shape[0], dtype=int)
                 tips3_global = np.insert(self.segs_tips[iseg], 0, self.iroot)
                 # map the global position to the position within the segment
-                tips3 = np.array([np.where(allindices[self.segs[iseg]] == tip)[0][0]
-                                  for tip in tips3_global])
+                tips3 = self.cells_pos[tips3_global]
                 # detect branching and update self.segs and self.segs_tips
                 self.segs, self.segs_tips = self.detect_branching(self.segs,
                                                                   self.segs_tips,
@@ -496,11 +799,13 @@ class DPT(data_graph.DataGraph):
         # branching on the segment, return the list ssegs of segments that
         # are defined by splitting this segment
         ssegs, ssegs_tips, ssegs_connects = self._detect_branching(Dseg, tips3)
-        # map back to global indices
+        # map back to global indices, keep -1 for missing tips and connections
         for iseg_new, seg_new in enumerate(ssegs):
             ssegs[iseg_new] = seg[seg_new]
-            ssegs_tips[iseg_new] = seg[ssegs_tips[iseg_new]]
-            ssegs_connects[iseg_new] = list(seg[ssegs_connects[iseg_new]])
+            ssegs_tips[iseg_new] = _map_to(seg, ssegs_tips[iseg_new])
+            ssegs_connects[iseg_new] = list(_map_to(seg, ssegs_connects[iseg_new]))
+        # the number of new segments besides the undecided cells, at most three
+        n_new = len(ssegs) - 1
         # remove previous segment
         segs.pop(iseg)
         segs_tips.pop(iseg)
@@ -513,10 +818,15 @@ class DPT(data_graph.DataGraph):
         segs += ssegs[:-1]
         segs_tips += ssegs_tips[:-1]
         segs_connects += ssegs_connects[:-1]
-        segs_undecided += [False, False, False]
+        segs_undecided += n_new * [False]
+        # update the maps from global indices to segments and positions
+        for iseg_new, seg_new in enumerate(ssegs):
+            self.cells_seg[seg_new] = (iseg if iseg_new == len(ssegs) - 1
+                                       else len(segs) - n_new + iseg_new)
+            self.cells_pos[seg_new] = np.arange(seg_new.size)
         # establish edges
         # step 0: extend dimensions and add connections of new branches to undecided cells
-        segs_adjacency += [[iseg], [iseg], [iseg]]
+        segs_adjacency += [[iseg] for iseg_new in range(n_new)]
         # step 1: adjust edges that were previously present
         # consider all previous connections with the segment
         prev_connecting_segments = segs_adjacency[iseg]
@@ -527,16 +837,16 @@ class DPT(data_graph.DataGraph):
             for iseg_new, seg_new in enumerate(ssegs[:-1]):
                 pos = segs_adjacency[jseg].index(iseg)
                 connection_to_iseg = segs_connects[jseg][pos]
-                if connection_to_iseg in seg_new:
-                    segs_adjacency[jseg][pos] = len(segs) - 3 + iseg_new
+                if self.cells_seg[connection_to_iseg] == len(segs) - n_new + iseg_new:
+                    segs_adjacency[jseg][pos] = len(segs) - n_new + iseg_new
                     pos_2 = segs_adjacency[iseg].index(jseg)
                     segs_adjacency[iseg].pop(pos_2)
                     idx = segs_connects[iseg].pop(pos_2)
-                    segs_adjacency[len(segs) - 3 + iseg_new].append(jseg)
-                    segs_connects[len(segs) - 3 + iseg_new].append(idx)
+                    segs_adjacency[len(segs) - n_new + iseg_new].append(jseg)
+                    segs_connects[len(segs) - n_new + iseg_new].append(idx)
                     break
         # step 2: each of the new segments connects with the undecided cells
-        segs_adjacency[iseg] += list(range(len(segs_adjacency) - 3, len(segs_adjacency)))
+        segs_adjacency[iseg] += list(range(len(segs_adjacency) - n_new, len(segs_adjacency)))
         segs_connects[iseg] += ssegs_connects[-1]
 
     def _detect_branching(self, Dseg, tips):
@@ -562,6 +872,9 @@ class DPT(data_graph.DataGraph):
         ssegs_tips : list of np.ndarray
             List of tips of segments in ssegs.
         """
+        if isinstance(Dseg, data_graph.OnFlySymMatrix):
+            # compute the rows of the tips in a single batch
+            Dseg.fetch(tips)
         if True:
             ssegs = self._detect_branching_single(Dseg, tips)
         else:  # not needed, just for conserving the idea
@@ -576,30 +889,58 @@ class DPT(data_graph.DataGraph):
         for iseg, mask in enumerate(masks):
             mask[nonunique] = False
             ssegs.append(np.arange(Dseg.shape[0], dtype=int)[mask])
+        # drop empty segments, this happens if a tip is not assigned uniquely
+        # or if the segment has no third branch
+        tips = [tip for tip, sseg in zip(tips, ssegs) if sseg.size > 0]
+        ssegs = [sseg for sseg in ssegs if sseg.size > 0]
+        if self._uses_Ddiff_tree(Dseg):
+            # for the DPT distance, query trees of the new segments in the
+            # weighted eigenbasis instead of computing rows of the distance
+            # matrix
+            seg = (np.arange(Dseg.shape[0]) if Dseg.restrict_array is None
+                   else Dseg.restrict_array)
+
+            def argextreme(i, cells, farthest):
+                return cells[self.get_Ddiff_extreme(seg[i], seg[cells], farthest)[0]]
+        else:
+            def argextreme(i, cells, farthest):
+                Dseg_i = Dseg[i][cells]
+                return cells[np.argmax(Dseg_i) if farthest else np.argmin(Dseg_i)]
         # compute new tips within new segments
         ssegs_tips = []
         for inewseg, newseg in enumerate(ssegs):
-            secondtip = newseg[np.argmax(Dseg[tips[inewseg]][newseg])]
-            ssegs_tips.append([tips[inewseg], secondtip])
+            tip = tips[inewseg]
+            secondtip = argextreme(tip, newseg, farthest=True)
+            # a tip that is not assigned uniquely is not in the segment,
+            # replace it with the closest point of the segment
+            if not np.any(newseg == tip):
+                tip = argextreme(tip, newseg, farthest=False)
+            ssegs_tips.append([tip, secondtip])
         # add the points not associated with a clear seg to ssegs
         mask = np.zeros(Dseg.shape[0], dtype=bool)
         # all points assigned to segments (flatten ssegs)
-        mask[[i for l in ssegs for i in l]] = True
+        mask[np.concatenate(ssegs)] = True
         # append all the points that have not been assigned, in Haghverdi et
         # al. (2016), we call them 'undecided cells'
         undecided_cells = np.arange(Dseg.shape[0], dtype=int)[mask == False]
         ssegs.append(undecided_cells)
-        # establish the connecting points with the other segments
-        ssegs_connects = [[], [], [], []]
+        # establish the connecting points with the other segments, an empty
+        # group of undecided cells is connected via -1
+        ssegs_connects = [[] for sseg in ssegs]
         for inewseg, newseg_tips in enumerate(ssegs_tips):
             secondtip = newseg_tips[1]
-            closest_cell = undecided_cells[np.argmin(Dseg[secondtip][undecided_cells])]
+            closest_cell = (argextreme(secondtip, undecided_cells, farthest=False)
+                            if undecided_cells.size > 0 else -1)
             ssegs_connects[inewseg].append(closest_cell)
             ssegs_connects[-1].append(secondtip)
-        # also compute tips for the undecided cells
-        tip_0 = undecided_cells[np.argmax(Dseg[undecided_cells[0]][undecided_cells])]
-        tip_1 = undecided_cells[np.argmax(Dseg[tip_0][undecided_cells])]
-        ssegs_tips.append([tip_0, tip_1])
+        # also compute tips for the undecided cells, as for small groups, an
+        # empty group has tips -1
+        if undecided_cells.size > 0:
+            tip_0 = argextreme(undecided_cells[0], undecided_cells, farthest=True)
+            tip_1 = argextreme(tip_0, undecided_cells, farthest=True)
+            ssegs_tips.append([tip_0, tip_1])
+        else:
+            ssegs_tips.append([-1, -1])
         return ssegs, ssegs_tips, ssegs_connects
 
     def _detect_branching_single(self, Dseg, tips):
@@ -608,13 +949,14 @@ class DPT(data_graph.DataGraph):
         # compute branchings using different starting points the first index of
         # tips is the starting point for the other two, the order does not
         # matter
-        ssegs = []
         # permutations of tip cells
         ps = [[0, 1, 2],  # start by computing distances from the first tip
               [1, 2, 0],  #             -"-                       second tip
               [2, 0, 1]]  #             -"-                       third tip
-        for i, p in enumerate(ps):
-            ssegs.append(self.__detect_branching(Dseg, tips[p]))
+        # the permutations are independent, run them in threads if n_jobs > 1
+        ssegs = parallel.run(self.__detect_branching,
+                             [(Dseg, tips[p]) for p in ps],
+                             n_jobs=self.n_jobs, backend='threading')
         return ssegs
 
     def _detect_branching_versions(self, Dseg, tips):
@@ -721,6 +1063,10 @@ class DPT(data_graph.DataGraph):
         Returns the splitting index that maximizes
             kendalltau(a[:i], b[:i]) - kendalltau(a[i:], b[i:])
 
+        The concordances of each element with all previous and all later
+        elements are computed at once by `_prefix_concordance` in
+        O(n log^2 n), Kendall tau is then updated via cumulative sums.
+
         Parameters
         ----------
         a, b : np.ndarray
@@ -739,33 +1085,22 @@ class DPT(data_graph.DataGraph):
         min_length = 5
         n = a.size
         idx_range = np.arange(min_length, a.size-min_length-1, dtype=int)
-        corr_coeff = np.zeros(idx_range.size)
         pos_old = sp.stats.kendalltau(a[:min_length], b[:min_length])[0]
         neg_old = sp.stats.kendalltau(a[min_length:], b[min_length:])[0]
-        for ii, i in enumerate(idx_range):
-            if True:
-                # compute differences in concordance when adding a[i] and b[i]
-                # to the first subsequence, and removing these elements from
-                # the second subsequence
-                diff_pos, diff_neg = self._kendall_tau_diff(a, b, i)
-                pos = pos_old + self._kendall_tau_add(i, diff_pos, pos_old)
-                neg = neg_old + self._kendall_tau_subtract(n-i, diff_neg, neg_old)
-                pos_old = pos
-                neg_old = neg
-            if False:
-                # computation using sp.stats.kendalltau, takes much longer!
-                # just for debugging purposes
-                pos = sp.stats.kendalltau(a[:i+1], b[:i+1])[0]
-                neg = sp.stats.kendalltau(a[i+1:], b[i+1:])[0]
-            if False:
-                # the following is much slower than using sp.stats.kendalltau,
-                # it is only good for debugging because it allows to compute the
-                # tau-a version, which does not account for ties, whereas
-                # sp.stats.kendalltau computes tau-b version, which accounts for
-                # ties
-                pos = sp.stats.mstats.kendalltau(a[:i], b[:i], use_ties=False)[0]
-                neg = sp.stats.mstats.kendalltau(a[i:], b[i:], use_ties=False)[0]
-            corr_coeff[ii] = pos - neg
+        # difference between concordant and non-concordant pairs of the
+        # element i with the previous and the later elements
+        diff_pos, diff_neg = _prefix_concordance(a, b)
+        # adding element i to a sequence of length i changes tau by
+        # 2/(i+1) * (diff_pos[i]/i - tau), that is, tau times the number of
+        # pairs changes by diff_pos[i], removing it works analogously
+        n_pairs_pos = (idx_range + 1) * idx_range / 2
+        pos = (pos_old * min_length * (min_length - 1) / 2
+               + np.cumsum(diff_pos[idx_range])) / n_pairs_pos
+        n_neg = n - idx_range - 1
+        n_pairs_neg = n_neg * (n_neg - 1) / 2
+        neg = (neg_old * (n - min_length) * (n - min_length - 1) / 2
+               - np.cumsum(diff_neg[idx_range])) / n_pairs_neg
+        corr_coeff = pos - neg
         iimax = np.argmax(corr_coeff)
         imax = min_length + iimax
         corr_coeff_max = corr_coeff[iimax]
@@ -773,71 +1108,134 @@ class DPT(data_graph.DataGraph):
             logg.m('... is root itself, never obtain significant correlation', v=4)
         return imax
 
-    def _kendall_tau_add(self, len_old, diff_pos, tau_old):
-        """Compute Kendall tau delta.
 
-        The new sequence has length len_old + 1.
+def _map_to(indices, positions):
+    """Map positions to indices, keeping -1 for missing tips or connections."""
+    positions = np.asarray(positions, dtype=int)
+    return np.where(positions >= 0, indices[positions], -1)
 
-        Parameters
-        ----------
-        len_old : int
-            The length of the old sequence, used to compute tau_old.
-        diff_pos : int
-            Difference between concordant and non-concordant pairs.
-        tau_old : float
-            Kendall rank correlation of the old sequence.
-        """
-        return 2./(len_old+1)*(float(diff_pos)/len_old-tau_old)
 
-    def _kendall_tau_subtract(self, len_old, diff_neg, tau_old):
-        """Compute Kendall tau delta.
+def _prefix_concordance(a, b):
+    """Concordance of each element with the previous and the later elements.
 
-        The new sequence has length len_old - 1.
+    Returns
+    -------
+    diff_pos, diff_neg : np.ndarray
+        diff_pos[i] is the sum of sign(a[j] - a[i]) * sign(b[j] - b[i]) over
+        j < i, diff_neg[i] the same over j > i.
 
-        Parameters
-        ----------
-        len_old : int
-            The length of the old sequence, used to compute tau_old.
-        diff_neg : int
-            Difference between concordant and non-concordant pairs.
-        tau_old : float
-            Kendall rank correlation of the old sequence.
-        """
-        return 2./(len_old-2)*(-float(diff_neg)/(len_old-1)+tau_old)
+    Notes
+    -----
+    Counting over j < i is a dominance problem in the three dimensions
+    index, a and b. It is solved by divide and conquer over the index: on
+    each of the log n levels, the elements in the right halves of blocks are
+    compared with those in the left halves by `_concordance`, which costs
+    O(n log n) as it counts with the Fenwick tree of `_count_earlier`.
+    Overall, this is O(n log^2 n) instead of O(n^2).
+    """
+    n = a.size
+    ra = np.unique(a, return_inverse=True)[1].ravel()
+    rb = np.unique(b, return_inverse=True)[1].ravel()
+    positions = np.arange(n)
+    diff_pos = np.zeros(n, dtype=np.int64)
+    width = 1
+    while width < n:
+        blocks = positions // width
+        left = blocks % 2 == 0
+        right = ~left
+        diff_pos[right] += _concordance(blocks[left] // 2, ra[left], rb[left],
+                                        blocks[right] // 2, ra[right], rb[right])
+        width *= 2
+    groups = np.zeros(n, dtype=np.int64)
+    diff_all = _concordance(groups, ra, rb, groups, ra, rb)
+    return diff_pos, diff_all - diff_pos
 
-    def _kendall_tau_diff(self, a, b, i):
-        """Compute difference in concordance of pairs in split sequences.
 
-        Consider splitting a and b at index i.
+def _concordance(g_points, x_points, y_points, g, x, y):
+    """Sum of sign(x_p - x) * sign(y_p - y) over the points p of group g.
 
-        Parameters
-        ----------
-        a, b : np.ndarray
+    All arguments are integer arrays, x and y are ranks. Computed for all
+    queries (g, x, y) from the numbers of points in the four quadrants around
+    the query. Sorting and counting cost O(m log m) for m points and queries.
+    """
+    R = max(x_points.max(), x.max(), y_points.max(), y.max()) + 2
+    lower = g * R
+    keys_x = np.sort(g_points * R + x_points)
+    keys_y = np.sort(g_points * R + y_points)
+    start = np.searchsorted(keys_x, lower)
+    n_total = np.searchsorted(keys_x, lower + R) - start
+    n_x_lt = np.searchsorted(keys_x, lower + x) - start
+    n_x_le = np.searchsorted(keys_x, lower + x, side='right') - start
+    start = np.searchsorted(keys_y, lower)
+    n_y_lt = np.searchsorted(keys_y, lower + y) - start
+    n_y_le = np.searchsorted(keys_y, lower + y, side='right') - start
+    # order the points and two copies of the queries by x within the groups,
+    # the copies are placed before and after the points with the same x,
+    # respectively
+    n_points, n_queries = g_points.size, g.size
+    order = np.lexsort((np.r_[2*x_points + 1, 2*x, 2*x + 2],
+                        np.r_[g_points, g, g]))
+    is_point = order < n_points
+    lt, le = _count_earlier(np.r_[g_points, g, g][order],
+                            np.r_[y_points, y, y][order], is_point)
+    counts_lt = np.empty_like(lt)
+    counts_lt[order] = lt
+    counts_le = np.empty_like(le)
+    counts_le[order] = le
+    strict, equal = slice(n_points, n_points + n_queries), slice(n_points + n_queries, None)
+    # points in the four quadrants, excluding ties
+    ll = counts_lt[strict]
+    lg = n_x_lt - counts_le[strict]
+    gl = n_y_lt - counts_lt[equal]
+    gg = (n_total - n_x_le) - (n_y_le - counts_le[equal])
+    return ll + gg - lg - gl
 
-        Returns
-        -------
-        diff_pos, diff_neg : int, int
-            Difference between concordant and non-concordant pairs for both
-            subsequences.
-        """
-        # compute ordering relation of the single points a[i] and b[i]
-        # with all previous points of the sequences a and b, respectively
-        a_pos = np.zeros(a[:i].size, dtype=int)
-        a_pos[a[:i] > a[i]] = 1
-        a_pos[a[:i] < a[i]] = -1
-        b_pos = np.zeros(b[:i].size, dtype=int)
-        b_pos[b[:i] > b[i]] = 1
-        b_pos[b[:i] < b[i]] = -1
-        diff_pos = np.dot(a_pos, b_pos).astype(float)
-
-        # compute ordering relation of the single points a[i] and b[i]
-        # with all later points of the sequences
-        a_neg = np.zeros(a[i:].size, dtype=int)
-        a_neg[a[i:] > a[i]] = 1
-        a_neg[a[i:] < a[i]] = -1
-        b_neg = np.zeros(b[i:].size, dtype=int)
-        b_neg[b[i:] > b[i]] = 1
-        b_neg[b[i:] < b[i]] = -1
-        diff_neg = np.dot(a_neg, b_neg)
-
-        return diff_pos, diff_neg
+
+def _count_earlier(g, y, is_point):
+    """Count the earlier points of the same group with smaller y.
+
+    A Fenwick tree over the bits of y that is evaluated for all elements at
+    once, level by level. On each level, the elements are ordered by their
+    node and within nodes by their position in the sequence. A query in the
+    upper half of a node counts the earlier points in the lower half, then,
+    the nodes are split stably. Each of the log(max(y)) levels costs O(n).
+    The elements need to be sorted by group, which are the nodes of the
+    first level.
+
+    Returns
+    -------
+    lt, le : np.ndarray
+        Numbers of earlier points with smaller and with smaller or equal y.
+    """
+    n = g.size
+    n_bits = int(y.max()).bit_length()
+    keys = (g.astype(np.int64) << n_bits) | y
+    positions = np.arange(n)
+    lt = np.zeros(n, dtype=np.int64)
+    counts = np.zeros(n + 1, dtype=np.int64)
+    order = positions
+    for level in range(n_bits, -1, -1):
+        keys_level = keys[order]
+        node = keys_level >> level
+        is_start = np.ones(n, dtype=bool)
+        is_start[1:] = node[1:] != node[:-1]
+        start = np.maximum.accumulate(np.where(is_start, positions, 0))
+        if level == 0:
+            break
+        upper = (keys_level >> (level - 1)) & 1 == 1
+        np.cumsum(is_point[order] & ~upper, out=counts[1:])
+        lt[order[upper]] += (counts[:-1] - counts[start])[upper]
+        # stable split of the nodes into their lower and upper halves
+        np.cumsum(~upper, out=counts[1:])
+        n_lower_before = counts[:-1] - counts[start]
+        stop = np.r_[np.flatnonzero(is_start)[1:], n][np.cumsum(is_start) - 1]
+        split = start + counts[stop] - counts[start]
+        order_split = np.empty_like(order)
+        order_split[np.where(upper, split + positions - start - n_lower_before,
+                             start + n_lower_before)] = order
+        order = order_split
+    # the leaves contain the points with equal y
+    np.cumsum(is_point[order], out=counts[1:])
+    le = lt.copy()
+    le[order] += counts[:-1] - counts[start]
+    return lt, le
@@ -0,0 +1,73 @@
+# Author: F. Alex Wolf (http://falexwolf.de)
+"""k Nearest Neighbors
+"""
+
+from .. import settings as sett
+from .. import logging as logg
+from ..data_structs import data_graph
+
+
+def neighbors(adata, k=30, n_pcs=50, method='auto', method_params=None,
+              n_jobs=None, recompute=False, copy=False):
+    """Compute k nearest neighbors and store them for reuse.
+
+    The graph-based tools `diffmap`, `dpt`, `spring` and `dbscan` reuse the
+    neighbors if the representation of the data matches and if at most k
+    neighbors are requested. Otherwise, they recompute the neighbors, and
+    only replace the stored ones if they compute at least k neighbors.
+
+    Parameters
+    ----------
+    adata : AnnData
+        Annotated data matrix, optionally with adata.smp['X_pca'].
+    k : int, optional (default: 30)
+        Number of nearest neighbors, including the data point itself.
+    n_pcs : int, optional (default: 50)
+        Use the first n_pcs principal components, computing them if
+        adata.smp['X_pca'] does not store enough of them. Set to 0 to use X.
+    method : str, optional (default: 'auto')
+        See `data_graph.neighbors_methods`, e.g., 'brute' for exact and
+        'nn_descent' for approximate neighbors. 'auto' chooses the exact
+        'brute' for up to 100000 samples and the exact 'sklearn' above.
+    method_params : dict or None, optional (default: None)
+        Parameters passed to the method.
+    n_jobs : int or None (default: None)
+        Number of threads, defaults to sett.n_jobs.
+    recompute : bool, optional (default: False)
+        Recompute even if matching neighbors are stored.
+    copy : bool (default: False)
+        Return a copy instead of writing to adata.
+
+    Notes
+    -----
+    The following is added to adata.add
+        neighbors_indices : np.ndarray
+            Array of shape n_samples x (k-1), sorted by distance.
+        neighbors_distances : np.ndarray
+            Squared Euclidean distances of shape n_samples x (k-1).
+        neighbors_k, neighbors_rep, neighbors_n_pcs, neighbors_metric,
+        neighbors_fingerprint
+            Parameters that identify the representation.
+        neighbors_method, neighbors_params
+            The method that computed the neighbors and its parameters.
+    """
+    logg.m('compute neighbors', r=True)
+    adata = adata.copy() if copy else adata
+    n_jobs = sett.n_jobs if n_jobs is None else n_jobs
+    if n_pcs == 0 or adata.X.shape[1] < n_pcs:
+        X, rep, n_pcs = adata.X, 'X', 0
+        logg.m('... using X')
+    else:
+        if 'X_pca' not in adata.smp or adata.smp['X_pca'].shape[1] < n_pcs:
+            logg.m('... compute X_pca')
+            from ..preprocessing import pca
+            pca(adata, n_comps=n_pcs)
+        X, rep = adata.smp['X_pca'][:, :n_pcs], 'X_pca'
+        logg.m('... using X_pca with', n_pcs, 'components')
+    data_graph.get_neighbors_cached(adata, X, rep, n_pcs, k, n_jobs=n_jobs,
+                                    method=method, method_params=method_params,
+                                    recompute=recompute, overwrite=True)
+    logg.m('finished', t=True, end=' ')
+    logg.m('and added\n'
+           '    "neighbors_indices" and "neighbors_distances" (adata.add)')
+    return adata if copy else None
@@ -0,0 +1,62 @@
+# Author: F. Alex Wolf (http://falexwolf.de)
+"""Spectral Layout
+"""
+
+from .. import logging as logg
+from ..data_structs import data_graph
+
+
+def spectral(adata, n_comps=2, k=30, n_pcs=50, normalized=True, n_jobs=None,
+             copy=False):
+    """Spectral Layout
+
+    Visualize data using the eigenvectors of the graph Laplacian, also known
+    as Laplacian eigenmaps. Is fast on large knn graphs and provides an
+    initialization for `spring`.
+
+    References
+    ----------
+    - Laplacian eigenmaps: Belkin & Niyogi, Neural Computation 15, 1373 (2003).
+    - Spectral clustering: von Luxburg, arXiv:0711.0189 (2007).
+
+    Parameters
+    ----------
+    adata : AnnData
+        Annotated data matrix.
+    n_comps : int, optional (default: 2)
+        The number of dimensions of the representation.
+    k : int, optional (default: 30)
+        Number of nearest neighbors in the knn graph.
+    n_pcs : int, optional (default: 50)
+        Use the first n_pcs principal components for building the graph. Set
+        to 0 to use X.
+    normalized : bool, optional (default: True)
+        Use the normalized Laplacian, whose eigenvectors are computed as the
+        largest eigenvectors of the normalized adjacency matrix. Otherwise,
+        use the unnormalized Laplacian.
+    n_jobs : int or None
+        Number of CPUs to use (default: sett.n_jobs).
+    copy : bool (default: False)
+        Return a copy instead of writing to adata.
+
+    Notes
+    -----
+    The following is added to adata.smp
+        X_spectral : np.ndarray
+            Array of shape n_samples x n_comps, the eigenvectors of the graph
+            Laplacian with the smallest non-zero eigenvalues.
+    The following is added to adata.add
+        spectral_evals : np.ndarray
+            Eigenvalues of the graph Laplacian.
+    """
+    logg.m('compute spectral layout', r=True)
+    adata = adata.copy() if copy else adata
+    graph = data_graph.DataGraph(adata, k=k, n_pcs=n_pcs, n_jobs=n_jobs)
+    layout = graph.spec_layout(n_comps=n_comps, normalized=normalized)
+    adata.smp['X_spectral'] = layout['Y']
+    adata.add['spectral_evals'] = layout['evals']
+    logg.m('finished', t=True, end=' ')
+    logg.m('and added\n'
+           '    the data representation "X_spectral" (adata.smp),\n'
+           '    the eigen values of the graph Laplacian "spectral_evals" (adata.add)')
+    return adata if copy else None
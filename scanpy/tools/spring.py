@@ -16,6 +16,7 @@ References
 import numpy as np
 from .. import settings as sett
 from .. import utils
+from ..data_structs import data_graph
 
 step_size = 10
 
@@ -31,6 +32,9 @@ def spring(adata, k=4, n_comps=2, n_steps=12, rep=None, copy=False):
         adata.smp['X_pca']: np.ndarray
             Result of preprocessing with PCA: observations × variables.
             If it exists, spring will use this instead of adata.X.
+        adata.smp['X_spectral']: np.ndarray
+            Result of `spectral`. If it exists, spring will use it as initial
+            positions.
     k : int
         Number of nearest neighbors in graph.
     n_comps : int
@@ -52,31 +56,37 @@ def spring(adata, k=4, n_comps=2, n_steps=12, rep=None, copy=False):
     sett.m(0, 'draw knn graph')
     if 'X_pca' in adata.smp:
         X = adata.smp['X_pca']
+        rep_key, n_pcs = 'X_pca', X.shape[1]
         sett.m(0, '--> using X_pca for building graph')
     else:
         X = adata.X
+        rep_key, n_pcs = 'X', 0
         sett.m(0, '--> using X for building graph')
-    D = utils.comp_distance(X, metric='euclidean')
-    # deterimine the distance of the k nearest neighbors
-    indices = np.zeros((D.shape[0], k), dtype=np.int_)
-    for irow, row in enumerate(D):
-        # the last item is already in its sorted position as
-        # argpartition puts the (k-1)th element - starting to count from
-        # zero - in its sorted position
-        idcs = np.argpartition(row, k-1)[:k]
-        indices[irow] = idcs
+    # the k nearest neighbors, which include the point itself, are reused
+    # from adata.add if possible
+    indices, _ = data_graph.get_neighbors_cached(adata, X, rep_key, n_pcs, k,
+                                                 n_jobs=sett.n_jobs)
+    indices = np.c_[np.arange(X.shape[0]), indices]
     # compute adjacency matrix
     # make this float, as we might put a weight matrix here
-    Adj = np.zeros(D.shape, dtype=float)
+    Adj = np.zeros((X.shape[0], X.shape[0]), dtype=float)
     for irow, row in enumerate(indices):
         Adj[irow, row] = 1
         # symmetrize as in DPT
         # for j in row:
         #    if irow not in indices[j]:
         #        Adj[j,irow] = 1
-    # just sample initial positions, the rest is done by the plotting tool
-    np.random.seed(1)
-    Y = np.asarray(np.random.random((Adj.shape[0], 2)), dtype=Adj.dtype)
+    if 'X_spectral' in adata.smp and adata.smp['X_spectral'].shape[1] >= 2:
+        # start from the spectral layout, rescaled to the unit square
+        Y = np.asarray(adata.smp['X_spectral'][:, :2], dtype=Adj.dtype)
+        ptp = np.ptp(Y, axis=0)
+        ptp[ptp == 0] = 1  # a constant component stays at 0
+        Y = (Y - Y.min(axis=0)) / ptp
+        sett.m(0, '--> using X_spectral as initial positions')
+    else:
+        # just sample initial positions, the rest is done by the plotting tool
+        np.random.seed(1)
+        Y = np.asarray(np.random.random((Adj.shape[0], 2)), dtype=Adj.dtype)
     sett.m(0, 'is very slow, will be sped up soon')
     for istep in 1 + np.arange(n_steps, dtype=int):
         sett.mt(0, 'compute Fruchterman-Reingold layout: step', istep)
@@ -31,6 +31,8 @@ def tsne(adata, random_state=0, n_pcs=50, perplexity=30, n_jobs=None, copy=False
     adata : AnnData
         Annotated data matrix, optionally with adata.smp['X_pca'], which is
         written when running sc.pca(adata). Is directly used for tSNE.
+        Optionally with adata.smp['X_spectral'], the result of `spectral`.
+        If it exists, it is used as initial positions by sklearn's tSNE.
     random_state : unsigned int or -1, optional (default: 0)
         Change to use different intial states for the optimization, if -1, use
         default behavior of implementation (sklearn uses np.random.seed,
@@ -80,11 +82,15 @@ def tsne(adata, random_state=0, n_pcs=50, perplexity=30, n_jobs=None, copy=False
     n_jobs = sett.n_jobs if n_jobs is None else n_jobs
     # deal with different tSNE implementations
     multicore_failed = False
+    has_spectral = 'X_spectral' in adata.smp and adata.smp['X_spectral'].shape[1] >= 2
     if n_jobs > 1:
         try:
             from MulticoreTSNE import MulticoreTSNE as TSNE
             tsne = TSNE(n_jobs=n_jobs, **params_sklearn)
             logg.m('... using MulticoreTSNE')
+            if has_spectral:
+                logg.m('... MulticoreTSNE does not take initial positions, '
+                       'not using X_spectral')
             X_tsne = tsne.fit_transform(X.astype(np.float64))
         except ImportError:
             multicore_failed = True
@@ -98,6 +104,14 @@ def tsne(adata, random_state=0, n_pcs=50, perplexity=30, n_jobs=None, copy=False
                '    Even for `n_jobs=1` this speeds up the computation considerably.',
                v='hint')
         logg.m('... using sklearn.manifold.TSNE')
+        if has_spectral:
+            # start from the spectral layout, scaled as sklearn scales its
+            # PCA initialization
+            init = np.array(adata.smp['X_spectral'][:, :2], dtype=np.float32)
+            std = np.std(init[:, 0])
+            init *= 1e-4 / (std if std > 0 else 1)
+            tsne.set_params(init=init)
+            logg.m('... using X_spectral as initial positions')
         X_tsne = tsne.fit_transform(X)
     # update AnnData instance
     adata.smp['X_tsne'] = X_tsne
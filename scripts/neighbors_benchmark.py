@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Benchmark recall and throughput of approximate against exact neighbors
+
+The exact neighbors are only computed for a random sample of query points and
+the runtime of the exact computation for all points is extrapolated from
+this. Pass a file with a PCA representation `X_pca` or use synthetic data.
+
+Example
+-------
+    python scripts/neighbors_benchmark.py --n_samples 1000000
+"""
+import argparse
+import time
+from sys import path
+# scanpy, first try loading it locally
+path.insert(0, '.')
+path.insert(0, '..')
+import numpy as np
+from scanpy.data_structs import data_graph
+
+
+def synthetic_data(n_samples, n_dims, n_clusters=20, seed=0):
+    np.random.seed(seed)
+    centers = 5 * np.random.randn(n_clusters, n_dims)
+    labels = np.random.randint(n_clusters, size=n_samples)
+    X = centers[labels] + np.random.randn(n_samples, n_dims)
+    return X.astype(np.float32)
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    p.add_argument('--filename', default=None,
+                   help='File readable by sc.read that stores "X_pca".')
+    p.add_argument('--n_samples', type=int, default=100000)
+    p.add_argument('--n_dims', type=int, default=50)
+    p.add_argument('--k', type=int, default=30)
+    p.add_argument('--n_jobs', type=int, default=1)
+    p.add_argument('--n_queries', type=int, default=2000)
+    p.add_argument('--n_trees', type=int, default=None)
+    p.add_argument('--n_iters', type=int, default=10)
+    p.add_argument('--rho', type=float, default=0.5)
+    args = p.parse_args()
+    if args.filename is not None:
+        import scanpy as sc
+        X = sc.read(args.filename).smp['X_pca'].astype(np.float32)
+    else:
+        X = synthetic_data(args.n_samples, args.n_dims)
+    print('data of shape', X.shape)
+    # approximate
+    start = time.time()
+    indices, distances = data_graph.get_neighbors_nn_descent(
+        X, args.k, n_jobs=args.n_jobs,
+        n_trees=args.n_trees, n_iters=args.n_iters, rho=args.rho)
+    time_approx = time.time() - start
+    # exact for a sample of queries
+    queries = np.random.RandomState(0).choice(X.shape[0], min(args.n_queries, X.shape[0]),
+                                              replace=False)
+    start = time.time()
+    indices_exact, _ = data_graph.get_neighbors(X[queries], X, args.k)
+    time_exact = (time.time() - start) * X.shape[0] / queries.size
+    recall = np.mean([np.intersect1d(a, b).size
+                      for a, b in zip(indices[queries], indices_exact)]) / (args.k - 1)
+    print('nn_descent: {:.1f} s, {:.0f} points/s'
+          .format(time_approx, X.shape[0] / time_approx))
+    print('brute (extrapolated): {:.1f} s, {:.0f} points/s'
+          .format(time_exact, X.shape[0] / time_exact))
+    print('recall: {:.4f}'.format(recall))
+
+
+if __name__ == '__main__':
+    main()